@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Инкрементальная лента активностей LocTracker
+Один запрос на проход для всего автопарка по курсору latestRecordId;
+курсор хранится на диске, дальше передаются только новые записи
+"""
+
+import os
+import json
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Файл с курсором ленты активностей
+ACTIVITY_CHECKPOINT_FILE = os.getenv('ACTIVITY_CHECKPOINT_FILE', '.activity_cursor.json')
+
+class ActivityStream:
+    """Лента новых активностей с долговременным курсором
+    
+    poll() возвращает записи новее курсора, ack() отмечает записи устройства, записанные
+    в Notion, commit() сохраняет курсор (доставка как минимум один раз). Курсор не проходит
+    дальше самой ранней неподтвержденной записи: она придет из ленты повторно, а уже
+    подтвержденные записи других устройств при повторе отбрасываются.
+    """
+    
+    def __init__(self, loctracker, checkpoint_file: Optional[str] = ACTIVITY_CHECKPOINT_FILE,
+                 devices: Optional[List[str]] = None, types: Optional[List[str]] = None):
+        self.loctracker = loctracker
+        self.checkpoint_file = checkpoint_file
+        self.devices = devices
+        self.types = types
+        self.cursor = self._load_cursor()
+        self._pending_cursor = self.cursor
+        # Принятые, но еще не записанные в Notion: устройство -> [меньший id, больший id]
+        self._undelivered: Dict[str, List[int]] = {}
+        # Записанные выше сохраненного курсора: устройство -> больший id
+        self._delivered: Dict[str, int] = {}
+        # ack() вызывается и из потока выгрузки очереди записей
+        self._lock = threading.Lock()
+    
+    def _load_cursor(self) -> int:
+        """Прочитать курсор (-1, если файла нет)"""
+        if not self.checkpoint_file or not os.path.exists(self.checkpoint_file):
+            return -1
+        try:
+            with open(self.checkpoint_file, 'r', encoding='utf-8') as f:
+                return int(json.load(f).get('latestRecordId', -1))
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать курсор активностей {self.checkpoint_file}: {e}")
+            return -1
+    
+    def poll(self) -> List[Dict]:
+        """Получить активности новее курсора (по возрастанию id)"""
+        records = self.loctracker.get_activity_feed(self.cursor, devices=self.devices, types=self.types)
+        return self._accept(records)
+    
+    async def poll_async(self) -> List[Dict]:
+        """То же, что poll(), для AsyncLocTrackerAPI"""
+        records = await self.loctracker.get_activity_feed(self.cursor, devices=self.devices, types=self.types)
+        return self._accept(records)
+    
+    def _accept(self, records: Optional[List[Dict]]) -> List[Dict]:
+        """Отобрать записи новее курсора и запомнить новый курсор до commit()"""
+        if not records:
+            return []
+        
+        with self._lock:
+            new_records = sorted(
+                (r for r in records if isinstance(r.get('id'), int) and r['id'] > self.cursor
+                 and r['id'] > self._delivered.get(str(r.get('deviceNumber')), self.cursor)),
+                key=lambda r: r['id']
+            )
+            for record in new_records:
+                if record.get('deviceNumber') is None:
+                    continue
+                span = self._undelivered.setdefault(str(record['deviceNumber']), [record['id'], record['id']])
+                span[0] = min(span[0], record['id'])
+                span[1] = max(span[1], record['id'])
+            if new_records:
+                self._pending_cursor = max(self._pending_cursor, new_records[-1]['id'])
+        if new_records:
+            logger.info(f"📨 Новых активностей: {len(new_records)} (курсор {self.cursor} -> {self._pending_cursor})")
+        return new_records
+    
+    def ack(self, device_number, record_id: Optional[int]):
+        """Записи устройства до record_id включительно записаны в Notion"""
+        if not isinstance(record_id, int):
+            return
+        key = str(device_number)
+        with self._lock:
+            self._delivered[key] = max(self._delivered.get(key, record_id), record_id)
+            span = self._undelivered.get(key)
+            if span is None or span[0] > record_id:
+                return
+            if span[1] <= record_id:
+                del self._undelivered[key]
+            else:
+                # Более новые записи устройства пришли после записанной
+                span[0] = record_id + 1
+    
+    def ack_others(self, device_numbers: Iterable):
+        """Подтвердить записи устройств, которые в этом проходе в Notion не пишутся"""
+        keep = {str(number) for number in device_numbers}
+        with self._lock:
+            for key in [key for key in self._undelivered if key not in keep]:
+                self._delivered[key] = max(self._delivered.get(key, self.cursor), self._undelivered.pop(key)[1])
+    
+    def commit(self):
+        """Сохранить курсор после обработки полученных записей (атомарно)
+        
+        Если записи какого-то устройства не записаны (ошибка или запись еще в очереди),
+        курсор сдвигается только до записи перед самой ранней из них.
+        """
+        with self._lock:
+            cursor = self._pending_cursor
+            if self._undelivered:
+                held = min(span[0] for span in self._undelivered.values()) - 1
+                if held < cursor:
+                    logger.warning(f"⏸️ Курсор активностей удержан на {max(held, self.cursor)}: "
+                                   f"не записаны активности {len(self._undelivered)} устройств")
+                    cursor = held
+            cursor = max(cursor, self.cursor)
+            # Записи не новее курсора из ленты больше не придут
+            self._delivered = {key: record_id for key, record_id in self._delivered.items() if record_id > cursor}
+            if cursor == self.cursor:
+                return
+            self.cursor = cursor
+        if not self.checkpoint_file:
+            return
+        tmp_file = f"{self.checkpoint_file}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'latestRecordId': self.cursor}, f)
+            os.replace(tmp_file, self.checkpoint_file)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить курсор активностей {self.checkpoint_file}: {e}")
+
+def latest_by_device(records: List[Dict]) -> Dict[str, Dict]:
+    """Последняя новая активность по каждому устройству"""
+    latest = {}
+    for record in records:
+        device_number = record.get('deviceNumber')
+        if device_number is not None:
+            latest[str(device_number)] = record
+    return latest
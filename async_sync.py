@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Асинхронная синхронизация LocTracker -> Notion (asyncio)
+Все запросы к LocTracker и записи в Notion выполняются одновременно под семафорами,
+поэтому проход ограничен самыми медленными запросами, а не их суммой
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+import httpx
+from notion_client import AsyncClient
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+from activity_stream import ActivityStream, latest_by_device
+from fleet_geo import apply_task_distances
+from snapshot_store import SNAPSHOT_DB_FILE, SnapshotStore
+from position_history import POSITION_HISTORY_DIR, PositionHistory
+from sync_metrics import METRICS, record_pass
+from sync_priority import SYNC_ORDER
+from change_gate import CHANGE_GATE_ENABLED, ChangeGate
+from task_geofence import GEOFENCE_ENABLED, GeofenceTracker
+from vehicle_state import VehicleStates
+from sync_dispatcher_data import (
+    LOCTRACKER_CONNECT_TIMEOUT,
+    LOCTRACKER_POOL_SIZE,
+    LOCTRACKER_READ_TIMEOUT,
+    ACTIVITY_STREAM_ENABLED,
+    NOTION_BASE_URL,
+    NOTION_NON_IDEMPOTENT_METHODS,
+    NOTION_RATE_LIMIT,
+    NOTION_STATE_FILE,
+    DispatcherNotionSync,
+    LocTrackerAPI,
+    _build_fleet_tasks_dict,
+    _detect_arrivals,
+    _gate_vehicles,
+    _merge_device_data,
+    _plan_priority,
+    _prepare_payloads,
+    _record_positions,
+    _roster,
+)
+
+logger = logging.getLogger(__name__)
+
+# Одновременных запросов к LocTracker и одновременных записей в Notion
+ASYNC_LOCTRACKER_CONCURRENCY = int(os.getenv('ASYNC_LOCTRACKER_CONCURRENCY', '32'))
+ASYNC_NOTION_CONCURRENCY = int(os.getenv('ASYNC_NOTION_CONCURRENCY', '8'))
+
+class AsyncRateLimiter:
+    """Token bucket для asyncio с паузой по Retry-After (аналог RateLimiter)"""
+    
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Дождаться токена"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated_at) * self.rate)
+                self.updated_at = max(now, self.updated_at)
+                if now < self.paused_until:
+                    # Во время паузы токены не накапливаются
+                    self.tokens = 0
+                    self.updated_at = self.paused_until
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+                await asyncio.sleep(wait)
+    
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов для всех задач (например, после 429)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+async def _drive_async(steps, perform) -> Any:
+    """Как _drive, но perform - корутина (запросы выполняются через await)"""
+    try:
+        request = next(steps)
+        while True:
+            try:
+                result = await perform(*request)
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(result)
+    except StopIteration as done:
+        return done.value
+
+class AsyncLocTrackerAPI(LocTrackerAPI):
+    """Асинхронный клиент LocTracker API с теми же методами, что и LocTrackerAPI
+    
+    Кэш, метрики, разбор ответов и методы get_* общие с LocTrackerAPI; здесь только
+    транспорт - httpx.AsyncClient, поэтому методы get_* возвращают корутины.
+    """
+    
+    def __init__(self, username: Optional[str] = None, password: Optional[str] = None,
+                 base_url: Optional[str] = None):
+        self._configure(username, password, base_url)
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(LOCTRACKER_READ_TIMEOUT, connect=LOCTRACKER_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=LOCTRACKER_POOL_SIZE, max_keepalive_connections=LOCTRACKER_POOL_SIZE),
+            headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'},
+        )
+        
+        logger.info(f"Подключение к LocTracker API (async) для пользователя: {self.username}")
+    
+    async def _run(self, steps) -> Any:
+        """Выполнить шаги запроса через httpx.AsyncClient"""
+        return await _drive_async(steps, self._send)
+        
+    async def _send(self, url: str, query: Dict) -> bytes:
+        """Один GET-запрос, возвращает тело ответа"""
+        response = await self.client.get(url, params=query)
+        response.raise_for_status()
+        return response.content
+    
+    async def close(self):
+        """Закрыть пул соединений"""
+        await self.client.aclose()
+    
+class AsyncDispatcherNotionSync(DispatcherNotionSync):
+    """Синхронизация с Notion на notion_client.AsyncClient
+    
+    Индекс страниц, отправка только изменений, подготовка свойств и сами шаги записи
+    берутся из DispatcherNotionSync; асинхронными становятся только сетевые вызовы.
+    """
+    
+    def __init__(self, database_id: Optional[str] = None, api_key: Optional[str] = None,
+                 state_file: Optional[str] = NOTION_STATE_FILE):
+        self._configure(database_id, api_key, state_file)
+        self.client = AsyncClient(auth=self.api_key, base_url=NOTION_BASE_URL)
+        self.rate_limiter = AsyncRateLimiter(NOTION_RATE_LIMIT)
+        self._index_load_lock = asyncio.Lock()
+        
+        logger.info(f"Подключение к Notion Database (async): {self.database_id}")
+    
+    async def close(self):
+        await self.client.aclose()
+    
+    async def _call(self, method, **kwargs) -> Any:
+        """Вызвать метод Notion через общий лимитер с повторами при 429, 5xx и таймаутах"""
+        name = self._method_name(method)
+        idempotent = name not in NOTION_NON_IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire()
+            started = time.perf_counter()
+            try:
+                result = await method(**kwargs)
+            except (HTTPResponseError, RequestTimeoutError, httpx.TransportError) as e:
+                self._observe_call(name, started, e)
+                delay = self._retry_delay(e, attempt, idempotent)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                self._observe_call(name, started)
+                return result
+    
+    async def _run(self, steps) -> Any:
+        """Выполнить шаги через await"""
+        return await _drive_async(steps, self._perform)
+    
+    async def _perform(self, kind: str, *args) -> Any:
+        """Один шаг (см. DispatcherNotionSync._perform)"""
+        if kind == 'call':
+            method, kwargs = args
+            return await self._call(method, **kwargs)
+        if kind == 'sleep':
+            await asyncio.sleep(*args)
+            return None
+        async with self._index_load_lock:
+            if self._index_synced_at is None:
+                await self.refresh_page_index()
+
+async def _fetch_device_extras(loctracker: AsyncLocTrackerAPI, device_number: str,
+                               fleet_tasks: Optional[List[Dict]]) -> Dict[str, Any]:
+    """Получить задачи, отчет и топливо для одного устройства одновременно"""
+    async def tasks_or_fleet():
+        # Сначала задачи из fleet state, иначе из API
+        if fleet_tasks:
+            return fleet_tasks
+        return await loctracker.get_device_tasks(device_number)
+    
+    tasks, report, fuel = await asyncio.gather(
+        tasks_or_fleet(),
+        loctracker.get_device_report(device_number),
+        loctracker.get_fuel_data(device_number),
+    )
+    return {'tasks': tasks, 'report': report, 'fuel': fuel}
+
+async def async_sync_dispatcher_data(loctracker: Optional[AsyncLocTrackerAPI] = None,
+                                     notion: Optional[AsyncDispatcherNotionSync] = None,
+                                     store: Optional[SnapshotStore] = None,
+                                     history: Optional[PositionHistory] = None,
+                                     gate: Optional[ChangeGate] = None,
+                                     activity_stream: Optional[ActivityStream] = None,
+                                     geofence: Optional[GeofenceTracker] = None,
+                                     states: Optional[VehicleStates] = None) -> Optional[Dict[str, Any]]:
+    """Асинхронный проход синхронизации (аналог sync_dispatcher_data)"""
+    logger.info("="*50)
+    logger.info("🚀 Начало асинхронной синхронизации данных диспетчера")
+    started_at = time.monotonic()
+    
+    owns_loctracker = loctracker is None
+    if owns_loctracker:
+        loctracker = AsyncLocTrackerAPI()
+    owns_notion = notion is None
+    if owns_notion:
+        notion = AsyncDispatcherNotionSync()
+    owns_store = store is None and bool(SNAPSHOT_DB_FILE)
+    if owns_store:
+        store = await asyncio.to_thread(SnapshotStore, SNAPSHOT_DB_FILE)
+    skipped_before = notion.skipped_writes
+    pass_started_at = time.time()
+    
+    try:
+        # Все общие запросы и загрузка индекса Notion - одновременно
+        async def refresh_index():
+            try:
+                if store:
+                    # Прогрев из снимка - только если он покрывает текущий автопарк
+                    pages, synced_at = await asyncio.to_thread(store.load_page_index, notion.database_id)
+                    notion.seed_page_index(pages, synced_at, _roster(await devices_task))
+                await notion.refresh_page_index()
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке индекса страниц: {e}")
+        
+        async def poll_activities() -> List[Dict]:
+            return await activity_stream.poll_async() if activity_stream else []
+        
+        if activity_stream is None and ACTIVITY_STREAM_ENABLED:
+            activity_stream = await asyncio.to_thread(ActivityStream, loctracker)
+        fetch_started = time.perf_counter()
+        devices_task = asyncio.ensure_future(loctracker.get_devices())
+        devices, positions, tachographs, fleet_state, activities, _ = await asyncio.gather(
+            devices_task,
+            loctracker.get_positions(),
+            loctracker.get_tachograph_state(),
+            loctracker.get_fleet_state(),
+            poll_activities(),
+            refresh_index(),
+        )
+        METRICS.observe_stage('fetch_fleet', time.perf_counter() - fetch_started)
+        if not devices:
+            logger.error("Не удалось получить список устройств")
+            return None
+        if not positions:
+            logger.error("Не удалось получить позиции")
+            return None
+        
+        if history is None and POSITION_HISTORY_DIR:
+            history = PositionHistory(POSITION_HISTORY_DIR)
+        await asyncio.to_thread(_record_positions, history, positions, pass_started_at)
+        
+        fleet_tasks_dict = _build_fleet_tasks_dict(fleet_state)
+        positions_dict = {p['deviceNumber']: p for p in positions}
+        tacho_dict = {t['deviceNumber']: t for t in (tachographs or []) if 'deviceNumber' in t}
+        activities_dict = latest_by_device(activities)
+        # Прибытия к задачам - по геозонам для всего автопарка, без запросов по ТС
+        if geofence is None and GEOFENCE_ENABLED:
+            geofence = await asyncio.to_thread(GeofenceTracker)
+        arrivals_dict = await asyncio.to_thread(_detect_arrivals, geofence, positions, fleet_tasks_dict)
+        
+        vehicles = [d for d in devices if d.get('registrationNumber', '').strip()]
+        if states is not None:
+            states.prune(vehicles)
+        # Запросы по ТС и запись - только для изменившихся (или давно не обновлявшихся) ТС
+        if gate is None and CHANGE_GATE_ENABLED:
+            gate = await asyncio.to_thread(ChangeGate)
+        vehicles, gated_count = _gate_vehicles(gate, vehicles, positions_dict, tacho_dict,
+                                               fleet_tasks_dict, activities_dict, arrivals_dict)
+        if activity_stream:
+            # Активности устройств без записи в этом проходе не держат курсор
+            activity_stream.ack_others(device.get('number') for device in vehicles)
+        # Срочные ТС (скоро пауза по тахографу) - отдельным первым ярусом
+        plan = None
+        if SYNC_ORDER == 'priority':
+            plan = _plan_priority(notion, vehicles, positions_dict, tacho_dict, fleet_tasks_dict)
+        tiers = plan.tiers if plan else [vehicles]
+        loctracker_semaphore = asyncio.Semaphore(ASYNC_LOCTRACKER_CONCURRENCY)
+        notion_semaphore = asyncio.Semaphore(ASYNC_NOTION_CONCURRENCY)
+        
+        async def enrich(device: Dict) -> Optional[Dict]:
+            device_number = device.get('number')
+            try:
+                async with loctracker_semaphore:
+                    with METRICS.stage('fetch_device'):
+                        extras = await _fetch_device_extras(loctracker, device_number,
+                                                            fleet_tasks_dict.get(device_number))
+                with METRICS.stage('merge'):
+                    return _merge_device_data(device, positions_dict.get(device_number),
+                                              tacho_dict.get(device_number), extras,
+                                              activities_dict.get(str(device_number)),
+                                              arrivals_dict.get(str(device_number)),
+                                              states.acquire(device_number) if states is not None else None)
+            except Exception as e:
+                logger.error(f"Ошибка обработки устройства {device_number}: {e}")
+                return None
+        
+        async def write(combined_data: Optional[Dict], properties: Optional[Dict]) -> bool:
+            if combined_data is None:
+                return False
+            async with notion_semaphore:
+                with METRICS.stage('notion_write'):
+                    success = await notion.update_or_create_entry(combined_data, properties)
+            if gate and success:
+                gate.mark_synced(combined_data)
+            if plan and success:
+                plan.observe_write(combined_data, time.monotonic() - started_at)
+            if activity_stream and success:
+                activity_stream.ack(combined_data.get('number'),
+                                    (activities_dict.get(str(combined_data.get('number'))) or {}).get('id'))
+            return success
+        
+        # gather сохраняет порядок яруса
+        logger.info(f"⚙️ Одновременно: LocTracker {ASYNC_LOCTRACKER_CONCURRENCY}, "
+                    f"Notion {ASYNC_NOTION_CONCURRENCY}, устройств: {len(vehicles)}")
+        records, results = [], []
+        for tier in tiers:
+            tier_records = await asyncio.gather(*(enrich(device) for device in tier))
+        
+            # Расстояния и ETA до всех задач - одним векторным расчетом по ярусу
+            valid_records = [r for r in tier_records if r is not None]
+            with METRICS.stage('distances'):
+                apply_task_distances(valid_records)
+            payloads = _prepare_payloads(notion, tier_records, valid_records)
+        
+            results.extend(await asyncio.gather(*(write(record, properties)
+                                                  for record, properties in zip(tier_records, payloads))))
+            records.extend(tier_records)
+        vehicles = [device for tier in tiers for device in tier]
+        # Запись файлов состояния и снимка - в потоке, чтобы не блокировать цикл событий
+        if activity_stream:
+            # Курсор сдвигаем только до активностей, уже записанных в Notion
+            await asyncio.to_thread(activity_stream.commit)
+        if gate:
+            await asyncio.to_thread(gate.save)
+        if geofence:
+            await asyncio.to_thread(geofence.learn_tasks, records)
+            await asyncio.to_thread(geofence.save)
+        
+        processed_count = sum(1 for success in results if success)
+        error_count = len(results) - processed_count
+        
+        # Снимок состояния автопарка и ID страниц
+        if store:
+            try:
+                saved = [r for r in records if r is not None]
+                page_ids = {str(r.get('number')): notion.page_id_for(r) for r in saved}
+                with METRICS.stage('snapshot'):
+                    await asyncio.to_thread(store.save_pass, saved, {k: v for k, v in page_ids.items() if v},
+                                            pass_started_at, processed_count, error_count, notion.database_id)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения снимка: {e}")
+    finally:
+        await asyncio.to_thread(notion.save_state)
+        loctracker.cache.purge()
+        if owns_loctracker:
+            await loctracker.close()
+        if owns_notion:
+            await notion.close()
+        if owns_store:
+            await asyncio.to_thread(store.close)
+    
+    for device, success in zip(vehicles, results):
+        if not success:
+            logger.error(f"❌ Ошибка обработки: {device.get('registrationNumber', '').strip()}")
+    
+    skipped_count = notion.skipped_writes - skipped_before
+    duration = time.monotonic() - started_at
+    logger.info("="*50)
+    logger.info(f"✅ Синхронизация завершена!")
+    logger.info(f"📊 Обработано: {processed_count}")
+    logger.info(f"❌ Ошибок: {error_count}")
+    logger.info(f"⏭️ Без изменений (запись пропущена): {skipped_count}")
+    logger.info(f"💤 Без изменений (не запрашивались): {gated_count}")
+    logger.info(f"⏱️ Длительность прохода: {duration:.1f} с")
+    record_pass(duration, processed_count, error_count, skipped_count, gated_count)
+    if plan:
+        plan.report()
+    logger.info(f"🔗 База данных: https://www.notion.so/{notion.database_id.replace('-', '')}")
+    logger.info("="*50)
+    
+    return {
+        'processed': processed_count,
+        'errors': error_count,
+        'skipped': skipped_count,
+        'gated': gated_count,
+        'duration': duration,
+    }
+
+def main():
+    """Главная функция"""
+    try:
+        asyncio.run(async_sync_dispatcher_data())
+    except Exception as e:
+        logger.error(f"Критическая ошибка: {e}")
+        raise
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,28 @@
 #!/usr/bin/env python3
 """
 Автоматическая синхронизация LocTracker -> Notion
-Обновляет данные каждую минуту
+Обновляет данные каждую минуту в одном резидентном процессе (см. sync_daemon.py)
 """
 
-import time
 import logging
-from loctracker_to_notion import LocTrackerNotionSync
+from sync_daemon import SyncDaemon
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(message)s',
-    handlers=[
-        logging.FileHandler('auto_sync.log'),
-        logging.StreamHandler()
-    ]
-)
+# Дополнительно пишем лог в файл
+file_handler = logging.FileHandler('auto_sync.log')
+file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+logging.getLogger().addHandler(file_handler)
 logger = logging.getLogger(__name__)
 
 def main():
     """Главная функция автоматической синхронизации"""
-    sync = LocTrackerNotionSync()
+    daemon = SyncDaemon()
+    daemon.install_signal_handlers()
     
     logger.info("🚀 Запуск автоматической синхронизации LocTracker -> Notion")
-    logger.info("📊 Данные будут обновляться каждую минуту")
-    logger.info("⏹️  Для остановки нажмите Ctrl+C")
+    logger.info(f"📊 Данные будут обновляться каждые {daemon.interval:.0f} секунд")
+    logger.info("⏹️  Для остановки нажмите Ctrl+C или отправьте SIGTERM")
     
-    while True:
-        try:
-            # Выполняем синхронизацию
-            sync.sync_data()
-            
-            # Ждем минуту перед следующим обновлением
-            logger.info("⏰ Следующее обновление через 60 секунд...")
-            time.sleep(60)
-            
-        except KeyboardInterrupt:
-            logger.info("\n⏹️  Синхронизация остановлена пользователем")
-            break
-        except Exception as e:
-            logger.error(f"❌ Ошибка синхронизации: {e}")
-            logger.info("🔄 Повторная попытка через 60 секунд...")
-            time.sleep(60)
+    daemon.run()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
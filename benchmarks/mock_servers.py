@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Локальные заглушки LocTracker REST API и Notion API для бенчмарков
+Настраиваются задержка, доля ошибок и доля ответов 429; каждый сервер считает
+запросы и время обработки по эндпоинтам
+"""
+
+import re
+import json
+import time
+import uuid
+import random
+import socket
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+class MockConfig:
+    """Поведение заглушки: задержка ответа, ошибки 5xx и ответы 429"""
+    
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0,
+                 rate_limit_rate: float = 0, retry_after: float = 1, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+    
+    def draw(self) -> Tuple[float, Optional[int]]:
+        """Задержка в секундах и код принудительной ошибки (None - обычный ответ)"""
+        with self.lock:
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return delay, 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return delay, 503
+        return delay, None
+
+class EndpointStats:
+    """Число запросов, коды ответов и время обработки по эндпоинтам"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Dict[int, int]] = {}
+    
+    def record(self, endpoint: str, status: int, duration: float):
+        with self.lock:
+            self.durations.setdefault(endpoint, []).append(duration)
+            codes = self.statuses.setdefault(endpoint, {})
+            codes[status] = codes.get(status, 0) + 1
+    
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """По эндпоинтам: запросы, коды ответов, p50/p95 в мс"""
+        with self.lock:
+            result = {}
+            for endpoint, durations in sorted(self.durations.items()):
+                ordered = sorted(durations)
+                result[endpoint] = {
+                    'requests': len(ordered),
+                    'statuses': dict(self.statuses[endpoint]),
+                    'p50_ms': _percentile(ordered, 50) * 1000,
+                    'p95_ms': _percentile(ordered, 95) * 1000,
+                }
+            return result
+
+def _percentile(ordered: List[float], percent: float) -> float:
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+class FleetData:
+    """Синтетический автопарк в форматах ответов LocTracker"""
+    
+    def __init__(self, size: int, seed: int = 1):
+        rng = random.Random(seed)
+        now_ms = int(time.time() * 1000)
+        self.devices = []
+        self.positions = []
+        self.tachographs = []
+        self.fleet_devices = []
+        self.tasks: Dict[str, List[Dict]] = {}
+        self.activities = []
+        
+        for i in range(size):
+            number = str(100000 + i)
+            lat, lng = 54.0 + rng.uniform(-2, 2), 25.0 + rng.uniform(-2, 2)
+            self.devices.append({'id': i + 1, 'number': number, 'registrationNumber': f"BM-{i:05d}"})
+            self.positions.append({
+                'deviceNumber': number, 'lat': lat, 'lng': lng,
+                'speed': rng.choice([0, 0, 42, 78, 85]),
+                'ignitionState': rng.choice(['ON', 'OFF']),
+                'address': f"Benchmark str. {i}",
+                'time': now_ms - rng.randint(0, 600) * 1000,
+            })
+            self.tachographs.append({
+                'deviceNumber': number,
+                'driveTimeCurrentDay': {'durationRemaining': rng.randint(0, 9 * 3600)},
+                'driveTimeSinceRest': {'durationRemaining': rng.randint(0, 4 * 3600)},
+                'driveTimeCurrentWeek': {'durationRemaining': rng.randint(0, 56 * 3600)},
+                'status': rng.randint(0, 3),
+                'workPeriodStart': now_ms - rng.randint(0, 10 * 3600) * 1000,
+                'workPeriodExpectedEnd': now_ms + rng.randint(0, 10 * 3600) * 1000,
+                'driverNameFull': f"Driver {i}",
+            })
+            tasks = [
+                {
+                    'taskId': i * 10 + t,
+                    'status': 'COMPLETED' if t == 0 else 'PENDING',
+                    'locationAddress': f"Stop {i}-{t}",
+                    'latitude': lat + rng.uniform(-1, 1),
+                    'longitude': lng + rng.uniform(-1, 1),
+                    'plannedArrival': now_ms + t * 3600 * 1000,
+                }
+                for t in range(3)
+            ]
+            # Половина задач приходит в fleet/state, остальные - через tasks/{device}/trip
+            if i % 2 == 0:
+                self.fleet_devices.append({'device': {'number': number}, 'tasks': tasks})
+            else:
+                self.tasks[number] = tasks
+            self.activities.append({
+                'id': i + 1, 'deviceNumber': number, 'type': 'MESSAGE',
+                'time': now_ms, 'message': f"Message {i}",
+            })
+        self.random = rng
+    
+    def move(self, share: float):
+        """Сдвинуть случайную долю ТС (остальные стоят на месте)"""
+        for position in self.random.sample(self.positions, int(len(self.positions) * share)):
+            position['lat'] += self.random.uniform(0.001, 0.01)
+            position['speed'] = self.random.choice([42, 78, 85])
+
+class _MockServer:
+    """HTTP-сервер заглушки в фоновом потоке"""
+    
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.stats = EndpointStats()
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.thread: Optional[threading.Thread] = None
+    
+    def start(self) -> '_MockServer':
+        mock = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def setup(self):
+                super().setup()
+                # Заголовки и тело уходят отдельными пакетами: без TCP_NODELAY keep-alive ждет delayed ACK
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            
+            def _handle(self):
+                started = time.perf_counter()
+                endpoint, status, body, headers = mock.respond(self)
+                if body is None:
+                    body = {}
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+                mock.stats.record(endpoint, status, time.perf_counter() - started)
+            
+            do_GET = do_POST = do_PATCH = _handle
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+    
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+    
+    def inject(self, endpoint: str) -> Optional[Tuple[str, int, Dict, Dict]]:
+        """Задержка и принудительная ошибка по настройкам; ответ с ошибкой или None"""
+        delay, forced = self.config.draw()
+        if delay:
+            time.sleep(delay)
+        if forced == 429:
+            return endpoint, 429, self.error_body(429, 'rate_limited'), {'Retry-After': str(self.config.retry_after)}
+        if forced:
+            return endpoint, forced, self.error_body(forced, 'service_unavailable'), {}
+        return None
+    
+    def error_body(self, status: int, code: str) -> Dict:
+        return {'error': code}
+    
+    def respond(self, handler: BaseHTTPRequestHandler) -> Tuple[str, int, Any, Dict]:
+        raise NotImplementedError
+
+class MockLocTracker(_MockServer):
+    """Заглушка LocTracker REST API (.../REST/v1/<user>/<endpoint>)"""
+    
+    ROUTES = [
+        (re.compile(r'^devices$'), 'devices'),
+        (re.compile(r'^positions$'), 'positions'),
+        (re.compile(r'^tachographs/state$'), 'tachographs/state'),
+        (re.compile(r'^fleet/state$'), 'fleet/state'),
+        (re.compile(r'^tasks/(?P<device>[^/]+)/trip$'), 'tasks/{device}/trip'),
+        (re.compile(r'^tasks/(?P<device>[^/]+)/active$'), 'tasks/{device}/active'),
+        (re.compile(r'^reports/vehicle$'), 'reports/vehicle'),
+        (re.compile(r'^activities$'), 'activities'),
+        (re.compile(r'^activities/(?P<device>[^/]+)$'), 'activities/{device}'),
+        (re.compile(r'^fuel/(?P<device>[^/]+)$'), 'fuel/{device}'),
+    ]
+    
+    def __init__(self, fleet: FleetData, config: Optional[MockConfig] = None, password: str = 'benchmark',
+                 churn: float = 0.0):
+        super().__init__(config or MockConfig())
+        self.fleet = fleet
+        self.password = password
+        # Доля ТС, сдвигающихся перед каждым ответом positions
+        self.churn = churn
+    
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/REST/v1"
+    
+    def respond(self, handler):
+        parsed = urlparse(handler.path)
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        # /REST/v1/<user>/<endpoint...>
+        parts = parsed.path.strip('/').split('/', 3)
+        path = parts[3] if len(parts) == 4 else ''
+        
+        for pattern, endpoint in self.ROUTES:
+            match = pattern.match(path)
+            if match:
+                break
+        else:
+            return 'unknown', 404, {'error': 'not_found'}, {}
+        
+        if query.get('password') != self.password:
+            return endpoint, 401, {'error': 'unauthorized'}, {}
+        failure = self.inject(endpoint)
+        if failure:
+            return failure
+        
+        device = match.groupdict().get('device')
+        fleet = self.fleet
+        if endpoint == 'devices':
+            body = {'devices': fleet.devices}
+        elif endpoint == 'positions':
+            if self.churn:
+                fleet.move(self.churn)
+            body = {'positions': fleet.positions}
+        elif endpoint == 'tachographs/state':
+            body = {'tachographsState': fleet.tachographs}
+        elif endpoint == 'fleet/state':
+            body = {'devices': fleet.fleet_devices}
+        elif endpoint == 'tasks/{device}/trip':
+            body = {'tasks': fleet.tasks.get(device, [])}
+        elif endpoint == 'tasks/{device}/active':
+            tasks = fleet.tasks.get(device) or [{}]
+            body = {'task': tasks[0]}
+        elif endpoint == 'reports/vehicle':
+            body = {'deviceNumber': query.get('deviceNumber'), 'totalDistance': 321.5, 'fuelTankCapacity': 600}
+        elif endpoint == 'activities':
+            latest = int(query.get('latestRecordId', -1))
+            body = {'activities': [a for a in fleet.activities if a['id'] > latest]}
+        elif endpoint == 'activities/{device}':
+            body = {'activities': [a for a in fleet.activities if a['deviceNumber'] == device]}
+        else:
+            body = {'currentLevel': 55.0, 'tankCapacity': 600}
+        return endpoint, 200, body, {}
+
+class MockNotion(_MockServer):
+    """Заглушка Notion API: запрос к базе, создание и обновление страниц"""
+    
+    QUERY = re.compile(r'^/v1/databases/(?P<database>[^/]+)/query$')
+    PAGE = re.compile(r'^/v1/pages/(?P<page>[^/]+)$')
+    
+    def __init__(self, config: Optional[MockConfig] = None):
+        super().__init__(config or MockConfig())
+        self.pages: Dict[str, Dict] = {}
+        self.pages_lock = threading.Lock()
+    
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+    
+    def error_body(self, status: int, code: str) -> Dict:
+        return {'object': 'error', 'status': status, 'code': code, 'message': f"Mock {code}"}
+    
+    def respond(self, handler):
+        path = urlparse(handler.path).path
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = json.loads(handler.rfile.read(length) or b'{}') if length else {}
+        
+        if handler.command == 'POST' and self.QUERY.match(path):
+            endpoint = 'databases.query'
+        elif handler.command == 'POST' and path == '/v1/pages':
+            endpoint = 'pages.create'
+        elif handler.command == 'PATCH' and self.PAGE.match(path):
+            endpoint = 'pages.update'
+        else:
+            return 'unknown', 404, self.error_body(404, 'object_not_found'), {}
+        
+        failure = self.inject(endpoint)
+        if failure:
+            return failure
+        
+        if endpoint == 'databases.query':
+            return endpoint, 200, self._query(self.QUERY.match(path).group('database'), body), {}
+        if endpoint == 'pages.create':
+            page_id = str(uuid.uuid4())
+            page = {'object': 'page', 'id': page_id, 'archived': False, 'in_trash': False,
+                    'parent': body.get('parent'), 'properties': {}}
+            with self.pages_lock:
+                self.pages[page_id] = page
+                return endpoint, 200, self._update(page, body.get('properties', {})), {}
+        
+        page_id = self.PAGE.match(path).group('page')
+        with self.pages_lock:
+            page = self.pages.get(page_id)
+            if page is None:
+                return endpoint, 404, self.error_body(404, 'object_not_found'), {}
+            return endpoint, 200, self._update(page, body.get('properties', {})), {}
+    
+    @staticmethod
+    def _update(page: Dict, properties: Dict) -> Dict:
+        """Применить свойства к странице (с plain_text, как в ответах Notion)"""
+        for name, value in properties.items():
+            value = json.loads(json.dumps(value))
+            for key in ('title', 'rich_text'):
+                for item in value.get(key, []):
+                    item['plain_text'] = item.get('text', {}).get('content', '')
+            page['properties'][name] = value
+        page['last_edited_time'] = datetime.now(timezone.utc).isoformat()
+        return json.loads(json.dumps(page))
+    
+    def _query(self, database: str, body: Dict) -> Dict:
+        """Постраничный запрос к базе с фильтром по last_edited_time"""
+        since = (body.get('filter') or {}).get('last_edited_time', {}).get('on_or_after')
+        with self.pages_lock:
+            pages = [p for p in self.pages.values() if (p.get('parent') or {}).get('database_id') == database]
+            if since:
+                since_at = datetime.fromisoformat(since)
+                pages = [p for p in pages if datetime.fromisoformat(p['last_edited_time']) >= since_at]
+            start = int(body.get('start_cursor') or 0)
+            size = int(body.get('page_size') or 100)
+            chunk = json.loads(json.dumps(pages[start:start + size]))
+        has_more = start + size < len(pages)
+        return {'object': 'list', 'results': chunk, 'has_more': has_more,
+                'next_cursor': str(start + size) if has_more else None}
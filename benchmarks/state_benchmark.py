@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк объединения данных ТС: новая запись на каждый проход против VehicleState на месте
+Запуск: python benchmarks/state_benchmark.py --vehicles 5000 --passes 20
+Сеть не нужна - ответы LocTracker синтетические (mock_servers.FleetData); печатает время
+объединения, размер записи и память резидентного процесса по проходам (tracemalloc)
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('NOTION_API_KEY', 'benchmark')
+os.environ['NOTION_STATE_FILE'] = ''
+
+from mock_servers import FleetData
+from sync_dispatcher_data import _merge_device_data
+from vehicle_state import VehicleStates
+
+def make_inputs(fleet: FleetData) -> list:
+    """Аргументы объединения по ТС: устройство, позиция, тахограф, доп. данные, активность"""
+    positions = {p['deviceNumber']: p for p in fleet.positions}
+    tachographs = {t['deviceNumber']: t for t in fleet.tachographs}
+    tasks = {f['device']['number']: f['tasks'] for f in fleet.fleet_devices}
+    tasks.update(fleet.tasks)
+    activities = {a['deviceNumber']: a for a in fleet.activities}
+    inputs = []
+    for device in fleet.devices:
+        number = device['number']
+        extras = {'tasks': tasks.get(number), 'report': {'totalDistance': 120.5},
+                  'fuel': {'currentLevel': 64.0, 'tankCapacity': 600}}
+        inputs.append((device, positions.get(number), tachographs.get(number), extras, activities.get(number)))
+    return inputs
+
+def merge_pass(inputs: list, states) -> list:
+    """Один проход объединения; с states записи заполняются на месте"""
+    return [
+        _merge_device_data(device, position, tacho, extras, activity, None,
+                           states.acquire(device['number']) if states is not None else None)
+        for device, position, tacho, extras, activity in inputs
+    ]
+
+def best_of(repeat: int, func) -> float:
+    """Лучшее время из нескольких запусков, секунды"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def resident_memory(fleet: FleetData, inputs: list, passes: int, states) -> tuple:
+    """Проходы как в демоне (записи прошлого прохода живы до следующего); память после каждого, КБ"""
+    tracemalloc.start()
+    records = None
+    after_pass = []
+    peak = 0
+    for _ in range(passes):
+        fleet.move(0.1)
+        tracemalloc.reset_peak()
+        records = merge_pass(inputs, states)
+        current, pass_peak = tracemalloc.get_traced_memory()
+        after_pass.append(current / 1024)
+        peak = max(peak, pass_peak / 1024)
+    tracemalloc.stop()
+    del records
+    return after_pass, peak
+
+def record_size(record) -> int:
+    """Байты одной записи: сам объект и словарь прочих ключей"""
+    size = sys.getsizeof(record)
+    extra = getattr(record, 'extra', None)
+    return size + (sys.getsizeof(extra) if extra is not None else 0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--vehicles', type=int, default=5000)
+    parser.add_argument('--passes', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    
+    logging.disable(logging.INFO)
+    fleet = FleetData(args.vehicles)
+    inputs = make_inputs(fleet)
+    states = VehicleStates()
+    merge_pass(inputs, states)
+    
+    fresh = best_of(args.repeat, lambda: merge_pass(inputs, None))
+    reused = best_of(args.repeat, lambda: merge_pass(inputs, states))
+    
+    sample = merge_pass(inputs[:1], states)[0]
+    print(f"ТС: {args.vehicles}, полей в записи: {len(sample)}")
+    print(f"запись: словарь {sys.getsizeof(sample.to_dict())} Б, VehicleState {record_size(sample)} Б")
+    print(f"новые записи:    {fresh * 1000:8.1f} мс, {fresh / args.vehicles * 1e6:6.2f} мкс/ТС, "
+          f"{args.vehicles / fresh:9.0f} ТС/с")
+    print(f"запись на месте: {reused * 1000:8.1f} мс, {reused / args.vehicles * 1e6:6.2f} мкс/ТС, "
+          f"{args.vehicles / reused:9.0f} ТС/с")
+    
+    for name, pool in (('новые записи', None), ('запись на месте', VehicleStates())):
+        after_pass, peak = resident_memory(fleet, inputs, args.passes, pool)
+        print(f"{name}: память после 1-го прохода {after_pass[0]:8.0f} КБ, после {args.passes}-го "
+              f"{after_pass[-1]:8.0f} КБ, пик прохода {peak:8.0f} КБ")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк прохода синхронизации на локальных заглушках LocTracker и Notion
+Запускает настоящий sync_dispatcher_data (или async_sync_dispatcher_data) против mock_servers
+и печатает время прохода, запросы и p50/p95 по эндпоинтам и пиковую память.
+
+Пример:
+    python benchmarks/sync_benchmark.py --vehicles 10 100 1000 --latency-ms 40 --notion-latency-ms 120
+    python benchmarks/sync_benchmark.py --vehicles 500 --error-rate 0.02 --rate-limit-rate 0.01 --json result.json
+
+Файлы состояния (снимок SQLite, очередь Notion, история позиций, геозоны, отпечатки, индекс
+страниц) по умолчанию пишутся во временный каталог - как в настройках по умолчанию;
+--stateless отключает их и измеряет проход без локального состояния.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import tempfile
+import multiprocessing
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_servers import FleetData, MockConfig, MockLocTracker, MockNotion
+
+def _run_passes(settings: Dict[str, Any], results):
+    """Дочерний процесс: настроить окружение, выполнить проходы и вернуть метрики"""
+    # Состояние живет между проходами, но не между запусками
+    state_dir = tempfile.mkdtemp(prefix='sync-benchmark-')
+    state_files = {
+        'NOTION_STATE_FILE': 'notion_state.json',
+        'SNAPSHOT_DB_FILE': 'fleet_snapshot.db',
+        'POSITION_HISTORY_DIR': 'position_history',
+        'CHANGE_GATE_FILE': 'change_gate.json',
+        'GEOFENCE_FILE': 'geofence_state.json',
+        'NOTION_OUTBOX_FILE': 'notion_outbox.db',
+    }
+    os.environ.update({
+        'VITE_LOCTRACKER_API_URL': settings['loctracker_url'],
+        'VITE_LOCTRACKER_USERNAME': 'benchmark',
+        'VITE_LOCTRACKER_PASSWORD': 'benchmark',
+        'NOTION_BASE_URL': settings['notion_url'],
+        'NOTION_API_KEY': 'benchmark',
+        'NOTION_RATE_LIMIT': str(settings['notion_rate']),
+        'SYNC_WORKERS': str(settings['workers']),
+        'ACTIVITY_CHECKPOINT_FILE': os.path.join(state_dir, 'activity_cursor.json'),
+        # Пустое значение отключает файл состояния
+        **{name: '' if settings['stateless'] else os.path.join(state_dir, file_name)
+           for name, file_name in state_files.items()},
+    })
+    sys.path.insert(0, ROOT)
+    
+    import logging
+    import resource
+    import tracemalloc
+    
+    if settings['tracemalloc']:
+        tracemalloc.start()
+    
+    if settings['mode'] == 'async':
+        import asyncio
+        from async_sync import AsyncDispatcherNotionSync, AsyncLocTrackerAPI, async_sync_dispatcher_data
+    else:
+        from sync_dispatcher_data import DispatcherNotionSync, LocTrackerAPI, sync_dispatcher_data
+        from stream_sync import stream_sync_dispatcher_data
+        run_pass = stream_sync_dispatcher_data if settings['mode'] == 'stream' else sync_dispatcher_data
+    from change_gate import CHANGE_GATE_ENABLED, ChangeGate
+    from vehicle_state import VehicleStates
+    logging.disable(logging.WARNING if settings['quiet'] else logging.NOTSET)
+    # Отпечатки и записи ТС живут между проходами в памяти, как в демоне
+    gate = ChangeGate() if CHANGE_GATE_ENABLED else None
+    states = VehicleStates()
+    
+    passes = []
+    if settings['mode'] == 'async':
+        async def run_all():
+            loctracker, notion = AsyncLocTrackerAPI(), AsyncDispatcherNotionSync()
+            try:
+                for _ in range(settings['passes']):
+                    started = time.perf_counter()
+                    summary = await async_sync_dispatcher_data(loctracker=loctracker, notion=notion, gate=gate,
+                                                               states=states)
+                    passes.append({'wall_s': time.perf_counter() - started, 'summary': summary})
+            finally:
+                await loctracker.close()
+                await notion.close()
+        asyncio.run(run_all())
+    else:
+        loctracker, notion = LocTrackerAPI(), DispatcherNotionSync()
+        try:
+            for _ in range(settings['passes']):
+                started = time.perf_counter()
+                summary = run_pass(loctracker=loctracker, notion=notion, gate=gate, states=states)
+                passes.append({'wall_s': time.perf_counter() - started, 'summary': summary})
+        finally:
+            loctracker.close()
+    
+    shutil.rmtree(state_dir, ignore_errors=True)
+    
+    memory = {'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if settings['tracemalloc']:
+        memory['python_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    results.put({'passes': passes, 'memory': memory})
+
+def run_scenario(vehicles: int, args) -> Dict[str, Any]:
+    """Один размер автопарка: свежие заглушки и отдельный процесс синхронизации"""
+    loctracker = MockLocTracker(
+        FleetData(vehicles, seed=args.seed),
+        MockConfig(args.latency_ms, args.jitter_ms, args.error_rate, 0, seed=args.seed),
+        churn=args.churn,
+    ).start()
+    notion = MockNotion(
+        MockConfig(args.notion_latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate,
+                   args.retry_after, seed=args.seed + 1),
+    ).start()
+    
+    settings = {
+        'loctracker_url': loctracker.url,
+        'notion_url': notion.url,
+        'notion_rate': args.notion_rate,
+        'workers': args.workers,
+        'mode': args.mode,
+        'passes': args.passes,
+        'tracemalloc': args.tracemalloc,
+        'stateless': args.stateless,
+        'quiet': not args.verbose,
+    }
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run_passes, args=(settings, results))
+    try:
+        process.start()
+        outcome = results.get()
+        process.join()
+    finally:
+        loctracker.stop()
+        notion.stop()
+    
+    return {
+        'vehicles': vehicles,
+        'mode': args.mode,
+        'stateless': args.stateless,
+        **outcome,
+        'loctracker': loctracker.stats.summary(),
+        'notion': notion.stats.summary(),
+    }
+
+def print_report(result: Dict[str, Any]):
+    """Человекочитаемый отчет по сценарию"""
+    state = 'без файлов состояния' if result.get('stateless') else 'с файлами состояния'
+    print(f"\n=== {result['vehicles']} ТС ({result['mode']}, {state}) ===")
+    for number, run in enumerate(result['passes'], 1):
+        summary = run['summary']
+        if summary is None:
+            print(f"проход {number}: {run['wall_s']:.2f} с, прерван (нет устройств или позиций)")
+            continue
+        print(f"проход {number}: {run['wall_s']:.2f} с, обработано {summary['processed']}, "
+              f"ошибок {summary['errors']}, без изменений {summary['skipped']}, "
+              f"не запрашивались {summary.get('gated', 0)}")
+    memory = result['memory']
+    line = f"память: пик RSS {memory['max_rss_mb']:.1f} МБ"
+    if 'python_peak_mb' in memory:
+        line += f", пик Python-аллокаций {memory['python_peak_mb']:.1f} МБ"
+    print(line)
+    print(f"{'эндпоинт':<28}{'запросов':>10}{'p50, мс':>10}{'p95, мс':>10}  коды")
+    for service in ('loctracker', 'notion'):
+        for endpoint, stats in result[service].items():
+            codes = ' '.join(f"{code}:{count}" for code, count in sorted(stats['statuses'].items()))
+            print(f"{endpoint:<28}{stats['requests']:>10}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}  {codes}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк синхронизации на локальных заглушках')
+    parser.add_argument('--vehicles', type=int, nargs='+', default=[10, 100, 1000],
+                        help='размеры автопарка (10-5000)')
+    parser.add_argument('--mode', choices=['sync', 'async', 'stream'], default='sync')
+    parser.add_argument('--passes', type=int, default=2, help='проходов подряд (первый - холодный)')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=30, help='задержка LocTracker')
+    parser.add_argument('--notion-latency-ms', type=float, default=100, help='задержка Notion')
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 503')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='доля ответов 429 от Notion')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After для 429, секунды')
+    parser.add_argument('--notion-rate', type=float, default=1000.0,
+                        help='NOTION_RATE_LIMIT клиента (реальный лимит Notion - 3)')
+    parser.add_argument('--churn', type=float, default=0.0,
+                        help='доля ТС, меняющих позицию перед каждым проходом')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stateless', action='store_true',
+                        help='без файлов состояния (снимок, очередь Notion, история, геозоны, отпечатки)')
+    parser.add_argument('--tracemalloc', action='store_true', help='также пик Python-аллокаций (медленнее)')
+    parser.add_argument('--json', help='сохранить результаты в JSON-файл')
+    parser.add_argument('--verbose', action='store_true', help='логи синхронизации')
+    args = parser.parse_args()
+    
+    results: List[Dict[str, Any]] = []
+    for vehicles in args.vehicles:
+        result = run_scenario(vehicles, args)
+        print_report(result)
+        results.append(result)
+    
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк подготовки свойств Notion: по одному ТС против пакетного преобразования
+Запуск: python benchmarks/transform_benchmark.py --vehicles 5000
+Сеть не нужна - записи синтетические, клиент Notion не вызывается
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import logging
+
+# Модули проекта лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('NOTION_API_KEY', 'benchmark')
+os.environ['NOTION_STATE_FILE'] = ''
+
+from sync_dispatcher_data import DispatcherNotionSync
+
+def make_records(count: int, seed: int = 42) -> list:
+    """Синтетические объединенные записи с полным набором полей"""
+    rng = random.Random(seed)
+    now_ms = int(time.time() * 1000)
+    records = []
+    for i in range(count):
+        records.append({
+            'number': str(100000 + i),
+            'deviceNumber': str(100000 + i),
+            'registrationNumber': f"LT-{i:05d}",
+            'vehicleId': i,
+            'lat': 54.0 + rng.random(),
+            'lng': 25.0 + rng.random(),
+            'speed': rng.choice([0, 0, 35, 72, 88]),
+            'ignitionState': rng.choice(['ON', 'OFF']),
+            'address': f"Gatve {i}, Vilnius",
+            'driverName': f"Driver {i}",
+            'currentTaskAddress': f"Task {i}",
+            'nextTaskAddress': rng.choice(['', f"Next {i}"]),
+            'taskStatus': rng.choice(['PENDING', 'STARTED']),
+            'distanceToTask': round(rng.uniform(0, 400), 2),
+            'dailyDrivingTimeLeft': rng.randint(0, 9 * 3600),
+            'continuousDrivingTimeLeft': rng.randint(0, 4 * 3600),
+            'weeklyDrivingTimeLeft': rng.randint(0, 56 * 3600),
+            'currentActivity': rng.choice(['DRIVING', 'REST', 'WORK']),
+            'workDayStarted': now_ms - rng.randint(0, 10 * 3600 * 1000),
+            'nextDayRest': now_ms + rng.randint(0, 10 * 3600 * 1000),
+            'longerDrivingCount': rng.randint(0, 2),
+            'shorterRestCount': rng.randint(0, 2),
+            'fuelLevel': rng.uniform(5, 100),
+            'dailyDistance': rng.uniform(0, 800),
+            'completedTasks': rng.randint(0, 10),
+            'plannedArrival': now_ms + rng.randint(-3600, 3600) * 1000,
+            'actualArrival': rng.choice([None, now_ms]),
+            'lastMessage': f"Message {i}",
+        })
+    return records
+
+def best_of(repeat: int, func) -> float:
+    """Лучшее время из нескольких запусков, секунды"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--vehicles', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    
+    logging.disable(logging.INFO)
+    notion = DispatcherNotionSync()
+    records = make_records(args.vehicles)
+    
+    per_vehicle = best_of(args.repeat, lambda: [notion._prepare_properties(r) for r in records])
+    batch = best_of(args.repeat, lambda: notion.prepare_properties_batch(records))
+    
+    print(f"ТС: {args.vehicles}")
+    print(f"по одному ТС: {per_vehicle * 1000:8.1f} мс, {per_vehicle / args.vehicles * 1e6:6.1f} мкс/ТС")
+    print(f"пакетно:      {batch * 1000:8.1f} мс, {batch / args.vehicles * 1e6:6.1f} мкс/ТС")
+    print(f"ускорение:    {per_vehicle / batch:.1f}x")
+
+if __name__ == "__main__":
+    main()
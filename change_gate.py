@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Фильтр изменившихся ТС по общим ответам LocTracker
+Отпечаток горячих полей каждого ТС (позиция, тахограф, задачи из fleet state) сравнивается
+с последним записанным в Notion; запросы по ТС и запись выполняются только для изменившихся
+или давно не обновлявшихся ТС
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Пропускать обогащение и запись ТС, чьи общие данные не изменились
+CHANGE_GATE_ENABLED = os.getenv('CHANGE_GATE_ENABLED', '1') == '1'
+# Файл с отпечатками последних записанных состояний ТС
+CHANGE_GATE_FILE = os.getenv('CHANGE_GATE_FILE', '.change_gate.json')
+# Неизменившееся ТС все равно обновляется не реже этого интервала (секунды)
+CHANGE_GATE_MAX_STALENESS = float(os.getenv('CHANGE_GATE_MAX_STALENESS', '900'))
+
+# Округление координат для отпечатка (4 знака - около 10 м, дрожание GPS стоящего ТС не считается)
+COORDINATE_DIGITS = 4
+TACHO_DURATIONS = ('driveTimeCurrentDay', 'driveTimeSinceRest', 'driveTimeCurrentWeek')
+
+def _rounded(value, digits: int):
+    try:
+        return round(float(value), digits)
+    except (TypeError, ValueError):
+        return None
+
+def fingerprint(position: Optional[Dict], tacho: Optional[Dict], tasks: Optional[List[Dict]],
+                arrivals: Optional[Dict] = None) -> str:
+    """Отпечаток горячих полей ТС (время отметки позиции не входит - оно меняется и у стоящего ТС)"""
+    position = position or {}
+    tacho = tacho or {}
+    hot = {
+        'lat': _rounded(position.get('lat'), COORDINATE_DIGITS),
+        'lng': _rounded(position.get('lng'), COORDINATE_DIGITS),
+        'speed': _rounded(position.get('speed'), 0),
+        'ignition': position.get('ignitionState'),
+        'tacho': [tacho.get('status'), tacho.get('workPeriodStart'), tacho.get('workPeriodExpectedEnd'),
+                  tacho.get('driverNameFull', tacho.get('driverName'))]
+                 + [(tacho.get(key) or {}).get('durationRemaining') for key in TACHO_DURATIONS],
+        'tasks': tasks or [],
+    }
+    # Прибытие или отъезд по геозоне - тоже изменение (без прибытий отпечаток прежний)
+    if arrivals:
+        hot['arrivals'] = arrivals
+    payload = json.dumps(hot, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+class ChangeGate:
+    """Отпечатки последних записанных состояний ТС
+    
+    select() отбирает ТС для обогащения, mark_synced() запоминает отпечаток после
+    успешной записи в Notion (неудачная запись повторится на следующем проходе),
+    save() сохраняет отпечатки на диск.
+    """
+    
+    def __init__(self, state_file: Optional[str] = CHANGE_GATE_FILE,
+                 max_staleness: float = CHANGE_GATE_MAX_STALENESS):
+        self.state_file = state_file
+        self.max_staleness = max_staleness
+        # номер устройства -> [отпечаток, время записи]
+        self.synced: Dict[str, list] = self._load()
+        self.pending: Dict[str, str] = {}
+        self.lock = threading.Lock()
+    
+    def _load(self) -> Dict[str, list]:
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать отпечатки ТС: {e}")
+            return {}
+    
+    def save(self):
+        """Атомарно сохранить отпечатки"""
+        if not self.state_file:
+            return
+        tmp_file = f"{self.state_file}.tmp"
+        try:
+            with self.lock:
+                data = json.dumps(self.synced)
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_file, self.state_file)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить отпечатки ТС: {e}")
+    
+    def select(self, vehicles: List[Dict], positions_dict: Dict, tacho_dict: Dict, fleet_tasks_dict: Dict,
+               activities_dict: Dict, arrivals_dict: Optional[Dict] = None,
+               now: Optional[float] = None) -> Tuple[List[Dict], List[Dict]]:
+        """Разделить ТС на изменившиеся (или устаревшие) и неизменившиеся"""
+        if now is None:
+            now = time.time()
+        changed, unchanged = [], []
+        with self.lock:
+            self.pending = {}
+            for device in vehicles:
+                key = device.get('number')
+                device_number = str(key)
+                current = fingerprint(positions_dict.get(key), tacho_dict.get(key), fleet_tasks_dict.get(key),
+                                      (arrivals_dict or {}).get(device_number))
+                self.pending[device_number] = current
+                previous = self.synced.get(device_number)
+                fresh = previous and previous[0] == current and now - previous[1] < self.max_staleness
+                # Новая активность из ленты - тоже изменение
+                if fresh and device_number not in activities_dict:
+                    unchanged.append(device)
+                else:
+                    changed.append(device)
+        return changed, unchanged
+    
+    def pending_fingerprint(self, record: Dict) -> Optional[str]:
+        """Отпечаток ТС, отобранного в текущем проходе"""
+        with self.lock:
+            return self.pending.get(str(record.get('number')))
+    
+    def mark_synced(self, record: Dict, now: Optional[float] = None, fingerprint: Optional[str] = None):
+        """Запомнить отпечаток ТС после успешной записи
+        
+        fingerprint - отпечаток на момент постановки записи в очередь: к выгрузке
+        следующий проход мог уже заменить pending более новым.
+        """
+        device_number = str(record.get('number'))
+        with self.lock:
+            current = fingerprint or self.pending.get(device_number)
+            if current:
+                self.synced[device_number] = [current, time.time() if now is None else now]
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Геометрия автопарка на NumPy
+Расстояния (haversine * коэффициент дорог) и ETA для всех пар (ТС, задача) одной векторной операцией
+"""
+
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import pytz
+
+EARTH_RADIUS_KM = 6371
+ROAD_FACTOR = 1.15        # +15% для учета дорог
+MOVING_SPEED_KMH = 10     # быстрее - считаем, что ТС едет, и берем его скорость
+DEFAULT_SPEED_KMH = 60    # средняя скорость, если ТС стоит
+
+def haversine_km(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Дорожное расстояние в км между массивами точек (с broadcasting)"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return np.round(EARTH_RADIUS_KM * c * ROAD_FACTOR, 2)
+
+def eta_hours(distance_km: np.ndarray, speed_kmh: np.ndarray) -> np.ndarray:
+    """Часы до прибытия; NaN, если ETA не определено (стоит и расстояние 0)"""
+    moving = speed_kmh > MOVING_SPEED_KMH
+    speed = np.where(moving, speed_kmh, DEFAULT_SPEED_KMH)
+    hours = distance_km / speed
+    return np.where(moving | (distance_km > 0), hours, np.nan)
+
+def eta_iso_strings(hours: np.ndarray, now: datetime) -> List[Optional[str]]:
+    """Часы до прибытия -> ISO-строки UTC относительно now одной операцией (None для NaN)"""
+    now_utc = np.datetime64(now.astimezone(pytz.UTC).replace(tzinfo=None), 'us')
+    offsets = (np.nan_to_num(hours) * 3_600_000_000).astype(np.int64).astype('timedelta64[us]')
+    eta_strings = np.char.add(np.datetime_as_string(now_utc + offsets, unit='us'), '+00:00')
+    return np.where(np.isnan(hours), None, eta_strings).tolist()
+
+def _coordinate(value) -> Optional[float]:
+    """Координата как float или None (0 и пустые значения считаются отсутствующими)"""
+    try:
+        return float(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+def apply_task_distances(records: List[Dict], now: Optional[datetime] = None):
+    """Рассчитать расстояния и ETA до задач для всех ТС сразу
+    
+    Ожидает в записях lat/lng/speed и taskCoords: список (lat, lng), первая - текущая задача,
+    далее остальные незавершенные. Заполняет distanceToTask и taskEta для текущей задачи,
+    taskDistances и taskEtas - для всех задач из taskCoords.
+    """
+    if now is None:
+        now = datetime.now(pytz.UTC)
+    
+    # Плоский список пар (ТС, задача) с валидными координатами
+    pair_record, pair_slot, vehicle_lat, vehicle_lng, speeds, task_lat, task_lng = [], [], [], [], [], [], []
+    for index, record in enumerate(records):
+        coords = record.get('taskCoords')
+        lat, lng = _coordinate(record.get('lat')), _coordinate(record.get('lng'))
+        if not coords or lat is None or lng is None:
+            continue
+        record['taskDistances'] = [None] * len(coords)
+        record['taskEtas'] = [None] * len(coords)
+        for slot, (t_lat, t_lng) in enumerate(coords):
+            t_lat, t_lng = _coordinate(t_lat), _coordinate(t_lng)
+            if t_lat is None or t_lng is None:
+                continue
+            pair_record.append(index)
+            pair_slot.append(slot)
+            vehicle_lat.append(lat)
+            vehicle_lng.append(lng)
+            speeds.append(float(record.get('speed') or 0))
+            task_lat.append(t_lat)
+            task_lng.append(t_lng)
+    
+    if not pair_record:
+        return
+    
+    distances = haversine_km(vehicle_lat, vehicle_lng, task_lat, task_lng)
+    hours = eta_hours(distances, np.asarray(speeds, dtype=np.float64))
+    
+    eta_strings = eta_iso_strings(hours, now)
+    
+    for index, slot, distance, eta_iso in zip(pair_record, pair_slot, distances.tolist(), eta_strings):
+        record = records[index]
+        record['taskDistances'][slot] = distance
+        record['taskEtas'][slot] = eta_iso
+        if slot == 0:
+            record['distanceToTask'] = distance
+            if eta_iso:
+                record['taskEta'] = eta_iso
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Кэши для LocTracker API
+TTLCache - многоуровневый опрос: у каждого источника свой интервал обновления
+NegativeCache - экспоненциальная пауза для эндпоинтов, которые падают для устройства
+BodyMemo - повторное тело ответа не декодируется заново
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+
+import httpx
+import requests
+
+try:
+    import orjson
+except ImportError:  # необязательная зависимость: без нее декодирует стандартный json
+    orjson = None
+
+# Интервалы обновления источников (секунды); 0 - запрашивать на каждом проходе
+DEFAULT_REFRESH_INTERVALS = {
+    'devices': 1800,       # состав автопарка меняется редко
+    'positions': 0,        # горячие данные - каждую минуту
+    'tachographs': 0,
+    'fleet_state': 0,
+    'tasks': 120,          # задачи по устройству
+    'active_task': 120,
+    'reports': 1800,       # тяжелый отчет за сутки
+    'activities': 0,
+    'fuel': 900,           # емкость бака и уровень топлива
+}
+
+def load_refresh_intervals() -> Dict[str, float]:
+    """Интервалы из окружения: LOCTRACKER_REFRESH_<SOURCE>=секунды"""
+    intervals = {}
+    for source, default in DEFAULT_REFRESH_INTERVALS.items():
+        intervals[source] = float(os.getenv(f'LOCTRACKER_REFRESH_{source.upper()}', default))
+    return intervals
+
+class TTLCache:
+    """Потокобезопасный кэш ответов с отдельным TTL для каждого источника"""
+    
+    def __init__(self, ttls: Dict[str, float]):
+        self.ttls = ttls
+        self._entries: Dict[Tuple[str, Hashable], Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+    
+    def ttl(self, source: str) -> float:
+        return self.ttls.get(source, 0)
+    
+    def get(self, source: str, key: Hashable) -> Tuple[bool, Any]:
+        """Вернуть (найдено, значение) для неустаревшей записи"""
+        if self.ttl(source) <= 0:
+            return False, None
+        with self._lock:
+            entry = self._entries.get((source, key))
+            if entry and entry[0] > time.monotonic():
+                self.hits[source] = self.hits.get(source, 0) + 1
+                return True, entry[1]
+            self.misses[source] = self.misses.get(source, 0) + 1
+            return False, None
+    
+    def set(self, source: str, key: Hashable, value: Any):
+        ttl = self.ttl(source)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[(source, key)] = (time.monotonic() + ttl, value)
+    
+    def invalidate(self, source: Optional[str] = None):
+        """Сбросить записи источника (или все)"""
+        with self._lock:
+            if source is None:
+                self._entries.clear()
+            else:
+                for cache_key in [k for k in self._entries if k[0] == source]:
+                    del self._entries[cache_key]
+    
+    def purge(self):
+        """Удалить устаревшие записи"""
+        now = time.monotonic()
+        with self._lock:
+            for cache_key in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+                del self._entries[cache_key]
+    
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Попадания/промахи по источникам"""
+        with self._lock:
+            sources = set(self.hits) | set(self.misses)
+            return {s: {'hits': self.hits.get(s, 0), 'misses': self.misses.get(s, 0)} for s in sorted(sources)}
+
+# Источники, чьи тела ответов сравниваются по хэшу (большие общие документы автопарка)
+LOCTRACKER_BODY_MEMO_SOURCES = os.getenv('LOCTRACKER_BODY_MEMO_SOURCES', 'positions,tachographs,fleet_state')
+# Тела не меньше этого размера декодируются orjson, если он установлен (байты)
+FAST_JSON_MIN_BYTES = int(os.getenv('FAST_JSON_MIN_BYTES', '65536'))
+
+def decode_json(body: bytes) -> Any:
+    """Декодировать JSON; большие тела - через orjson, если он доступен"""
+    if orjson is not None and len(body) >= FAST_JSON_MIN_BYTES:
+        return orjson.loads(body)
+    return json.loads(body)
+
+class BodyMemo:
+    """Последнее тело ответа по источнику и запросу: хэш тела -> декодированное значение
+    
+    Если тело побайтно совпадает с предыдущим, decode() возвращает прежний объект
+    без разбора JSON. Возвращаемые объекты общие для проходов и не должны изменяться.
+    """
+    
+    def __init__(self, sources: Iterable[str]):
+        self.sources = {source.strip() for source in sources if source.strip()}
+        self._entries: Dict[Tuple[str, Hashable], Tuple[bytes, Any]] = {}
+        self._lock = threading.Lock()
+    
+    def decode(self, source: Optional[str], key: Hashable, body: bytes) -> Tuple[Any, bool]:
+        """Вернуть (значение, тело не изменилось)"""
+        if source not in self.sources:
+            return decode_json(body), False
+        digest = hashlib.blake2b(body, digest_size=16).digest()
+        with self._lock:
+            entry = self._entries.get((source, key))
+        if entry and entry[0] == digest:
+            return entry[1], True
+        value = decode_json(body)
+        with self._lock:
+            self._entries[(source, key)] = (digest, value)
+        return value, False
+
+# Начальная пауза по классу ошибки (секунды); удваивается при повторных ошибках
+NEGATIVE_BACKOFF_SECONDS = {
+    'not_found': 300,      # 404: у устройства нет датчика топлива / рейса
+    'client_error': 300,   # прочие 4xx
+    'timeout': 60,
+    'connection': 30,
+    'server_error': 30,    # 5xx
+    'error': 60,           # невалидный ответ и прочее
+}
+NEGATIVE_CACHE_MAX_SECONDS = float(os.getenv('NEGATIVE_CACHE_MAX_SECONDS', '3600'))
+
+class BackoffActive(Exception):
+    """Запрос не выполнялся: эндпоинт для устройства в паузе после ошибок"""
+
+def classify_failure(error: Exception) -> str:
+    """Класс ошибки запроса: not_found / client_error / server_error / timeout / connection / error"""
+    # Синхронный клиент работает через requests, асинхронный - через httpx
+    if isinstance(error, (requests.HTTPError, httpx.HTTPStatusError)) and error.response is not None:
+        status = error.response.status_code
+        if status == 404:
+            return 'not_found'
+        if status >= 500:
+            return 'server_error'
+        return 'client_error'
+    if isinstance(error, (requests.Timeout, httpx.TimeoutException)):
+        return 'timeout'
+    if isinstance(error, (requests.ConnectionError, httpx.TransportError)):
+        return 'connection'
+    return 'error'
+
+class NegativeCache:
+    """Запоминает неудачные запросы по (эндпоинт, устройство) и не повторяет их до конца паузы"""
+    
+    def __init__(self, max_backoff: float = NEGATIVE_CACHE_MAX_SECONDS):
+        self.max_backoff = max_backoff
+        # (эндпоинт, устройство) -> (класс ошибки, число ошибок подряд, пауза до)
+        self._entries: Dict[Tuple[str, str], Tuple[str, int, float]] = {}
+        self._lock = threading.Lock()
+        self.avoided: Dict[str, int] = {}
+    
+    def check(self, endpoint: str, device: str):
+        """Выбросить BackoffActive, если эндпоинт для устройства еще в паузе"""
+        with self._lock:
+            entry = self._entries.get((endpoint, device))
+            if not entry or entry[2] <= time.monotonic():
+                return
+            self.avoided[endpoint] = self.avoided.get(endpoint, 0) + 1
+            failure, _, until = entry
+        raise BackoffActive(f"{endpoint} для {device} в паузе ({failure}) еще {until - time.monotonic():.0f} с")
+    
+    def record_failure(self, endpoint: str, device: str, error: Exception) -> float:
+        """Запомнить ошибку и вернуть длительность паузы"""
+        failure = classify_failure(error)
+        with self._lock:
+            previous = self._entries.get((endpoint, device))
+            # При смене класса ошибки счетчик начинается заново
+            streak = previous[1] + 1 if previous and previous[0] == failure else 1
+            backoff = min(self.max_backoff, NEGATIVE_BACKOFF_SECONDS[failure] * 2 ** (streak - 1))
+            self._entries[(endpoint, device)] = (failure, streak, time.monotonic() + backoff)
+        return backoff
+    
+    def record_success(self, endpoint: str, device: str):
+        with self._lock:
+            self._entries.pop((endpoint, device), None)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Сэкономленные запросы по эндпоинтам и активные паузы по классам ошибок"""
+        now = time.monotonic()
+        with self._lock:
+            active: Dict[str, int] = {}
+            for failure, _, until in self._entries.values():
+                if until > now:
+                    active[failure] = active.get(failure, 0) + 1
+            return {'avoided': dict(self.avoided), 'active': active}
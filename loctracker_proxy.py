@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Локальный кэширующий прокси LocTracker для всех потребителей (синхронизация Notion, server/index.js)
+Общие эндпоинты (устройства, позиции, тахографы, fleet state) опрашиваются один раз по своему
+расписанию, остальные запросы кэшируются на интервал источника; одинаковые одновременные
+запросы объединяются в один запрос к LocTracker. Адреса те же, что у LocTracker
+(/<пользователь>/<путь>?password=...), поэтому потребителю достаточно сменить
+VITE_LOCTRACKER_API_URL на адрес прокси
+"""
+
+import os
+import re
+import hmac
+import json
+import time
+import signal
+import logging
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+from loctracker_cache import classify_failure, load_refresh_intervals
+from sync_dispatcher_data import LocTrackerAPI
+from sync_metrics import METRICS, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Адрес и порт прокси
+LOCTRACKER_PROXY_HOST = os.getenv('LOCTRACKER_PROXY_HOST', '127.0.0.1')
+LOCTRACKER_PROXY_PORT = int(os.getenv('LOCTRACKER_PROXY_PORT', '8765'))
+# Настоящий LocTracker для прокси (у потребителей VITE_LOCTRACKER_API_URL указывает на прокси)
+LOCTRACKER_UPSTREAM_URL = os.getenv('LOCTRACKER_UPSTREAM_URL', 'https://locator.lt/LoctrackerFieldService/REST/v1')
+# Минимальное время жизни ответа в кэше (секунды): объединяет опросы разных потребителей
+LOCTRACKER_PROXY_MIN_TTL = float(os.getenv('LOCTRACKER_PROXY_MIN_TTL', '5'))
+# Сколько отдавать устаревший ответ, если LocTracker недоступен (секунды)
+LOCTRACKER_PROXY_STALE_SECONDS = float(os.getenv('LOCTRACKER_PROXY_STALE_SECONDS', '600'))
+# Сколько кэшировать ответ 4xx (например, 404 по устройству без тахографа), секунды
+LOCTRACKER_PROXY_NEGATIVE_TTL = float(os.getenv('LOCTRACKER_PROXY_NEGATIVE_TTL', '30'))
+
+# Общие эндпоинты, которые прокси опрашивает сам: путь -> (источник, интервал по умолчанию)
+POLLED_ENDPOINTS = {
+    'devices': ('devices', 300),
+    'positions': ('positions', 10),
+    'tachographs/state': ('tachographs', 30),
+    'fleet/state': ('fleet_state', 30),
+}
+
+# Остальные пути -> источник (TTL из LOCTRACKER_REFRESH_<ИСТОЧНИК>)
+SOURCE_PATTERNS = (
+    (re.compile(r'^tasks/[^/]+/trip$'), 'tasks'),
+    (re.compile(r'^tasks/[^/]+/active$'), 'active_task'),
+    (re.compile(r'^reports/vehicle$'), 'reports'),
+    (re.compile(r'^fuel/[^/]+$'), 'fuel'),
+    (re.compile(r'^activities(/[^/]+)?$'), 'activities'),
+)
+
+def load_poll_intervals() -> Dict[str, float]:
+    """Интервалы опроса общих эндпоинтов: LOCTRACKER_PROXY_POLL_<SOURCE>=секунды"""
+    return {
+        path: float(os.getenv(f'LOCTRACKER_PROXY_POLL_{source.upper()}', default))
+        for path, (source, default) in POLLED_ENDPOINTS.items()
+    }
+
+def source_for(path: str) -> str:
+    """Источник пути LocTracker (для TTL и меток метрик)"""
+    if path in POLLED_ENDPOINTS:
+        return POLLED_ENDPOINTS[path][0]
+    for pattern, source in SOURCE_PATTERNS:
+        if pattern.match(path):
+            return source
+    return 'other'
+
+class _Entry:
+    """Закэшированный ответ LocTracker как есть: статус, тело, тип и время получения"""
+    
+    __slots__ = ('status', 'body', 'content_type', 'fetched_at', 'ttl')
+    
+    def __init__(self, status: int, body: bytes, content_type: Optional[str], ttl: float):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.fetched_at = time.time()
+        self.ttl = ttl
+    
+    def age(self) -> float:
+        return max(0.0, time.time() - self.fetched_at)
+    
+    def fresh(self) -> bool:
+        return self.age() < self.ttl
+
+class LocTrackerProxy:
+    """Кэш ответов LocTracker с опросом по расписанию и объединением запросов"""
+    
+    def __init__(self, loctracker: LocTrackerAPI, poll_intervals: Optional[Dict[str, float]] = None):
+        self.loctracker = loctracker
+        self.poll_intervals = poll_intervals if poll_intervals is not None else load_poll_intervals()
+        self.refresh_intervals = load_refresh_intervals()
+        # (путь, параметры) -> ответ
+        self._entries: Dict[Tuple, _Entry] = {}
+        # Запросы к LocTracker в процессе: (путь, параметры) -> событие завершения
+        self._inflight: Dict[Tuple, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server: Optional[ThreadingHTTPServer] = None
+    
+    def _ttl(self, path: str) -> float:
+        if path in self.poll_intervals:
+            return max(self.poll_intervals[path], LOCTRACKER_PROXY_MIN_TTL)
+        return max(self.refresh_intervals.get(source_for(path), 0), LOCTRACKER_PROXY_MIN_TTL)
+    
+    def _refresh(self, key: Tuple) -> _Entry:
+        """Запросить LocTracker и сохранить ответ без перекодирования (ошибка пробрасывается)
+        
+        Ответ 4xx кэшируется ненадолго (LOCTRACKER_PROXY_NEGATIVE_TTL), чтобы потребители
+        не повторяли заведомо неудачный запрос; 5xx и 429 - ошибка, как и недоступность сервера.
+        """
+        path, params = key
+        url = f"{self.loctracker.base_url}/{self.loctracker.username}/{path}"
+        query = {**dict(params), 'password': self.loctracker.password}
+        response = self.loctracker.session.get(url, params=query, timeout=self.loctracker.timeout)
+        if response.status_code >= 500 or response.status_code == 429:
+            response.raise_for_status()
+        ttl = self._ttl(path) if response.ok else LOCTRACKER_PROXY_NEGATIVE_TTL
+        entry = _Entry(response.status_code, response.content, response.headers.get('Content-Type'), ttl)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+    
+    def fetch(self, path: str, params: Dict[str, str], force: bool = False) -> Tuple[_Entry, str]:
+        """Ответ для пути и параметров и результат: hit, miss, coalesced или stale
+        
+        force - запросить LocTracker, даже если ответ в кэше еще свежий (опрос по расписанию).
+        """
+        key = (path, tuple(sorted(params.items())))
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry.fresh() and not force:
+                    return entry, 'hit'
+                waiting = self._inflight.get(key)
+                if waiting is None:
+                    done = self._inflight[key] = threading.Event()
+                    break
+            # Такой же запрос уже идет - ждем его ответ вместо второго запроса
+            waiting.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry and entry.fresh():
+                return entry, 'coalesced'
+            if entry and entry.age() < LOCTRACKER_PROXY_STALE_SECONDS:
+                return entry, 'stale'
+        
+        try:
+            return self._refresh(key), 'miss'
+        except Exception:
+            if entry and entry.age() < LOCTRACKER_PROXY_STALE_SECONDS:
+                return entry, 'stale'
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            done.set()
+    
+    def invalidate(self, prefix: str):
+        """Сбросить ответы путей с префиксом (после изменяющих запросов)"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0].startswith(prefix)]:
+                del self._entries[key]
+    
+    def purge(self):
+        """Удалить ответы, которые уже нельзя отдать даже как устаревшие"""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e.age() > max(e.ttl, LOCTRACKER_PROXY_STALE_SECONDS)]:
+                del self._entries[key]
+    
+    def _poll(self, path: str, interval: float):
+        """Опрос общего эндпоинта по расписанию (через fetch - с объединением запросов)"""
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.fetch(path, {}, force=True)
+            except Exception as e:
+                logger.warning(f"⚠️ Прокси: не удалось обновить {path}: {e}")
+            self.purge()
+            self._stop.wait(max(0.0, interval - (time.monotonic() - started)))
+    
+    def authorized(self, username: str, password: str) -> bool:
+        """Учетные данные потребителя совпадают с учетной записью прокси"""
+        return (hmac.compare_digest(username.encode('utf-8'), str(self.loctracker.username).encode('utf-8'))
+                and hmac.compare_digest(password.encode('utf-8'), str(self.loctracker.password).encode('utf-8')))
+    
+    def forward(self, method: str, path: str, params: Dict[str, str], body: bytes,
+                content_type: Optional[str]) -> Tuple[int, bytes]:
+        """Изменяющий запрос (POST/PUT/DELETE) - напрямую в LocTracker, без кэша"""
+        url = f"{self.loctracker.base_url}/{self.loctracker.username}/{path}"
+        query = {**params, 'password': self.loctracker.password}
+        headers = {'Content-Type': content_type} if content_type else {}
+        response = self.loctracker.session.request(method, url, params=query, data=body or None,
+                                                   headers=headers, timeout=self.loctracker.timeout)
+        # Задачи устройства и fleet state после изменения нужно перечитать
+        parts = path.split('/')
+        if parts[0] == 'tasks' and len(parts) > 1:
+            self.invalidate(f"tasks/{parts[1]}/")
+            self.invalidate('fleet/state')
+        return response.status_code, response.content
+    
+    def start(self, host: str = LOCTRACKER_PROXY_HOST, port: int = LOCTRACKER_PROXY_PORT) -> ThreadingHTTPServer:
+        """Запустить HTTP-сервер и опрос общих эндпоинтов в фоновых потоках"""
+        proxy = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def _send(self, status: int, body: bytes, headers: Optional[Dict[str, str]] = None,
+                      content_type: Optional[str] = None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type or 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def _error(self, status: int, description: str):
+                body = json.dumps({'errorCode': status, 'errorDescription': description}, ensure_ascii=False)
+                self._send(status, body.encode('utf-8'))
+            
+            def _route(self) -> Optional[Tuple[str, Dict[str, str]]]:
+                """Путь LocTracker и параметры без пароля; None, если ответ уже отправлен"""
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query, keep_blank_values=True))
+                username, _, path = url.path.lstrip('/').partition('/')
+                if not path:
+                    self._error(404, 'Unknown path')
+                    return None
+                if not proxy.authorized(username, params.pop('password', '')):
+                    self._error(401, 'Invalid credentials')
+                    return None
+                return path, params
+            
+            def do_GET(self):
+                route = self._route()
+                if route is None:
+                    return
+                path, params = route
+                source = source_for(path)
+                try:
+                    entry, result = proxy.fetch(path, params)
+                except Exception as e:
+                    METRICS.inc('loctracker_proxy_requests_total', endpoint=source, result=classify_failure(e))
+                    if isinstance(e, requests.HTTPError) and e.response is not None:
+                        # Статус и тело LocTracker как есть - потребитель сам различает виды ошибок
+                        self._send(e.response.status_code, e.response.content,
+                                   content_type=e.response.headers.get('Content-Type'))
+                    else:
+                        self._error(502, f"LocTracker unavailable: {e}")
+                    return
+                METRICS.inc('loctracker_proxy_requests_total', endpoint=source, result=result)
+                age = entry.age()
+                headers = {
+                    'Cache-Control': f"max-age={max(0, int(entry.ttl - age))}",
+                    'Age': str(int(age)),
+                    'Last-Modified': formatdate(entry.fetched_at, usegmt=True),
+                    'X-Cache': result.upper(),
+                }
+                if result == 'stale':
+                    headers['Warning'] = '110 - "Response is Stale"'
+                self._send(entry.status, entry.body, headers, entry.content_type)
+            
+            def _forward(self):
+                route = self._route()
+                if route is None:
+                    return
+                path, params = route
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                try:
+                    status, content = proxy.forward(self.command, path, params, body,
+                                                    self.headers.get('Content-Type'))
+                except Exception as e:
+                    self._error(502, f"LocTracker unavailable: {e}")
+                    return
+                self._send(status, content)
+            
+            do_POST = do_PUT = do_DELETE = _forward
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='loctracker-proxy', daemon=True).start()
+        for path, interval in self.poll_intervals.items():
+            if interval > 0:
+                threading.Thread(target=self._poll, args=(path, interval), name=f"poll-{path}", daemon=True).start()
+        logger.info(f"🛰️ Прокси LocTracker на http://{host}:{self._server.server_address[1]} "
+                    f"-> {self.loctracker.base_url}")
+        return self._server
+    
+    def stop(self):
+        self._stop.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        self.loctracker.close()
+
+def main():
+    """Главная функция"""
+    proxy = LocTrackerProxy(LocTrackerAPI(base_url=LOCTRACKER_UPSTREAM_URL))
+    proxy.start()
+    if METRICS_PORT:
+        METRICS.start_http_server(METRICS_PORT)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    stop_event.wait()
+    proxy.stop()
+    logger.info("👋 Прокси LocTracker остановлен")
+
+if __name__ == "__main__":
+    main()
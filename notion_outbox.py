@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Долговременная очередь записей в Notion (SQLite)
+Проход кладет подготовленные свойства в очередь и не ждет Notion; отдельный поток
+выгружает очередь в темпе общего RateLimiter. На одно ТС в очереди не больше одной записи:
+новое обновление заменяет еще не отправленное (побеждает последнее), а неудачные записи
+повторяются с нарастающей паузой и переживают перезапуск процесса
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from sync_metrics import METRICS, with_pass_labels
+
+logger = logging.getLogger(__name__)
+
+# Файл очереди записей в Notion ('' - писать в Notion напрямую из прохода)
+NOTION_OUTBOX_FILE = os.getenv('NOTION_OUTBOX_FILE', 'notion_outbox.db')
+# Потоков выгрузки очереди (темп запросов все равно задает RateLimiter)
+NOTION_OUTBOX_WORKERS = int(os.getenv('NOTION_OUTBOX_WORKERS', '4'))
+# Пауза перед повтором неудачной записи: база и потолок (секунды)
+NOTION_OUTBOX_RETRY_BASE = float(os.getenv('NOTION_OUTBOX_RETRY_BASE', '5'))
+NOTION_OUTBOX_RETRY_MAX = float(os.getenv('NOTION_OUTBOX_RETRY_MAX', '300'))
+# После стольких неудач подряд запись удаляется из очереди
+NOTION_OUTBOX_MAX_ATTEMPTS = int(os.getenv('NOTION_OUTBOX_MAX_ATTEMPTS', '20'))
+
+# Сколько записей выгружается за один круг
+DRAIN_BATCH_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    vehicle_key     TEXT PRIMARY KEY,
+    data            TEXT NOT NULL,
+    properties      TEXT,
+    priority        INTEGER NOT NULL,
+    version         INTEGER NOT NULL,
+    enqueued_at     REAL NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt_at, priority, enqueued_at);
+"""
+
+def vehicle_key(data: Dict) -> Optional[str]:
+    """Ключ ТС в очереди: номер устройства, иначе регистрационный номер"""
+    key = data.get('number', data.get('deviceNumber')) or str(data.get('registrationNumber', '')).strip()
+    return str(key) if key else None
+
+class NotionOutbox:
+    """Очередь записей в Notion с объединением по ТС
+    
+    enqueue() сохраняет запись (заменяя ожидающую запись того же ТС),
+    drain() выгружает подошедшие записи через notion.update_or_create_entry,
+    start_drainer() выгружает очередь в фоне до stop_drainer().
+    on_written из enqueue() вызывается только после успешной записи именно этой версии
+    (колбэки живут в памяти; записи, оставшиеся с прошлого запуска, пишутся без них).
+    on_settled() откладывает действие, пока ожидающие колбэки не будут вызваны или отменены.
+    """
+    
+    def __init__(self, notion, path: str = NOTION_OUTBOX_FILE, workers: int = NOTION_OUTBOX_WORKERS):
+        self.notion = notion
+        self.path = path
+        self.workers = max(1, workers)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.coalesced = 0
+        # ключ ТС -> (версия записи, колбэк после успешной записи)
+        self._callbacks: Dict[str, Tuple[int, Callable[[Dict], None]]] = {}
+        # Действия после ожидающих колбэков: (ожидаемые (ключ ТС, версия), действие), см. on_settled
+        self._settled_callbacks: List[Tuple[Set[Tuple[str, int]], Callable[[], None]]] = []
+        pending = self.pending()
+        if pending:
+            logger.info(f"📮 В очереди записей Notion с прошлого запуска: {pending}")
+    
+    def close(self):
+        self.connection.close()
+    
+    def pending(self) -> int:
+        with self._lock:
+            return self.connection.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+    
+    def enqueue(self, data: Dict, properties: Optional[Dict] = None, priority: int = 0,
+                on_written: Optional[Callable[[Dict], None]] = None) -> bool:
+        """Поставить запись ТС в очередь; ожидающая запись того же ТС заменяется
+        
+        on_written(data) вызывается из потока выгрузки после успешной записи в Notion.
+        """
+        key = vehicle_key(data)
+        if key is None:
+            logger.warning("Пропускаем запись без идентификации")
+            return False
+        now = time.time()
+        row = (key, json.dumps(dict(data), ensure_ascii=False, default=str),
+               json.dumps(properties, ensure_ascii=False) if properties is not None else None,
+               priority, now, now)
+        with self._lock, self.connection:
+            replaced = self.connection.execute('SELECT 1 FROM outbox WHERE vehicle_key = ?', (key,)).fetchone()
+            # Новые данные заменяют старые, но пауза после неудачи сохраняется
+            self.connection.execute(
+                'INSERT INTO outbox (vehicle_key, data, properties, priority, version, enqueued_at, next_attempt_at) '
+                'VALUES (?, ?, ?, ?, 1, ?, ?) '
+                'ON CONFLICT(vehicle_key) DO UPDATE SET '
+                'data = excluded.data, properties = excluded.properties, priority = excluded.priority, '
+                'version = outbox.version + 1, enqueued_at = excluded.enqueued_at',
+                row
+            )
+            version = self.connection.execute('SELECT version FROM outbox WHERE vehicle_key = ?',
+                                              (key,)).fetchone()[0]
+            # Колбэк - только у последней версии: замененные данные отдельно не записываются
+            if on_written is not None:
+                self._callbacks[key] = (version, on_written)
+            else:
+                self._callbacks.pop(key, None)
+            if replaced:
+                self.coalesced += 1
+        if replaced:
+            METRICS.inc('notion_outbox_coalesced_total')
+        self._wakeup.set()
+        return True
+    
+    def _due(self, now: float):
+        with self._lock:
+            return self.connection.execute(
+                'SELECT vehicle_key, data, properties, version, attempts FROM outbox '
+                'WHERE next_attempt_at <= ? ORDER BY priority, enqueued_at LIMIT ?', (now, DRAIN_BATCH_SIZE)
+            ).fetchall()
+    
+    def _next_attempt_at(self) -> Optional[float]:
+        with self._lock:
+            row = self.connection.execute('SELECT MIN(next_attempt_at) FROM outbox').fetchone()
+        return row[0]
+    
+    def _take_callback(self, row) -> Optional[Callable[[Dict], None]]:
+        """Забрать колбэк записи, если он относится к этой версии (вызывать под self._lock)"""
+        pending = self._callbacks.get(row['vehicle_key'])
+        if pending is None or pending[0] != row['version']:
+            return None
+        del self._callbacks[row['vehicle_key']]
+        return pending[1]
+    
+    def _write(self, row) -> bool:
+        """Отправить одну запись; удалить ее из очереди, если ее не заменили за время отправки"""
+        data = json.loads(row['data'])
+        with METRICS.stage('notion_write'):
+            success = self.notion.update_or_create_entry(data,
+                                                         json.loads(row['properties']) if row['properties'] else None)
+        callback = None
+        with self._lock, self.connection:
+            if success:
+                self.connection.execute('DELETE FROM outbox WHERE vehicle_key = ? AND version = ?',
+                                        (row['vehicle_key'], row['version']))
+                callback = self._take_callback(row)
+            elif row['attempts'] + 1 >= NOTION_OUTBOX_MAX_ATTEMPTS:
+                self.connection.execute('DELETE FROM outbox WHERE vehicle_key = ? AND version = ?',
+                                        (row['vehicle_key'], row['version']))
+                self._take_callback(row)
+                logger.error(f"❌ Запись {row['vehicle_key']} удалена из очереди после "
+                             f"{NOTION_OUTBOX_MAX_ATTEMPTS} неудачных попыток")
+            else:
+                delay = min(NOTION_OUTBOX_RETRY_MAX, NOTION_OUTBOX_RETRY_BASE * 2 ** row['attempts'])
+                self.connection.execute(
+                    'UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE vehicle_key = ?',
+                    (time.time() + delay, row['vehicle_key'])
+                )
+        METRICS.inc('notion_outbox_writes_total', result='written' if success else 'failed')
+        if callback is not None:
+            try:
+                callback(data)
+            except Exception as e:
+                logger.error(f"Ошибка обработки записи {row['vehicle_key']} после выгрузки: {e}")
+        return success
+    
+    def drain(self) -> Tuple[int, int]:
+        """Выгрузить подошедшие записи (сначала срочные); вернуть (записано, неудачно)
+        
+        После первой неудачи круг останавливается: при сбое Notion остальная очередь
+        ждет паузы, а не тратит на него повторы.
+        """
+        written = failed = 0
+        with self._drain_lock, ThreadPoolExecutor(max_workers=self.workers,
+                                                  thread_name_prefix='outbox') as executor:
+            while not self._stop.is_set():
+                rows = self._due(time.time())
+                if not rows:
+                    break
+                results = list(executor.map(with_pass_labels(self._write), rows))
+                written += sum(results)
+                failed += len(results) - sum(results)
+                if not all(results):
+                    break
+        if written:
+            self.notion.save_state()
+        METRICS.set('notion_outbox_pending', self.pending())
+        if failed:
+            logger.warning(f"⚠️ Очередь Notion: записано {written}, неудачно {failed}, ожидает {self.pending()}")
+        elif written:
+            logger.info(f"📮 Очередь Notion: записано {written}")
+        return written, failed
+    
+    def on_settled(self, callback: Callable[[], None]):
+        """Вызвать callback из потока выгрузки, когда все ожидающие сейчас on_written будут
+        вызваны или отменены (запись удалена из очереди или заменена новой версией)"""
+        with self._lock:
+            waiting = {(key, version) for key, (version, _) in self._callbacks.items()}
+            self._settled_callbacks.append((waiting, callback))
+        self._wakeup.set()
+    
+    def _run_settled_callbacks(self, force: bool = False):
+        with self._lock:
+            callbacks, remaining = [], []
+            for waiting, callback in self._settled_callbacks:
+                waiting = {(key, version) for key, version in waiting
+                           if self._callbacks.get(key, (None,))[0] == version}
+                if waiting and not force:
+                    remaining.append((waiting, callback))
+                else:
+                    callbacks.append(callback)
+            self._settled_callbacks = remaining
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Ошибка обработки после выгрузки очереди Notion: {e}")
+    
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error(f"Ошибка выгрузки очереди Notion: {e}")
+            self._run_settled_callbacks()
+            next_attempt_at = self._next_attempt_at()
+            timeout = None if next_attempt_at is None else max(0.1, next_attempt_at - time.time())
+            # Новая запись в очереди будит поток раньше срока повтора
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+    
+    def start_drainer(self):
+        """Выгружать очередь в фоновом потоке"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=with_pass_labels(self._run), name='notion-outbox', daemon=True)
+        self._thread.start()
+    
+    def stop_drainer(self):
+        """Остановить фоновый поток (ожидающие записи остаются в файле очереди)"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._stop.clear()
+        # Итоги по уже подтвержденным записям - до остановки, не дожидаясь остальных
+        self._run_settled_callbacks(force=True)
+    
+    @property
+    def draining(self) -> bool:
+        """Очередь выгружает фоновый поток"""
+        return self._thread is not None
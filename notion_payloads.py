@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Поколоночные преобразования данных автопарка для свойств Notion
+Метки времени, время вождения, топливо и загрузка считаются для всех ТС сразу на NumPy,
+а не по одному datetime/форматированию на каждое поле каждого ТС
+"""
+
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from fleet_geo import eta_hours, eta_iso_strings
+
+DEFAULT_TANK_CAPACITY = 400   # литров, стандартный бак грузовика
+WORK_DAY_HOURS = 8            # рабочий день для расчета загрузки
+
+# Границы, которые datetime.fromtimestamp принимает для UTC (годы 1..9999)
+_MIN_TIMESTAMP_MS = -62135596800000
+_MAX_TIMESTAMP_MS = 253402300799999
+
+def column(records: List[Dict], key: str) -> List[Any]:
+    """Значения одного поля по всем записям"""
+    return [record.get(key) for record in records]
+
+def _timestamp_column(values: List[Any]):
+    """Метки в мс как int64 и маска валидных (пустые и нечисловые пропускаются)"""
+    timestamps = np.zeros(len(values), dtype=np.int64)
+    valid = np.zeros(len(values), dtype=bool)
+    for index, value in enumerate(values):
+        if not value:
+            continue
+        try:
+            timestamp_ms = int(value)
+        except (TypeError, ValueError):
+            continue
+        if _MIN_TIMESTAMP_MS <= timestamp_ms <= _MAX_TIMESTAMP_MS:
+            timestamps[index] = timestamp_ms
+            valid[index] = True
+    return timestamps, valid
+
+def _float_column(values: List[Any]) -> np.ndarray:
+    """Числа как float64, None -> NaN"""
+    return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+
+def timestamps_iso(values: List[Any]) -> List[Optional[str]]:
+    """Метки времени в мс -> ISO-строки UTC (как datetime.fromtimestamp(...).isoformat())"""
+    if not values:
+        return []
+    timestamps, valid = _timestamp_column(values)
+    moments = timestamps.astype('datetime64[ms]')
+    # isoformat опускает доли секунды, если они нулевые
+    strings = np.where(timestamps % 1000 == 0,
+                       np.datetime_as_string(moments, unit='s'),
+                       np.datetime_as_string(moments, unit='us'))
+    strings = np.char.add(strings, '+00:00')
+    return np.where(valid, strings, None).tolist()
+
+def driving_times(values: List[Any]) -> List[Optional[str]]:
+    """Остаток времени вождения в секундах -> 'ч:мм' ('0:00' для неположительных, None для пустых)"""
+    if not values:
+        return []
+    seconds = _float_column(values)
+    positive = seconds > 0
+    hours = np.where(positive, np.trunc(seconds / 3600), 0).astype(np.int64)
+    minutes = np.where(positive, np.trunc((seconds % 3600) / 60), 0).astype(np.int64)
+    return [
+        None if value is None else f"{h}:{m:02d}"
+        for value, h, m in zip(values, hours.tolist(), minutes.tolist())
+    ]
+
+def fuel_liters(levels: List[Any], capacities: List[Any]) -> List[Optional[float]]:
+    """Уровень топлива в процентах -> литры (бак по умолчанию 400 л)"""
+    if not levels:
+        return []
+    level = _float_column(levels)
+    capacity = _float_column([DEFAULT_TANK_CAPACITY if c is None else c for c in capacities])
+    liters = (level / 100) * capacity
+    return [None if value is None else result for value, result in zip(levels, liters.tolist())]
+
+def utilizations(work_starts: List[Any], now: datetime) -> List[Optional[float]]:
+    """Доля рабочего дня с начала смены (не больше 1); None, если смена не началась"""
+    if not work_starts:
+        return []
+    timestamps, valid = _timestamp_column(work_starts)
+    work_hours = (now.timestamp() - timestamps / 1000) / 3600
+    share = np.minimum(work_hours / WORK_DAY_HOURS, 1.0)
+    return np.where(valid & (work_hours > 0), share, None).tolist()
+
+def delay_minutes(planned: List[Any], actual: List[Any]) -> List[Optional[int]]:
+    """Опоздание в полных минутах (факт - план); None, если нет обеих меток или опоздания нет"""
+    if not planned:
+        return []
+    planned_ms, planned_valid = _timestamp_column(planned)
+    actual_ms, actual_valid = _timestamp_column(actual)
+    minutes = np.trunc((actual_ms / 1000 - planned_ms / 1000) / 60).astype(np.int64)
+    return np.where(planned_valid & actual_valid & (minutes > 0), minutes, None).tolist()
+
+def fallback_etas(distances: List[Any], speeds: List[Any], now: datetime) -> List[Optional[str]]:
+    """ETA по расстоянию и скорости для ТС без пакетного taskEta (стоит - средние 60 км/ч)"""
+    if not distances:
+        return []
+    distance = _float_column(distances)
+    speed = np.nan_to_num(_float_column(speeds))
+    return eta_iso_strings(eta_hours(distance, speed), now)
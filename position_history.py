@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+История позиций автопарка (колоночное хранилище временных рядов)
+Каждый проход дописывает позиции в файлы-массивы по устройствам и суткам:
+    <каталог>/<YYYY-MM-DD>/<устройство>.ts   int32   секунды от начала суток UTC (смещение к базе дня)
+    <каталог>/<YYYY-MM-DD>/<устройство>.lat  float32
+    <каталог>/<YYYY-MM-DD>/<устройство>.lng  float32
+    <каталог>/<YYYY-MM-DD>/<устройство>.spd  float32  км/ч
+Файлы открываются через np.memmap, запрос по окну времени - бинарный поиск по .ts,
+в память копируется только нужный срез
+"""
+
+import os
+import re
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# Каталог истории позиций ('' - не сохранять)
+POSITION_HISTORY_DIR = os.getenv('POSITION_HISTORY_DIR', 'position_history')
+
+COLUMNS = {
+    'ts': np.int32,
+    'lat': np.float32,
+    'lng': np.float32,
+    'spd': np.float32,
+}
+SECONDS_PER_DAY = 86400
+
+def _day_start(timestamp: int) -> int:
+    """Начало суток UTC (Unix секунды) для метки времени"""
+    return timestamp - timestamp % SECONDS_PER_DAY
+
+def _day_name(day_start: int) -> str:
+    return datetime.fromtimestamp(day_start, tz=pytz.UTC).strftime('%Y-%m-%d')
+
+def _safe_device(device_number: str) -> str:
+    """Номер устройства как безопасное имя файла"""
+    return re.sub(r'[^0-9A-Za-z_.-]', '_', str(device_number))
+
+class PositionHistory:
+    """Дописываемая история позиций с запросами по устройству и окну времени"""
+    
+    def __init__(self, root: str = POSITION_HISTORY_DIR):
+        self.root = root
+        # Последняя записанная метка по устройству и суткам: не пишем дубли и откаты времени
+        self._last_ts: Dict[tuple, Optional[int]] = {}
+        self._lock = threading.Lock()
+    
+    def _path(self, day_start: int, device_number: str, column: str) -> str:
+        return os.path.join(self.root, _day_name(day_start), f"{_safe_device(device_number)}.{column}")
+    
+    def _repair(self, day_start: int, device_number: str) -> int:
+        """Выровнять колонки устройства за сутки по самой короткой; вернуть число строк
+        
+        Сбой посреди дописывания оставляет колонки разной длины (и неполное значение в конце);
+        без обрезки следующие точки легли бы в колонки со сдвигом.
+        """
+        paths = {column: self._path(day_start, device_number, column) for column in COLUMNS}
+        sizes = {column: os.path.getsize(path) if os.path.exists(path) else 0 for column, path in paths.items()}
+        rows = min(sizes[column] // np.dtype(dtype).itemsize for column, dtype in COLUMNS.items())
+        for column, dtype in COLUMNS.items():
+            size = rows * np.dtype(dtype).itemsize
+            if sizes[column] > size:
+                with open(paths[column], 'r+b') as f:
+                    f.truncate(size)
+                logger.warning(f"✂️ История позиций {_day_name(day_start)}/{device_number}.{column}: "
+                               f"обрезано до {rows} точек после незавершенной записи")
+        return rows
+    
+    def _last_offset(self, day_start: int, device_number: str) -> Optional[int]:
+        """Последнее смещение в файле .ts (читается с диска один раз на устройство и сутки)
+        
+        При первом обращении колонки выравниваются по длине (_repair).
+        """
+        key = (day_start, str(device_number))
+        if key not in self._last_ts:
+            rows = self._repair(day_start, device_number)
+            if rows:
+                with open(self._path(day_start, device_number, 'ts'), 'rb') as f:
+                    f.seek((rows - 1) * 4)
+                    self._last_ts[key] = int(np.frombuffer(f.read(4), dtype=np.int32)[0])
+            else:
+                self._last_ts[key] = None
+        return self._last_ts[key]
+    
+    def append(self, positions: Iterable[Dict], fallback_time: Optional[float] = None) -> int:
+        """Дописать позиции прохода; вернуть число новых точек"""
+        if fallback_time is None:
+            fallback_time = datetime.now(pytz.UTC).timestamp()
+        
+        # Группируем точки по (сутки, устройство), чтобы дописать каждый файл одним блоком
+        batches: Dict[tuple, List[tuple]] = {}
+        for position in positions:
+            device_number = position.get('deviceNumber')
+            lat, lng = position.get('lat'), position.get('lng')
+            if device_number is None or lat is None or lng is None:
+                continue
+            timestamp_ms = position.get('time')
+            timestamp = int(timestamp_ms / 1000) if timestamp_ms else int(fallback_time)
+            day_start = _day_start(timestamp)
+            batches.setdefault((day_start, str(device_number)), []).append(
+                (timestamp - day_start, float(lat), float(lng), float(position.get('speed') or 0))
+            )
+        
+        written = 0
+        with self._lock:
+            for (day_start, device_number), points in batches.items():
+                last_offset = self._last_offset(day_start, device_number)
+                points.sort()
+                fresh = []
+                for point in points:
+                    if last_offset is None or point[0] > last_offset:
+                        fresh.append(point)
+                        last_offset = point[0]
+                if not fresh:
+                    continue
+                
+                os.makedirs(os.path.join(self.root, _day_name(day_start)), exist_ok=True)
+                columns = list(zip(*fresh))
+                try:
+                    for (column, dtype), values in zip(COLUMNS.items(), columns):
+                        with open(self._path(day_start, device_number, column), 'ab') as f:
+                            f.write(np.asarray(values, dtype=dtype).tobytes())
+                except Exception:
+                    # Часть колонок могла дописаться: следующее дописывание сначала выровняет их (_repair)
+                    self._last_ts.pop((day_start, device_number), None)
+                    raise
+                self._last_ts[(day_start, device_number)] = last_offset
+                written += len(fresh)
+        
+        # Старые сутки больше не дописываются - не держим их в памяти
+        today = _day_start(int(fallback_time))
+        with self._lock:
+            for key in [k for k in self._last_ts if k[0] < today - SECONDS_PER_DAY]:
+                del self._last_ts[key]
+        return written
+    
+    def _open_day(self, day_start: int, device_number: str) -> Optional[Dict[str, np.ndarray]]:
+        """memmap-массивы устройства за сутки (длина по самой короткой колонке)"""
+        arrays = {}
+        for column, dtype in COLUMNS.items():
+            path = self._path(day_start, device_number, column)
+            if not os.path.exists(path) or os.path.getsize(path) < np.dtype(dtype).itemsize:
+                return None
+            arrays[column] = np.memmap(path, dtype=dtype, mode='r')
+        # После сбоя посреди дописывания колонки могут отличаться по длине
+        length = min(len(a) for a in arrays.values())
+        return {column: a[:length] for column, a in arrays.items()}
+    
+    def query(self, device_number: str, start: datetime, end: datetime) -> Dict[str, np.ndarray]:
+        """Точки устройства в окне [start, end]: time (Unix секунды), lat, lng, speed"""
+        start_ts, end_ts = int(start.timestamp()), int(end.timestamp())
+        parts = {'time': [], 'lat': [], 'lng': [], 'speed': []}
+        
+        day_start = _day_start(start_ts)
+        while day_start <= end_ts:
+            arrays = self._open_day(day_start, device_number)
+            if arrays is not None:
+                ts = arrays['ts']
+                lo = np.searchsorted(ts, start_ts - day_start, side='left')
+                hi = np.searchsorted(ts, end_ts - day_start, side='right')
+                if hi > lo:
+                    parts['time'].append(ts[lo:hi].astype(np.int64) + day_start)
+                    parts['lat'].append(np.array(arrays['lat'][lo:hi]))
+                    parts['lng'].append(np.array(arrays['lng'][lo:hi]))
+                    parts['speed'].append(np.array(arrays['spd'][lo:hi]))
+            day_start += SECONDS_PER_DAY
+        
+        empty = {'time': np.int64, 'lat': np.float32, 'lng': np.float32, 'speed': np.float32}
+        return {
+            name: np.concatenate(chunks) if chunks else np.empty(0, dtype=empty[name])
+            for name, chunks in parts.items()
+        }
+    
+    def last_hours(self, device_number: str, hours: float = 24) -> Dict[str, np.ndarray]:
+        """Трек устройства за последние часы"""
+        end = datetime.now(pytz.UTC)
+        return self.query(device_number, end - timedelta(hours=hours), end)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Локальное хранилище снимков состояния автопарка (SQLite)
+После каждого прохода сохраняет объединенные данные по каждому ТС и ID страницы Notion:
+перезапуск прогревается из снимка, а другие процессы читают состояние без LocTracker и Notion
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Файл базы снимков ('' - не сохранять)
+SNAPSHOT_DB_FILE = os.getenv('SNAPSHOT_DB_FILE', 'fleet_snapshot.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vehicles (
+    device_number TEXT PRIMARY KEY,
+    registration  TEXT NOT NULL,
+    page_id       TEXT,
+    database_id   TEXT,
+    state         TEXT NOT NULL,
+    state_hash    TEXT NOT NULL,
+    pass_id       INTEGER NOT NULL,
+    updated_at    REAL NOT NULL,
+    changed_at    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS vehicles_registration ON vehicles (registration);
+CREATE TABLE IF NOT EXISTS passes (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    database_id TEXT,
+    started_at  REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    vehicles    INTEGER NOT NULL,
+    changed     INTEGER NOT NULL,
+    processed   INTEGER NOT NULL,
+    errors      INTEGER NOT NULL
+);
+"""
+
+# Поля, зависящие только от текущего времени: не считаются изменением состояния
+VOLATILE_STATE_KEYS = ('taskEta', 'taskEtas')
+
+def _state_json(state: Dict) -> str:
+    """Каноничный JSON состояния (одинаковые данные - одинаковая строка)"""
+    return json.dumps(state, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str)
+
+def state_hash(state: Dict) -> str:
+    """Хэш состояния ТС без зависящих от времени полей"""
+    stable = {key: value for key, value in state.items() if key not in VOLATILE_STATE_KEYS}
+    return hashlib.blake2b(_state_json(stable).encode('utf-8'), digest_size=16).hexdigest()
+
+class SnapshotStore:
+    """Снимки объединенного состояния ТС по проходам"""
+    
+    def __init__(self, path: str = SNAPSHOT_DB_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        # WAL: читатели не блокируют запись прохода
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self._migrate()
+        self._lock = threading.Lock()
+        self._hashes = {row['device_number']: row['state_hash']
+                        for row in self.connection.execute('SELECT device_number, state_hash FROM vehicles')}
+    
+    def _migrate(self):
+        """Снимки до появления database_id: колонка добавляется, старые строки не прогревают индекс"""
+        columns = {row['name'] for row in self.connection.execute('PRAGMA table_info(vehicles)')}
+        if 'database_id' not in columns:
+            with self.connection:
+                self.connection.execute('ALTER TABLE vehicles ADD COLUMN database_id TEXT')
+    
+    def close(self):
+        self.connection.close()
+    
+    def save_pass(self, records: List[Dict], page_ids: Dict[str, str], started_at: float,
+                  processed: int = 0, errors: int = 0, database_id: Optional[str] = None) -> List[str]:
+        """Сохранить состояние всех ТС за проход одной транзакцией; вернуть изменившиеся устройства"""
+        now = time.time()
+        changed = []
+        with self._lock, self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO passes (database_id, started_at, finished_at, vehicles, changed, processed, errors) '
+                'VALUES (?, ?, ?, ?, 0, ?, ?)',
+                (database_id, started_at, now, len(records), processed, errors)
+            )
+            pass_id = cursor.lastrowid
+            
+            for record in records:
+                device_number = str(record.get('number', record.get('deviceNumber', '')))
+                if not device_number:
+                    continue
+                # Записи прохода - VehicleState; в JSON идет обычный словарь
+                record = dict(record)
+                state = _state_json(record)
+                record_hash = state_hash(record)
+                if self._hashes.get(device_number) != record_hash:
+                    changed.append(device_number)
+                    self._hashes[device_number] = record_hash
+                
+                self.connection.execute(
+                    'INSERT INTO vehicles (device_number, registration, page_id, database_id, state, state_hash, '
+                    'pass_id, updated_at, changed_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT(device_number) DO UPDATE SET '
+                    'registration = excluded.registration, '
+                    # Прежний ID страницы годится только для той же базы Notion
+                    'page_id = CASE WHEN excluded.page_id IS NOT NULL THEN excluded.page_id '
+                    'WHEN vehicles.database_id IS excluded.database_id THEN vehicles.page_id END, '
+                    'database_id = excluded.database_id, '
+                    'pass_id = excluded.pass_id, updated_at = excluded.updated_at, '
+                    'state = excluded.state, '
+                    'changed_at = CASE WHEN vehicles.state_hash = excluded.state_hash THEN vehicles.changed_at ELSE excluded.changed_at END, '
+                    'state_hash = excluded.state_hash',
+                    (device_number, str(record.get('registrationNumber', '')).strip(),
+                     page_ids.get(device_number), database_id, state, record_hash, pass_id, now, now)
+                )
+            
+            self.connection.execute('UPDATE passes SET changed = ? WHERE id = ?', (len(changed), pass_id))
+        
+        logger.info(f"🗄️ Снимок сохранен: {len(records)} ТС, изменилось {len(changed)}")
+        return changed
+    
+    def load_states(self) -> Dict[str, Dict]:
+        """Последнее состояние каждого ТС: номер устройства -> объединенные данные"""
+        with self._lock:
+            rows = self.connection.execute('SELECT device_number, state FROM vehicles').fetchall()
+        return {row['device_number']: json.loads(row['state']) for row in rows}
+    
+    def get_vehicle(self, device_number: str) -> Optional[Dict]:
+        """Последнее состояние одного ТС"""
+        with self._lock:
+            row = self.connection.execute('SELECT state FROM vehicles WHERE device_number = ?',
+                                          (str(device_number),)).fetchone()
+        return json.loads(row['state']) if row else None
+    
+    def load_page_index(self, database_id: Optional[str] = None) -> Tuple[List[Dict], Optional[float]]:
+        """Страницы Notion из снимка и время начала последнего прохода для этой базы"""
+        with self._lock:
+            rows = self.connection.execute(
+                'SELECT device_number, registration, page_id FROM vehicles '
+                'WHERE page_id IS NOT NULL AND database_id IS ?', (database_id,)
+            ).fetchall()
+            last_pass = self.connection.execute(
+                'SELECT started_at FROM passes WHERE database_id IS ? ORDER BY id DESC LIMIT 1', (database_id,)
+            ).fetchone()
+        pages = [{'id': row['page_id'], 'name': row['registration'], 'device': row['device_number']} for row in rows]
+        return pages, (last_pass['started_at'] if last_pass else None)
+
+def read_fleet_state(path: str = SNAPSHOT_DB_FILE) -> Dict[str, Dict[str, Any]]:
+    """Прочитать текущее состояние автопарка из снимка (только чтение, для других процессов)"""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = connection.execute('SELECT device_number, page_id, state, updated_at FROM vehicles').fetchall()
+    finally:
+        connection.close()
+    return {
+        device_number: {'pageId': page_id, 'updatedAt': updated_at, **json.loads(state)}
+        for device_number, page_id, state, updated_at in rows
+    }
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Потоковая синхронизация LocTracker -> Notion
+Этапы загрузка -> объединение -> преобразование -> запись работают одновременно
+и связаны ограниченными очередями: первые ТС попадают в Notion, пока остальные
+еще загружаются, а длительность прохода стремится к самому медленному этапу
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from activity_stream import ActivityStream, latest_by_device
+from fleet_geo import apply_task_distances
+from snapshot_store import SNAPSHOT_DB_FILE, SnapshotStore
+from position_history import POSITION_HISTORY_DIR, PositionHistory
+from sync_metrics import METRICS, record_pass, with_pass_labels
+from sync_priority import SYNC_ORDER
+from change_gate import CHANGE_GATE_ENABLED, ChangeGate
+from task_geofence import GEOFENCE_ENABLED, GeofenceTracker
+from notion_outbox import NOTION_OUTBOX_FILE, NotionOutbox
+from vehicle_state import VehicleStates
+from sync_dispatcher_data import (
+    ACTIVITY_STREAM_ENABLED,
+    SYNC_WORKERS,
+    DispatcherNotionSync,
+    LocTrackerAPI,
+    _build_fleet_tasks_dict,
+    _detect_arrivals,
+    _fetch_device_extras,
+    _flush_outbox,
+    _gate_vehicles,
+    _merge_device_data,
+    _plan_priority,
+    _prepare_payloads,
+    _record_positions,
+    _report_writes,
+    _roster,
+)
+
+logger = logging.getLogger(__name__)
+
+# Емкость очередей между этапами (при заполнении предыдущий этап ждет)
+STREAM_QUEUE_SIZE = int(os.getenv('STREAM_QUEUE_SIZE', '64'))
+# Сколько ТС преобразуется за раз (расстояния и свойства Notion считаются пачкой)
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', '25'))
+
+# Признак конца потока данных в очереди
+_DONE = object()
+
+def _start_stage(name: str, func: Callable[[List], List], inbox: queue.Queue,
+                 outbox: Optional[queue.Queue], threads: int = 1, batch_size: int = 1) -> List[threading.Thread]:
+    """Запустить этап: потоки берут из inbox до batch_size элементов, результаты func кладут в outbox
+    
+    _DONE каждый поток возвращает в inbox для соседей по этапу,
+    последний завершившийся поток передает его следующему этапу
+    """
+    remaining = [threads]
+    lock = threading.Lock()
+    
+    def take() -> Tuple[List, bool]:
+        items = [inbox.get()]
+        while items[-1] is not _DONE and len(items) < batch_size:
+            try:
+                items.append(inbox.get_nowait())
+            except queue.Empty:
+                break
+        if items[-1] is _DONE:
+            inbox.put(_DONE)
+            return items[:-1], True
+        return items, False
+    
+    def run():
+        finished = False
+        while not finished:
+            items, finished = take()
+            if not items:
+                continue
+            try:
+                results = func(items)
+            except Exception as e:
+                # Поток этапа не должен падать: иначе очереди выше заполнятся навсегда
+                logger.error(f"Ошибка этапа {name}: {e}")
+                continue
+            if outbox is not None:
+                for result in results:
+                    outbox.put(result)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and outbox is not None:
+            outbox.put(_DONE)
+    
+    workers = [threading.Thread(target=with_pass_labels(run), name=f"stream-{name}-{i}", daemon=True) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+def stream_sync_dispatcher_data(workers: Optional[int] = None, loctracker: Optional[LocTrackerAPI] = None,
+                                notion: Optional[DispatcherNotionSync] = None,
+                                store: Optional[SnapshotStore] = None,
+                                history: Optional[PositionHistory] = None,
+                                gate: Optional[ChangeGate] = None,
+                                activity_stream: Optional[ActivityStream] = None,
+                                geofence: Optional[GeofenceTracker] = None,
+                                outbox: Optional[NotionOutbox] = None,
+                                states: Optional[VehicleStates] = None) -> Optional[Dict[str, Any]]:
+    """Потоковый проход синхронизации (аналог sync_dispatcher_data)"""
+    logger.info("="*50)
+    logger.info("🚀 Начало потоковой синхронизации данных диспетчера")
+    started_at = time.monotonic()
+    
+    if workers is None:
+        workers = SYNC_WORKERS
+    workers = max(1, workers)
+    
+    owns_loctracker = loctracker is None
+    if loctracker is None:
+        loctracker = LocTrackerAPI()
+    if notion is None:
+        notion = DispatcherNotionSync()
+    owns_store = store is None and bool(SNAPSHOT_DB_FILE)
+    if owns_store:
+        store = SnapshotStore(SNAPSHOT_DB_FILE)
+    owns_outbox = outbox is None and bool(NOTION_OUTBOX_FILE)
+    if owns_outbox:
+        outbox = NotionOutbox(notion)
+    skipped_before = notion.skipped_writes
+    pass_started_at = time.time()
+    if activity_stream is None and ACTIVITY_STREAM_ENABLED:
+        activity_stream = ActivityStream(loctracker)
+    
+    def refresh_index(devices_future):
+        try:
+            if store:
+                # Прогрев из снимка - только если он покрывает текущий автопарк
+                notion.seed_page_index(*store.load_page_index(notion.database_id),
+                                       _roster(devices_future.result()))
+            notion.refresh_page_index()
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке индекса страниц: {e}")
+    
+    try:
+        with ThreadPoolExecutor(max_workers=6, thread_name_prefix='stream-fleet') as executor:
+            # Общие запросы к LocTracker - одновременно, а не друг за другом
+            fetch_started = time.perf_counter()
+            devices_future = executor.submit(loctracker.get_devices)
+            # Индекс Notion догружается в фоне, пока идут загрузка и преобразование
+            index_future = executor.submit(with_pass_labels(refresh_index), devices_future)
+            positions_future = executor.submit(loctracker.get_positions)
+            tacho_future = executor.submit(loctracker.get_tachograph_state)
+            fleet_future = executor.submit(loctracker.get_fleet_state)
+            activities_future = executor.submit(activity_stream.poll) if activity_stream else None
+            
+            devices = devices_future.result()
+            positions = positions_future.result()
+            tachographs = tacho_future.result()
+            fleet_state = fleet_future.result()
+            activities = activities_future.result() if activities_future else []
+            METRICS.observe_stage('fetch_fleet', time.perf_counter() - fetch_started)
+            if not devices:
+                logger.error("Не удалось получить список устройств")
+                return None
+            if not positions:
+                logger.error("Не удалось получить позиции")
+                return None
+            
+            if history is None and POSITION_HISTORY_DIR:
+                history = PositionHistory(POSITION_HISTORY_DIR)
+            _record_positions(history, positions, pass_started_at)
+            
+            fleet_tasks_dict = _build_fleet_tasks_dict(fleet_state)
+            positions_dict = {p['deviceNumber']: p for p in positions}
+            tacho_dict = {t['deviceNumber']: t for t in (tachographs or []) if 'deviceNumber' in t}
+            activities_dict = latest_by_device(activities)
+            # Прибытия к задачам - по геозонам для всего автопарка, без запросов по ТС
+            if geofence is None and GEOFENCE_ENABLED:
+                geofence = GeofenceTracker()
+            arrivals_dict = _detect_arrivals(geofence, positions, fleet_tasks_dict)
+            
+            vehicles = [d for d in devices if d.get('registrationNumber', '').strip()]
+            if states is not None:
+                states.prune(vehicles)
+            # Запросы по ТС и запись - только для изменившихся (или давно не обновлявшихся) ТС
+            if gate is None and CHANGE_GATE_ENABLED:
+                gate = ChangeGate()
+            vehicles, gated_count = _gate_vehicles(gate, vehicles, positions_dict, tacho_dict,
+                                                   fleet_tasks_dict, activities_dict, arrivals_dict)
+            if activity_stream:
+                # Активности устройств без записи в этом проходе не держат курсор
+                activity_stream.ack_others(device.get('number') for device in vehicles)
+            # Срочные ТС (скоро пауза по тахографу) идут в конвейер первыми
+            plan = None
+            if SYNC_ORDER == 'priority':
+                plan = _plan_priority(notion, vehicles, positions_dict, tacho_dict, fleet_tasks_dict)
+                vehicles = plan.ordered
+            records: List[Optional[Dict]] = [None] * len(vehicles)
+            results = [False] * len(vehicles)
+            first_write = threading.Event()
+            
+            def fetch(items: List) -> List:
+                fetched = []
+                for index, device in items:
+                    device_number = device.get('number')
+                    registration = device.get('registrationNumber', '').strip()
+                    logger.info(f"📦 Обработка {registration}...")
+                    try:
+                        with METRICS.stage('fetch_device'):
+                            extras = _fetch_device_extras(loctracker, device_number, registration,
+                                                          fleet_tasks_dict.get(device_number))
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки устройства {device_number}: {e}")
+                        continue
+                    fetched.append((index, device, extras))
+                return fetched
+            
+            def merge(items: List) -> List:
+                merged = []
+                for index, device, extras in items:
+                    device_number = device.get('number')
+                    try:
+                        with METRICS.stage('merge'):
+                            records[index] = _merge_device_data(device, positions_dict.get(device_number),
+                                                                tacho_dict.get(device_number), extras,
+                                                                activities_dict.get(str(device_number)),
+                                                                arrivals_dict.get(str(device_number)),
+                                                                states.acquire(device_number) if states is not None else None)
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки устройства {device_number}: {e}")
+                        continue
+                    merged.append((index, records[index]))
+                return merged
+            
+            def transform(items: List) -> List:
+                batch = [record for _, record in items]
+                with METRICS.stage('distances'):
+                    apply_task_distances(batch)
+                payloads = _prepare_payloads(notion, batch, batch)
+                return [(index, record, properties) for (index, record), properties in zip(items, payloads)]
+            
+            written: List[str] = []
+            
+            def synced(record: Dict, fingerprint: Optional[str], activity_id: Optional[int]):
+                """Учесть подтвержденную запись ТС в Notion - из прохода или из потока выгрузки очереди"""
+                written.append(str(record.get('number')))
+                if gate:
+                    gate.mark_synced(record, fingerprint=fingerprint)
+                if plan:
+                    plan.observe_write(record, time.monotonic() - started_at)
+                if activity_stream:
+                    activity_stream.ack(record.get('number'), activity_id)
+                if not first_write.is_set():
+                    first_write.set()
+                    elapsed = time.monotonic() - started_at
+                    METRICS.set('sync_first_write_seconds', elapsed)
+                    logger.info(f"🥇 Первая запись в Notion через {elapsed:.1f} с")
+            
+            def write(items: List) -> List:
+                # Поиск страниц возможен только после загрузки индекса
+                if not outbox:
+                    index_future.result()
+                for index, record, properties in items:
+                    fingerprint = gate.pending_fingerprint(record) if gate else None
+                    activity_id = (activities_dict.get(str(record.get('number'))) or {}).get('id')
+                    if outbox:
+                        # Запись в Notion - из очереди, срочные ТС выгружаются первыми; отпечаток,
+                        # SLO и подтверждение активностей учитываются только после настоящей записи
+                        results[index] = outbox.enqueue(
+                            record, properties, plan.rank(record) if plan else 0,
+                            on_written=lambda data, fp=fingerprint, ai=activity_id: synced(data, fp, ai)
+                        )
+                        continue
+                    with METRICS.stage('notion_write'):
+                        results[index] = notion.update_or_create_entry(record, properties)
+                    if results[index]:
+                        synced(record, fingerprint, activity_id)
+                return []
+            
+            device_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+            extras_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+            record_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+            payload_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+            
+            logger.info(f"⚙️ Воркеров: {workers}, устройств: {len(vehicles)}, "
+                        f"очередь {STREAM_QUEUE_SIZE}, пачка {STREAM_BATCH_SIZE}")
+            stage_threads = (
+                _start_stage('fetch', fetch, device_queue, extras_queue, threads=workers)
+                + _start_stage('merge', merge, extras_queue, record_queue)
+                + _start_stage('transform', transform, record_queue, payload_queue,
+                               batch_size=max(1, STREAM_BATCH_SIZE))
+                + _start_stage('write', write, payload_queue, None, threads=workers)
+            )
+            # Очередь ограничена: если запись отстает, загрузка новых ТС ждет
+            for item in enumerate(vehicles):
+                device_queue.put(item)
+            device_queue.put(_DONE)
+            for thread in stage_threads:
+                thread.join()
+        
+        # Выгрузка очереди подтверждает записанные ТС до сохранения курсора и отпечатков
+        queued_count = _flush_outbox(outbox)
+        if activity_stream:
+            # Курсор сдвигаем только до активностей, уже записанных в Notion
+            activity_stream.commit()
+        if gate:
+            gate.save()
+        if geofence:
+            geofence.learn_tasks(records)
+            geofence.save()
+        
+        processed_count = sum(1 for success in results if success)
+        error_count = len(results) - processed_count
+        written_count = len(written)
+        enqueued_count = processed_count if outbox else 0
+        
+        # Снимок состояния автопарка и ID страниц
+        if store:
+            try:
+                saved = [r for r in records if r is not None]
+                page_ids = {str(r.get('number')): notion.page_id_for(r) for r in saved}
+                with METRICS.stage('snapshot'):
+                    store.save_pass(saved, {k: v for k, v in page_ids.items() if v}, pass_started_at,
+                                    processed_count, error_count, notion.database_id)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения снимка: {e}")
+    finally:
+        notion.save_state()
+        loctracker.cache.purge()
+        # Все, что проход создал сам, закрывается и при раннем выходе
+        if owns_loctracker:
+            loctracker.close()
+        if owns_outbox:
+            outbox.close()
+        if owns_store:
+            store.close()
+    
+    for device, success in zip(vehicles, results):
+        registration = device.get('registrationNumber', '').strip()
+        if success:
+            logger.info(f"✅ Обработано: {registration}")
+        else:
+            logger.error(f"❌ Ошибка обработки: {registration}")
+    
+    skipped_count = notion.skipped_writes - skipped_before
+    duration = time.monotonic() - started_at
+    logger.info("="*50)
+    logger.info(f"✅ Синхронизация завершена!")
+    logger.info(f"📊 Обработано: {processed_count}")
+    logger.info(f"❌ Ошибок: {error_count}")
+    logger.info(f"⏭️ Без изменений (запись пропущена): {skipped_count}")
+    logger.info(f"💤 Без изменений (не запрашивались): {gated_count}")
+    if outbox:
+        logger.info(f"📮 Поставлено в очередь: {enqueued_count}, записано в Notion: {written_count}, "
+                    f"ожидают записи: {queued_count}"
+                    + (" (очередь выгружает фоновый поток - учтены записи, подтвержденные к концу прохода)"
+                       if outbox.draining else ""))
+    logger.info(f"⏱️ Длительность прохода: {duration:.1f} с")
+    record_pass(duration, written_count, error_count, skipped_count, gated_count, enqueued_count)
+    _report_writes(outbox, plan, gate)
+    logger.info(f"🔗 База данных: https://www.notion.so/{notion.database_id.replace('-', '')}")
+    logger.info("="*50)
+    
+    return {
+        'processed': processed_count,
+        'errors': error_count,
+        'skipped': skipped_count,
+        'gated': gated_count,
+        'enqueued': enqueued_count,
+        'written': written_count,
+        'queued': queued_count,
+        'duration': duration,
+    }
+
+def main():
+    """Главная функция"""
+    try:
+        stream_sync_dispatcher_data()
+    except Exception as e:
+        logger.error(f"Критическая ошибка: {e}")
+        raise
+
+if __name__ == "__main__":
+    main()
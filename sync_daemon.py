@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Резидентный демон синхронизации LocTracker -> Notion
+Держит клиенты, индекс страниц и соединения прогретыми и запускает проходы
+с фиксированным интервалом вместо запуска нового процесса из cron
+"""
+
+import os
+import signal
+import time
+import threading
+import logging
+from typing import Optional
+
+from snapshot_store import SNAPSHOT_DB_FILE, SnapshotStore
+from position_history import POSITION_HISTORY_DIR, PositionHistory
+from activity_stream import ActivityStream
+from sync_dispatcher_data import ACTIVITY_STREAM_ENABLED, LocTrackerAPI, DispatcherNotionSync, sync_dispatcher_data
+from sync_metrics import METRICS, METRICS_PORT
+from stream_sync import stream_sync_dispatcher_data
+from change_gate import CHANGE_GATE_ENABLED, ChangeGate
+from task_geofence import GEOFENCE_ENABLED, GeofenceTracker
+from notion_outbox import NOTION_OUTBOX_FILE, NotionOutbox
+from vehicle_state import VehicleStates
+
+logger = logging.getLogger(__name__)
+
+# Интервал между началами проходов (секунды)
+SYNC_INTERVAL_SECONDS = float(os.getenv('SYNC_INTERVAL_SECONDS', '60'))
+# Конвейер прохода: batch - этапы по очереди, stream - одновременно через очереди (stream_sync.py)
+SYNC_PIPELINE = os.getenv('SYNC_PIPELINE', 'batch')
+
+class SyncDaemon:
+    """Планировщик проходов синхронизации с фиксированным шагом"""
+    
+    def __init__(self, interval: float = SYNC_INTERVAL_SECONDS, workers: Optional[int] = None):
+        self.interval = interval
+        self.workers = workers
+        self.metrics_port = METRICS_PORT
+        self.stop_event = threading.Event()
+        
+        # Клиенты создаются один раз и живут весь срок работы процесса
+        self._create_clients()
+        
+        self.passes = 0
+        self.skipped_ticks = 0
+    
+    def _create_clients(self):
+        self.loctracker = LocTrackerAPI()
+        self.notion = DispatcherNotionSync()
+        self.store = SnapshotStore(SNAPSHOT_DB_FILE) if SNAPSHOT_DB_FILE else None
+        self.history = PositionHistory(POSITION_HISTORY_DIR) if POSITION_HISTORY_DIR else None
+        self.gate = ChangeGate() if CHANGE_GATE_ENABLED else None
+        self.geofence = GeofenceTracker() if GEOFENCE_ENABLED else None
+        # Записи в Notion выгружает фоновый поток: проходы не ждут Notion
+        self.outbox = NotionOutbox(self.notion) if NOTION_OUTBOX_FILE else None
+        if self.outbox:
+            self.outbox.start_drainer()
+        # Записи ТС заполняются на месте из прохода в проход (память не растет)
+        self.states = VehicleStates()
+        # Курсор ленты активностей один на процесс: подтверждения из фоновой выгрузки
+        # приходят в тот же объект, чей commit() выполняет следующий проход
+        self.activity_stream = ActivityStream(self.loctracker) if ACTIVITY_STREAM_ENABLED else None
+    
+    def stop(self, signum=None, frame=None):
+        """Запросить остановку после текущего прохода"""
+        if signum is not None:
+            logger.info(f"⏹️ Получен сигнал {signal.Signals(signum).name}, завершаем после текущего прохода")
+        self.stop_event.set()
+    
+    def install_signal_handlers(self):
+        """Корректно завершаться по SIGTERM/SIGINT"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+    
+    def run_once(self):
+        """Выполнить один проход, не роняя демон при ошибке"""
+        started = time.monotonic()
+        try:
+            self._run_pass()
+        except Exception as e:
+            logger.error(f"❌ Ошибка прохода синхронизации: {e}")
+        self.passes += 1
+        # Какую часть интервала занял проход (>= 1 - проход не укладывается в интервал)
+        METRICS.set('sync_pass_interval_ratio', (time.monotonic() - started) / self.interval)
+    
+    def _run_pass(self):
+        run_pass = stream_sync_dispatcher_data if SYNC_PIPELINE == 'stream' else sync_dispatcher_data
+        run_pass(workers=self.workers, loctracker=self.loctracker,
+                 notion=self.notion, store=self.store, history=self.history, gate=self.gate,
+                 activity_stream=self.activity_stream, geofence=self.geofence, outbox=self.outbox,
+                 states=self.states)
+    
+    def run(self):
+        """Главный цикл: проходы по сетке интервалов, пропуск (а не накопление) опоздавших"""
+        logger.info(f"🚀 Демон синхронизации запущен, интервал {self.interval:.0f} с")
+        METRICS.set('sync_interval_seconds', self.interval)
+        if self.metrics_port:
+            METRICS.start_http_server(self.metrics_port)
+        next_run = time.monotonic()
+        
+        try:
+            while not self.stop_event.is_set():
+                wait = next_run - time.monotonic()
+                if wait > 0 and self.stop_event.wait(wait):
+                    break
+                
+                self.run_once()
+                
+                next_run += self.interval
+                now = time.monotonic()
+                if now > next_run:
+                    # Проход не уложился в интервал: пропускаем пропущенные слоты
+                    missed = int((now - next_run) // self.interval) + 1
+                    next_run += missed * self.interval
+                    self.skipped_ticks += missed
+                    METRICS.inc('sync_skipped_ticks_total', missed)
+                    logger.warning(f"⚠️ Проход превысил интервал {self.interval:.0f} с, пропущено запусков: {missed}")
+        finally:
+            self.shutdown()
+    
+    def shutdown(self):
+        """Сохранить состояние и закрыть соединения"""
+        if self.outbox:
+            self.outbox.stop_drainer()
+            self.outbox.close()
+        self.notion.save_state()
+        self.loctracker.close()
+        if self.store:
+            self.store.close()
+        logger.info(f"👋 Демон остановлен. Проходов: {self.passes}, пропущено запусков: {self.skipped_ticks}")
+
+def main():
+    """Главная функция"""
+    daemon = SyncDaemon()
+    daemon.install_signal_handlers()
+    daemon.run()
+
+if __name__ == "__main__":
+    main()
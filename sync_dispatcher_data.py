@@ -6,15 +6,36 @@
 
 import os
 import json
+import functools
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterable, List, Optional, Any
 from dotenv import load_dotenv
-from notion_client import Client
+import httpx
+from notion_client import Client, APIErrorCode, APIResponseError
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
 import pytz
 import time
 import math
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loctracker_cache import (LOCTRACKER_BODY_MEMO_SOURCES, BodyMemo, NegativeCache, TTLCache, classify_failure,
+                              load_refresh_intervals)
+from fleet_geo import EARTH_RADIUS_KM, ROAD_FACTOR, apply_task_distances
+from activity_stream import ActivityStream, latest_by_device
+from snapshot_store import SNAPSHOT_DB_FILE, SnapshotStore
+from notion_payloads import (column, delay_minutes, driving_times, fallback_etas, fuel_liters,
+                             timestamps_iso, utilizations)
+from position_history import POSITION_HISTORY_DIR, PositionHistory
+from sync_metrics import METRICS, record_pass, with_pass_labels
+from sync_priority import SYNC_ORDER, PriorityPlan
+from change_gate import CHANGE_GATE_ENABLED, ChangeGate
+from task_geofence import GEOFENCE_ENABLED, GeofenceTracker, task_key
+from notion_outbox import NOTION_OUTBOX_FILE, NotionOutbox
+from vehicle_state import VehicleState, VehicleStates
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -29,117 +50,281 @@ logger = logging.getLogger(__name__)
 # ID созданной базы данных диспетчера (обновлено с новыми полями)
 DISPATCHER_DATABASE_ID = "262c3f4a-118b-812c-a535-f0fd1ae50550"
 
+# Количество параллельных воркеров для обогащения устройств (1 = последовательно)
+SYNC_WORKERS = int(os.getenv('SYNC_WORKERS', '8'))
+
+# Инкрементальная лента активностей (один запрос на проход для всего автопарка)
+ACTIVITY_STREAM_ENABLED = os.getenv('ACTIVITY_STREAM_ENABLED', '1') == '1'
+
+# Параметры HTTP-сессии LocTracker (пул соединений и таймауты в секундах)
+LOCTRACKER_POOL_SIZE = int(os.getenv('LOCTRACKER_POOL_SIZE', str(max(SYNC_WORKERS, 10))))
+LOCTRACKER_CONNECT_TIMEOUT = float(os.getenv('LOCTRACKER_CONNECT_TIMEOUT', '5'))
+LOCTRACKER_READ_TIMEOUT = float(os.getenv('LOCTRACKER_READ_TIMEOUT', '30'))
+
+# Файл с последними записанными в Notion свойствами (для отправки только изменений)
+NOTION_STATE_FILE = os.getenv('NOTION_STATE_FILE', '.notion_state.json')
+# Как часто обновлять запись без изменений, чтобы освежить 🔄 Update (секунды)
+NOTION_HEARTBEAT_SECONDS = int(os.getenv('NOTION_HEARTBEAT_SECONDS', '900'))
+# Свойства, зависящие только от текущего времени: сами по себе запись не вызывают
+HEARTBEAT_PROPERTIES = ('🔄 Update', '⏱️ ETA', '📊 Auslastung')
+
+# Адрес Notion API (локальная заглушка для бенчмарков и тестов)
+NOTION_BASE_URL = os.getenv('NOTION_BASE_URL', 'https://api.notion.com')
+
+# Лимит запросов к Notion (в среднем ~3 запроса/сек на интеграцию) и повторы
+NOTION_RATE_LIMIT = float(os.getenv('NOTION_RATE_LIMIT', '3'))
+NOTION_MAX_RETRIES = int(os.getenv('NOTION_MAX_RETRIES', '5'))
+NOTION_BACKOFF_BASE = 0.5
+NOTION_BACKOFF_MAX = 30.0
+# Неидемпотентные методы: повтор после запроса, дошедшего до Notion, создаст дубликат страницы
+NOTION_NON_IDEMPOTENT_METHODS = ('pages.create',)
+
+class RateLimiter:
+    """Token bucket, общий для всех потоков; поддерживает паузу по Retry-After"""
+    
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Дождаться токена"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated_at) * self.rate)
+                self.updated_at = max(now, self.updated_at)
+                if now < self.paused_until:
+                    # Во время паузы токены не накапливаются
+                    self.tokens = 0
+                    self.updated_at = self.paused_until
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+    
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов для всех потоков (например, после 429)"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+def _observe_body(endpoint: str, size: int, decode_seconds: float, unchanged: bool):
+    """Метрики тела ответа LocTracker: объем и время разбора (или повтор без разбора)"""
+    METRICS.inc('loctracker_response_bytes_total', size, endpoint=endpoint)
+    METRICS.set('loctracker_last_response_bytes', size, endpoint=endpoint)
+    if unchanged:
+        METRICS.inc('loctracker_unchanged_bodies_total', endpoint=endpoint)
+    else:
+        METRICS.observe('loctracker_decode_seconds', decode_seconds, endpoint=endpoint)
+
+def _drive(steps, perform) -> Any:
+    """Выполнить генератор шагов: каждый отданный запрос выполняет perform,
+    результат или ошибка возвращаются в генератор; значение return генератора - итог"""
+    try:
+        request = next(steps)
+        while True:
+            try:
+                result = perform(*request)
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(result)
+    except StopIteration as done:
+        return done.value
+
+def _with_transport(steps_method):
+    """Метод-генератор шагов -> метод клиента
+    
+    Генератор отдает запросы (yield) и получает ответы; выполняет их self._run - синхронно
+    у LocTrackerAPI и DispatcherNotionSync, через await у асинхронных клиентов. Так логика
+    кэша, метрик, разбора и поиска страниц одна, а различается только транспорт.
+    """
+    @functools.wraps(steps_method)
+    def method(self, *args, **kwargs):
+        return self._run(steps_method(self, *args, **kwargs))
+    return method
+
 class LocTrackerAPI:
-    """Класс для работы с LocTracker API"""
+    """Класс для работы с LocTracker API
+    
+    Учетная запись по умолчанию берется из окружения; для нескольких учетных
+    записей в одном процессе (tenant_sync.py) она передается явно.
+    """
     
-    def __init__(self):
-        self.username = os.getenv('VITE_LOCTRACKER_USERNAME', '37010032240')
-        self.password = os.getenv('VITE_LOCTRACKER_PASSWORD', 'Frei-Disposition!?2025')
-        self.base_url = os.getenv('VITE_LOCTRACKER_API_URL', 'https://locator.lt/LoctrackerFieldService/REST/v1')
+    def __init__(self, username: Optional[str] = None, password: Optional[str] = None,
+                 base_url: Optional[str] = None):
+        self._configure(username, password, base_url)
+        self.timeout = (LOCTRACKER_CONNECT_TIMEOUT, LOCTRACKER_READ_TIMEOUT)
+        self.session = self._create_session(LOCTRACKER_POOL_SIZE)
         
         logger.info(f"Подключение к LocTracker API для пользователя: {self.username}")
-        
+    
+    def _configure(self, username: Optional[str], password: Optional[str], base_url: Optional[str]):
+        """Учетная запись и кэши, общие для синхронного и асинхронного клиента"""
+        self.username = username or os.getenv('VITE_LOCTRACKER_USERNAME', '37010032240')
+        self.password = password or os.getenv('VITE_LOCTRACKER_PASSWORD', 'Frei-Disposition!?2025')
+        self.base_url = base_url or os.getenv('VITE_LOCTRACKER_API_URL', 'https://locator.lt/LoctrackerFieldService/REST/v1')
+        
+        # Многоуровневый опрос: у каждого источника свой интервал обновления
+        self.cache = TTLCache(load_refresh_intervals())
+        # Пауза для эндпоинтов, которые для конкретного устройства постоянно падают
+        self.negative_cache = NegativeCache()
+        # Побайтно повторившиеся тела больших ответов не декодируются заново
+        self.body_memo = BodyMemo(LOCTRACKER_BODY_MEMO_SOURCES.split(','))
+    
+    @staticmethod
+    def _create_session(pool_size: int) -> requests.Session:
+        """Создать общую keep-alive сессию с пулом соединений"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        return session
+    
+    def _run(self, steps) -> Any:
+        """Выполнить шаги запроса через общую сессию"""
+        return _drive(steps, self._send)
+    
+    def _send(self, url: str, query: Dict) -> bytes:
+        """Один GET-запрос, возвращает тело ответа"""
+        response = self.session.get(url, params=query, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+    
+    def _get_steps(self, path: str, params: Optional[Dict] = None, source: Optional[str] = None,
+                   device: Optional[str] = None):
+        """GET-запрос к LocTracker, возвращает JSON
+        
+        Если указан source, ответ кэшируется на интервал обновления этого источника.
+        Если указан device, ошибки запоминаются и повтор откладывается (BackoffActive).
+        """
+        cache_key = (path, tuple(sorted(params.items()))) if params else path
+        endpoint = source or path
+        if source:
+            found, data = self.cache.get(source, cache_key)
+            if found:
+                METRICS.inc('loctracker_requests_total', endpoint=endpoint, result='cached')
+                return data
+        if device:
+            self.negative_cache.check(endpoint, str(device))
+        
+        url = f"{self.base_url}/{self.username}/{path}"
+        query = {'password': self.password}
+        if params:
+            query.update(params)
+        
+        started = time.perf_counter()
+        try:
+            content = yield url, query
+            decode_started = time.perf_counter()
+            data, unchanged = self.body_memo.decode(source, cache_key, content)
+            _observe_body(endpoint, len(content), time.perf_counter() - decode_started, unchanged)
+        except Exception as e:
+            METRICS.observe('loctracker_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+            METRICS.inc('loctracker_requests_total', endpoint=endpoint, result=classify_failure(e))
+            if device:
+                self.negative_cache.record_failure(endpoint, str(device), e)
+            raise
+        METRICS.observe('loctracker_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+        METRICS.inc('loctracker_requests_total', endpoint=endpoint, result='ok')
+        
+        if device:
+            self.negative_cache.record_success(endpoint, str(device))
+        if source:
+            self.cache.set(source, cache_key, data)
+        return data
+    
+    _get = _with_transport(_get_steps)
+    
+    def close(self):
+        """Закрыть пул соединений"""
+        self.session.close()
+    
+    @_with_transport
     def get_devices(self) -> Optional[List[Dict]]:
         """Получить список всех устройств"""
         try:
-            url = f"{self.base_url}/{self.username}/devices"
-            params = {'password': self.password}
-            
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = yield from self._get_steps("devices", source='devices')
             devices = data.get('devices', data) if isinstance(data, dict) else data
             logger.info(f"Получено {len(devices)} устройств")
             return devices
-            
+        
         except Exception as e:
             logger.error(f"Ошибка при получении устройств: {e}")
             return None
     
+    @_with_transport
     def get_positions(self) -> Optional[List[Dict]]:
         """Получить текущие позиции всех устройств"""
         try:
-            url = f"{self.base_url}/{self.username}/positions"
-            params = {'password': self.password}
-            
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = yield from self._get_steps("positions", source='positions')
             positions = data.get('positions', data) if isinstance(data, dict) else data
             logger.info(f"Получено {len(positions)} позиций")
             return positions
-            
+        
         except Exception as e:
             logger.error(f"Ошибка при получении позиций: {e}")
             return None
     
+    @_with_transport
     def get_device_tasks(self, device_number: str) -> Optional[List[Dict]]:
         """Получить задачи для конкретного устройства"""
         try:
-            url = f"{self.base_url}/{self.username}/tasks/{device_number}/trip"
-            params = {'password': self.password}
-            
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = yield from self._get_steps(f"tasks/{device_number}/trip", source='tasks', device=device_number)
             tasks = data.get('tasks', data) if isinstance(data, dict) else data
             return tasks
-            
+        
         except Exception as e:
             logger.debug(f"Нет задач для устройства {device_number}: {e}")
             return None
     
+    @_with_transport
     def get_active_task(self, device_number: str) -> Optional[Dict]:
         """Получить активную задачу устройства"""
         try:
-            url = f"{self.base_url}/{self.username}/tasks/{device_number}/active"
-            params = {'password': self.password}
-            
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = yield from self._get_steps(f"tasks/{device_number}/active", source='active_task',
+                                              device=device_number)
             return data.get('task', data) if isinstance(data, dict) else data
-            
+        
         except Exception as e:
             logger.debug(f"Нет активной задачи для {device_number}: {e}")
             return None
     
+    @_with_transport
     def get_tachograph_state(self) -> Optional[List]:
         """Получить состояние тахографов для всех устройств"""
         try:
-            url = f"{self.base_url}/{self.username}/tachographs/state"
-            params = {'password': self.password}
-            
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = yield from self._get_steps("tachographs/state", source='tachographs')
             # Правильный ключ - tachographsState, не tachographs
             return data.get('tachographsState', []) if isinstance(data, dict) else []
-            
+        
         except Exception as e:
             logger.debug(f"Нет данных тахографов: {e}")
             return None
     
+    @_with_transport
     def get_fleet_state(self) -> Optional[Dict]:
         """Получить состояние всего автопарка"""
         try:
-            url = f"{self.base_url}/{self.username}/fleet/state"
-            params = {'password': self.password}
-            
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            return response.json()
-            
+            return (yield from self._get_steps("fleet/state", source='fleet_state'))
+        
         except Exception as e:
             logger.debug(f"Ошибка получения состояния автопарка: {e}")
             return None
     
+    @_with_transport
     def get_device_report(self, device_number: str, date_from: str = None, date_to: str = None) -> Optional[Dict]:
         """Получить отчет по устройству за период"""
         try:
@@ -149,70 +334,363 @@ class LocTrackerAPI:
             if not date_to:
                 date_to = datetime.now().strftime('%Y-%m-%d')
             
-            url = f"{self.base_url}/{self.username}/reports/vehicle"
             params = {
-                'password': self.password,
                 'deviceNumber': device_number,
                 'dateFrom': date_from,
                 'dateTo': date_to
             }
             
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            return response.json()
-            
+            return (yield from self._get_steps("reports/vehicle", params, source='reports', device=device_number))
+        
         except Exception as e:
             logger.debug(f"Нет отчета для устройства {device_number}: {e}")
             return None
     
+    @_with_transport
     def get_activities(self, device_number: str) -> Optional[List[Dict]]:
         """Получить активности водителя"""
         try:
-            url = f"{self.base_url}/{self.username}/activities/{device_number}"
-            params = {'password': self.password}
-            
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = yield from self._get_steps(f"activities/{device_number}", source='activities',
+                                              device=device_number)
             return data.get('activities', data) if isinstance(data, dict) else data
-            
+        
         except Exception as e:
             logger.debug(f"Нет активностей для {device_number}: {e}")
             return None
     
+    @_with_transport
+    def get_activity_feed(self, latest_record_id: int = -1, devices: Optional[List[str]] = None,
+                          types: Optional[List[str]] = None) -> Optional[List[Dict]]:
+        """Получить активности всего автопарка новее latestRecordId"""
+        try:
+            params = {'latestRecordId': latest_record_id}
+            if devices:
+                params['devices'] = ';'.join(str(d) for d in devices)
+            if types:
+                params['types'] = ';'.join(types)
+            
+            data = yield from self._get_steps("activities", params, source='activities')
+            return data.get('activities', data) if isinstance(data, dict) else data
+        
+        except Exception as e:
+            logger.error(f"Ошибка при получении ленты активностей: {e}")
+            return None
+    
+    @_with_transport
     def get_fuel_data(self, device_number: str) -> Optional[Dict]:
         """Получить данные по топливу"""
         try:
-            url = f"{self.base_url}/{self.username}/fuel/{device_number}"
-            params = {'password': self.password}
-            
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            return response.json()
-            
+            return (yield from self._get_steps(f"fuel/{device_number}", source='fuel', device=device_number))
+        
         except Exception as e:
             logger.debug(f"Нет данных по топливу для {device_number}: {e}")
             return None
 
 class DispatcherNotionSync:
-    """Класс для синхронизации данных с Notion"""
+    """Класс для синхронизации данных с Notion
+    
+    database_id, api_key и state_file по умолчанию - база диспетчера из окружения.
+    Базы с общим токеном Notion должны делить один rate_limiter: лимит считается на интеграцию.
+    """
+    
+    def __init__(self, database_id: Optional[str] = None, api_key: Optional[str] = None,
+                 state_file: Optional[str] = NOTION_STATE_FILE, rate_limiter: Optional[RateLimiter] = None):
+        self._configure(database_id, api_key, state_file)
+        self.client = Client(auth=self.api_key, base_url=NOTION_BASE_URL)
+        self.rate_limiter = rate_limiter or RateLimiter(NOTION_RATE_LIMIT)
+        self._index_load_lock = threading.Lock()
+        
+        logger.info(f"Подключение к Notion Database: {self.database_id}")
     
-    def __init__(self):
-        self.api_key = os.getenv('NOTION_API_KEY')
+    def _configure(self, database_id: Optional[str], api_key: Optional[str], state_file: Optional[str]):
+        """Индекс страниц и записанные свойства, общие для синхронного и асинхронного клиента"""
+        self.api_key = api_key or os.getenv('NOTION_API_KEY')
         if not self.api_key:
             raise ValueError("NOTION_API_KEY должен быть установлен")
-            
-        self.client = Client(auth=self.api_key)
-        self.database_id = DISPATCHER_DATABASE_ID
         
-        logger.info(f"Подключение к Notion Database: {self.database_id}")
+        self.database_id = database_id or DISPATCHER_DATABASE_ID
+        self.max_retries = NOTION_MAX_RETRIES
+        
+        # Локальный индекс страниц базы: точный номер ТС / номер устройства -> страница
+        self._pages_by_name: Dict[str, Dict] = {}
+        self._pages_by_device: Dict[str, Dict] = {}
+        self._index_synced_at: Optional[datetime] = None
+        self._index_lock = threading.Lock()
+        
+        # Последние записанные свойства по страницам: page_id -> {properties, written_at}
+        self.state_file = state_file
+        self.heartbeat_seconds = NOTION_HEARTBEAT_SECONDS
+        self._written = self._load_state()
+        self._state_lock = threading.Lock()
+        self.skipped_writes = 0
+    
+    def _load_state(self) -> Dict[str, Dict]:
+        """Загрузить последние записанные свойства из локального файла"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            return state.get('pages', {}) if state.get('database_id') == self.database_id else {}
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать {self.state_file}: {e}")
+            return {}
+    
+    def save_state(self):
+        """Сохранить последние записанные свойства (атомарно через временный файл)"""
+        if not self.state_file:
+            return
+        with self._state_lock:
+            payload = json.dumps({'database_id': self.database_id, 'pages': self._written}, ensure_ascii=False)
+        tmp_file = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp_file, self.state_file)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить {self.state_file}: {e}")
+    
+    def _diff_properties(self, page_id: str, properties: Dict) -> Optional[Dict]:
+        """Вернуть только изменившиеся свойства или None, если запись можно пропустить"""
+        with self._state_lock:
+            previous = self._written.get(page_id)
+        if not previous:
+            return properties
+        
+        last_properties = previous['properties']
+        changed = {
+            name: value for name, value in properties.items()
+            if name not in HEARTBEAT_PROPERTIES and last_properties.get(name) != value
+        }
+        heartbeat_due = time.time() - previous['written_at'] >= self.heartbeat_seconds
+        if not changed and not heartbeat_due:
+            return None
+        
+        # Вместе с изменениями всегда обновляем время и зависящие от него поля
+        for name in HEARTBEAT_PROPERTIES:
+            if name in properties:
+                changed[name] = properties[name]
+        return changed
+    
+    def _remember_properties(self, page_id: str, properties: Dict):
+        """Запомнить записанные свойства страницы"""
+        with self._state_lock:
+            previous = self._written.get(page_id, {}).get('properties', {})
+            self._written[page_id] = {
+                'properties': {**previous, **properties},
+                'written_at': time.time()
+            }
+    
+    @staticmethod
+    def _plain_text(prop: Optional[Dict]) -> str:
+        """Извлечь текст из свойства title/rich_text"""
+        if not prop:
+            return ''
+        items = prop.get('title', prop.get('rich_text')) or []
+        return ''.join(item.get('plain_text', item.get('text', {}).get('content', '')) for item in items).strip()
+    
+    def _index_page(self, page: Dict):
+        """Добавить страницу в локальный индекс"""
+        properties = page.get('properties', {})
+        name = self._plain_text(properties.get('🚛 Fahrzeug'))
+        device = self._plain_text(properties.get('📱 Device'))
+        with self._index_lock:
+            if page.get('archived') or page.get('in_trash'):
+                if self._pages_by_name.get(name, {}).get('id') == page['id']:
+                    del self._pages_by_name[name]
+                if self._pages_by_device.get(device, {}).get('id') == page['id']:
+                    del self._pages_by_device[device]
+                return
+            if name:
+                self._pages_by_name[name] = page
+            if device:
+                self._pages_by_device[device] = page
+    
+    def _forget_page(self, page_id: str):
+        """Удалить страницу из локального индекса"""
+        with self._index_lock:
+            for index in (self._pages_by_name, self._pages_by_device):
+                for key in [k for k, v in index.items() if v['id'] == page_id]:
+                    del index[key]
+        with self._state_lock:
+            self._written.pop(page_id, None)
+    
+    @staticmethod
+    def _request_unsent(error: Exception) -> bool:
+        """Запрос точно не ушел в Notion: не удалось установить соединение"""
+        # notion_client заменяет таймауты httpx на RequestTimeoutError, исходная ошибка - в __context__
+        cause = error.__context__ if isinstance(error, RequestTimeoutError) else error
+        return isinstance(cause, (httpx.ConnectError, httpx.ConnectTimeout))
+    
+    def _retry_delay(self, error: Exception, attempt: int, idempotent: bool = True) -> Optional[float]:
+        """Задержка перед повтором запроса к Notion или None, если повторять нельзя
+        
+        Неидемпотентный запрос повторяется только при 429 и если он не был отправлен:
+        после 5xx или таймаута чтения страница могла быть уже создана.
+        """
+        status = getattr(error, 'status', None)
+        if idempotent:
+            retryable = status is None or status == 429 or status >= 500
+        else:
+            retryable = status == 429 or self._request_unsent(error)
+        if not retryable or attempt >= self.max_retries:
+            return None
+        
+        # Экспоненциальная задержка с джиттером
+        delay = random.uniform(0, min(NOTION_BACKOFF_MAX, NOTION_BACKOFF_BASE * 2 ** attempt))
+        if status == 429:
+            try:
+                delay = max(delay, float(error.headers.get('Retry-After', 1)))
+            except ValueError:
+                delay = max(delay, 1.0)
+            # Останавливаем все потоки, а не только текущий
+            self.rate_limiter.pause(delay)
+            logger.warning(f"⏳ Notion rate limit, пауза {delay:.1f} с")
+            return 0.0
+        
+        logger.warning(f"🔁 Повтор запроса к Notion через {delay:.1f} с: {error}")
+        return delay
+    
+    @staticmethod
+    def _method_name(method) -> str:
+        """Имя метода Notion для метрик: pages.update, databases.query, ..."""
+        endpoint = type(getattr(method, '__self__', None)).__name__.replace('Endpoint', '').lower()
+        return f"{endpoint}.{method.__name__}"
+    
+    @staticmethod
+    def _failure_class(error: Exception) -> str:
+        """Класс ошибки запроса к Notion для метрик"""
+        status = getattr(error, 'status', None)
+        if status == 429:
+            return 'rate_limited'
+        if status is not None:
+            return 'server_error' if status >= 500 else 'client_error'
+        if isinstance(error, (RequestTimeoutError, httpx.TimeoutException)):
+            return 'timeout'
+        return 'connection'
+    
+    def _observe_call(self, name: str, started: float, error: Optional[Exception] = None):
+        METRICS.observe('notion_request_duration_seconds', time.perf_counter() - started, method=name)
+        METRICS.inc('notion_requests_total', method=name,
+                    result='ok' if error is None else self._failure_class(error))
+    
+    def _call(self, method, **kwargs) -> Any:
+        """Вызвать метод Notion через общий лимитер с повторами при 429, 5xx и таймаутах"""
+        name = self._method_name(method)
+        idempotent = name not in NOTION_NON_IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            started = time.perf_counter()
+            try:
+                result = method(**kwargs)
+            except (HTTPResponseError, RequestTimeoutError, httpx.TransportError) as e:
+                self._observe_call(name, started, e)
+                delay = self._retry_delay(e, attempt, idempotent)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self._observe_call(name, started)
+                return result
+    
+    def _run(self, steps) -> Any:
+        """Выполнить шаги синхронно"""
+        return _drive(steps, self._perform)
+    
+    def _perform(self, kind: str, *args) -> Any:
+        """Один шаг: ('call', метод, аргументы) - запрос к Notion, ('sleep', секунды) - пауза,
+        ('load_index',) - первая загрузка индекса"""
+        if kind == 'call':
+            method, kwargs = args
+            return self._call(method, **kwargs)
+        if kind == 'sleep':
+            time.sleep(*args)
+            return None
+        # Индекс еще не загружен - загружаем один раз; при ошибке не создаем дубликаты
+        with self._index_load_lock:
+            if self._index_synced_at is None:
+                self.refresh_page_index()
+    
+    def seed_page_index(self, pages: List[Dict], synced_at: Optional[float], devices: Optional[Iterable] = None):
+        """Прогреть индекс из локального снимка, чтобы первый проход обновлял его инкрементально
+        
+        devices - номера устройств текущего автопарка. Инкрементальное обновление находит только
+        страницы, измененные после снимка, поэтому если снимок покрывает не все устройства,
+        индекс не прогревается и загружается полностью.
+        """
+        if self._index_synced_at is not None or not pages or synced_at is None:
+            return
+        if devices is not None:
+            seeded = {str(page.get('device')) for page in pages}
+            missing = sum(1 for device_number in devices if str(device_number) not in seeded)
+            if missing:
+                logger.info(f"📇 В снимке нет страниц {missing} ТС - индекс загружается полностью")
+                return
+        for page in pages:
+            self._index_page({
+                'id': page['id'],
+                'properties': {
+                    '🚛 Fahrzeug': {'title': [{'plain_text': page.get('name') or ''}]},
+                    '📱 Device': {'rich_text': [{'plain_text': page.get('device') or ''}]},
+                }
+            })
+        self._index_synced_at = datetime.fromtimestamp(synced_at, tz=pytz.UTC)
+        logger.info(f"📇 Индекс страниц прогрет из снимка: {len(pages)} страниц")
+    
+    def page_id_for(self, data: Dict) -> Optional[str]:
+        """ID страницы Notion для объединенных данных ТС (из локального индекса)"""
+        vehicle_name = data.get('registrationNumber', data.get('name', 'Unknown'))
+        page = self._lookup_page(vehicle_name, data.get('deviceNumber'))
+        return page['id'] if page else None
+    
+    def _index_query(self) -> Dict:
+        """Параметры запроса к базе для обновления индекса"""
+        query = {'database_id': self.database_id, 'page_size': 100}
+        if self._index_synced_at:
+            # last_edited_time в Notion округляется до минуты, берем с запасом
+            since = self._index_synced_at - timedelta(minutes=1)
+            query['filter'] = {
+                "timestamp": "last_edited_time",
+                "last_edited_time": {"on_or_after": since.isoformat()}
+            }
+        return query
+    
+    def _index_refreshed(self, started_at: datetime, loaded: int):
+        """Отметить завершение обновления индекса"""
+        mode = "инкрементально" if self._index_synced_at else "полностью"
+        self._index_synced_at = started_at
+        logger.info(f"📇 Индекс страниц обновлен {mode}: {loaded} страниц, всего {len(self._pages_by_name)} ТС")
+    
+    @_with_transport
+    def refresh_page_index(self):
+        """Загрузить базу диспетчера в локальный индекс (первый раз целиком, далее инкрементально)"""
+        with METRICS.stage('notion_index'):
+            yield from self._refresh_page_index()
+    
+    def _refresh_page_index(self):
+        started_at = datetime.now(pytz.UTC)
+        query = self._index_query()
+        
+        loaded = 0
+        cursor = None
+        while True:
+            if cursor:
+                query['start_cursor'] = cursor
+            response = yield 'call', self.client.databases.query, dict(query)
+            for page in response['results']:
+                self._index_page(page)
+                loaded += 1
+            if not response.get('has_more'):
+                break
+            cursor = response.get('next_cursor')
+        
+        self._index_refreshed(started_at, loaded)
     
     def _calculate_distance(self, lat1: float, lng1: float, lat2: float, lng2: float) -> float:
         """Рассчитать расстояние между двумя точками в км"""
-        R = 6371  # Радиус Земли в км
+        R = EARTH_RADIUS_KM
         
         lat1_rad = math.radians(lat1)
         lat2_rad = math.radians(lat2)
@@ -222,17 +700,9 @@ class DispatcherNotionSync:
         a = math.sin(delta_lat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lng/2)**2
         c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
         
-        distance = R * c * 1.15  # +15% для учета дорог
+        distance = R * c * ROAD_FACTOR  # +15% для учета дорог
         return round(distance, 2)
     
-    def _format_driving_time(self, seconds: int) -> str:
-        """Форматировать время вождения в часы:минуты"""
-        if seconds is None or seconds <= 0:
-            return "0:00"
-        hours = int(seconds / 3600)
-        minutes = int((seconds % 3600) / 60)
-        return f"{hours}:{minutes:02d}"
-    
     def _calculate_status(self, data: Dict) -> str:
         """Рассчитать статус на основе данных"""
         # Проверяем время вождения
@@ -268,64 +738,154 @@ class DispatcherNotionSync:
         
         return "🟢 OK"
     
-    def update_or_create_entry(self, data: Dict) -> bool:
-        """Обновить или создать запись в базе данных диспетчера"""
+    @_with_transport
+    def update_or_create_entry(self, data: Dict, properties: Optional[Dict] = None) -> bool:
+        """Обновить или создать запись в базе данных диспетчера
+        
+        properties - заранее подготовленные свойства (prepare_properties_batch)
+        """
         
         vehicle_name = data.get('registrationNumber', data.get('name', 'Unknown'))
         if not vehicle_name:
             logger.warning("Пропускаем запись без идентификации")
             return False
-            
+        
         try:
             # Проверяем существующую запись
-            existing = self._find_entry(vehicle_name)
+            existing = yield from self._find_entry(vehicle_name, data.get('deviceNumber'))
             
-            properties = self._prepare_properties(data)
+            if properties is None:
+                properties = self._prepare_properties(data)
             
             if existing:
+                # Отправляем только изменившиеся свойства
+                changed = self._diff_properties(existing['id'], properties)
+                if changed is None:
+                    with self._state_lock:
+                        self.skipped_writes += 1
+                    logger.debug(f"⏭️ Без изменений: {vehicle_name}")
+                    return True
+                
                 # Обновляем существующую запись
-                self.client.pages.update(
-                    page_id=existing['id'],
-                    properties=properties
-                )
-                logger.info(f"✅ Обновлена запись для {vehicle_name}")
-            else:
+                try:
+                    page = yield 'call', self.client.pages.update, {
+                        'page_id': existing['id'],
+                        'properties': changed
+                    }
+                except APIResponseError as e:
+                    if e.code != APIErrorCode.ObjectNotFound and 'archived' not in str(e):
+                        raise
+                    # Страница удалена или архивирована в Notion - убираем из индекса и создаем заново
+                    self._forget_page(existing['id'])
+                    existing = None
+                else:
+                    self._index_page(page)
+                    self._remember_properties(page['id'], changed)
+                    logger.info(f"✅ Обновлена запись для {vehicle_name} ({len(changed)} полей)")
+            
+            if not existing:
                 # Создаем новую запись
-                self.client.pages.create(
-                    parent={"database_id": self.database_id},
-                    properties=properties
-                )
+                page = yield from self._create_page(vehicle_name, data.get('deviceNumber'), properties)
+                self._index_page(page)
+                self._remember_properties(page['id'], properties)
                 logger.info(f"➕ Создана новая запись для {vehicle_name}")
-                
-            return True
             
+            return True
+        
         except Exception as e:
             logger.error(f"Ошибка при обновлении/создании записи для {vehicle_name}: {e}")
             return False
     
-    def _find_entry(self, vehicle_name: str) -> Optional[Dict]:
-        """Найти существующую запись по названию ТС"""
-        try:
-            response = self.client.databases.query(
-                database_id=self.database_id,
-                filter={
-                    "property": "🚛 Fahrzeug",
-                    "title": {
-                        "contains": vehicle_name
-                    }
-                }
-            )
-            
-            if response['results']:
-                return response['results'][0]
-            return None
+    def _create_page(self, vehicle_name: str, device_number: Optional[str], properties: Dict):
+        """Создать страницу ТС без дубликатов
+        
+        _call повторяет pages.create только при 429 и неотправленном запросе. После прочих
+        сбоев (5xx, таймаут, обрыв) страница могла быть создана: индекс обновляется,
+        и найденная страница обновляется вместо повторного создания.
+        """
+        attempt = 0
+        while True:
+            try:
+                return (yield 'call', self.client.pages.create, {
+                    'parent': {"database_id": self.database_id},
+                    'properties': properties
+                })
+            except (HTTPResponseError, RequestTimeoutError, httpx.TransportError) as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                yield 'sleep', delay
+                attempt += 1
             
-        except Exception as e:
-            logger.error(f"Ошибка при поиске записи: {e}")
-            return None
+            yield from self._refresh_page_index()
+            page = self._lookup_page(vehicle_name, device_number)
+            if page:
+                logger.warning(f"♻️ Страница {vehicle_name} создана до сбоя - обновляем ее вместо повторного создания")
+                return (yield 'call', self.client.pages.update, {'page_id': page['id'], 'properties': properties})
+    
+    def _find_entry(self, vehicle_name: str, device_number: Optional[str] = None):
+        """Найти существующую запись в локальном индексе по точному названию ТС или номеру устройства"""
+        if self._index_synced_at is None:
+            yield ('load_index',)
+        with METRICS.stage('notion_lookup'):
+            return self._lookup_page(vehicle_name, device_number)
     
-    def _prepare_properties(self, data: Dict) -> Dict:
+    def _lookup_page(self, vehicle_name: str, device_number: Optional[str] = None) -> Optional[Dict]:
+        """Поиск страницы в уже загруженном индексе"""
+        with self._index_lock:
+            page = self._pages_by_name.get(str(vehicle_name).strip())
+            if not page and device_number:
+                page = self._pages_by_device.get(str(device_number))
+            return page
+    
+    def _prepare_properties(self, data: Dict, now: Optional[datetime] = None) -> Dict:
         """Подготовить свойства для Notion"""
+        if now is None:
+            now = datetime.now(pytz.UTC)
+        with METRICS.stage('transform_record'):
+            return self._build_properties(data, now, now.isoformat(), self._convert_columns([data], now)[0])
+    
+    def prepare_properties_batch(self, records: List[Dict], now: Optional[datetime] = None) -> List[Optional[Dict]]:
+        """Подготовить свойства Notion для всех ТС прохода
+        
+        Метки времени, время вождения, топливо и загрузка считаются поколоночно,
+        текущее время одно на весь проход. Для записей, которые не удалось преобразовать, - None:
+        их свойства подготовит update_or_create_entry и залогирует ошибку.
+        """
+        if now is None:
+            now = datetime.now(pytz.UTC)
+        now_iso = now.isoformat()
+        
+        payloads = []
+        with METRICS.stage('transform'):
+            for data, converted in zip(records, self._convert_columns(records, now)):
+                try:
+                    payloads.append(self._build_properties(data, now, now_iso, converted))
+                except Exception as e:
+                    logger.debug(f"Не удалось подготовить свойства {data.get('registrationNumber')}: {e}")
+                    payloads.append(None)
+        return payloads
+    
+    @staticmethod
+    def _convert_columns(records: List[Dict], now: datetime) -> List[Dict]:
+        """Поколоночные преобразования по всему автопарку, результат - по записям"""
+        columns = {
+            'workDayStarted': timestamps_iso(column(records, 'workDayStarted')),
+            'nextDayRest': timestamps_iso(column(records, 'nextDayRest')),
+            'plannedArrival': timestamps_iso(column(records, 'plannedArrival')),
+            'actualArrival': timestamps_iso(column(records, 'actualArrival')),
+            'dailyDrivingTimeLeft': driving_times(column(records, 'dailyDrivingTimeLeft')),
+            'continuousDrivingTimeLeft': driving_times(column(records, 'continuousDrivingTimeLeft')),
+            'weeklyDrivingTimeLeft': driving_times(column(records, 'weeklyDrivingTimeLeft')),
+            'fuelLiters': fuel_liters(column(records, 'fuelLevel'), column(records, 'fuelTankCapacity')),
+            'utilization': utilizations(column(records, 'workDayStarted'), now),
+            'delayMinutes': delay_minutes(column(records, 'plannedArrival'), column(records, 'actualArrival')),
+            'eta': fallback_etas(column(records, 'distanceToTask'), column(records, 'speed'), now),
+        }
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
+    
+    def _build_properties(self, data: Dict, now: datetime, now_iso: str, converted: Dict) -> Dict:
+        """Свойства одного ТС из записи и заранее рассчитанных колонок"""
         properties = {}
         
         # === ОСНОВНАЯ ИДЕНТИФИКАЦИЯ ===
@@ -385,17 +945,10 @@ class DispatcherNotionSync:
         if data.get('distanceToTask') is not None:
             properties['📏 KM'] = {"number": float(data['distanceToTask'])}
             
-            # Рассчитываем ETA на основе расстояния и скорости
-            speed = data.get('speed', 0)
-            if speed > 10:  # Если едет
-                eta_hours = data['distanceToTask'] / speed
-                eta_time = datetime.now(pytz.UTC) + timedelta(hours=eta_hours)
-                properties['⏱️ ETA'] = {"date": {"start": eta_time.isoformat()}}
-            elif data.get('distanceToTask', 0) > 0:
-                # Используем среднюю скорость 60 км/ч если стоит
-                eta_hours = data['distanceToTask'] / 60
-                eta_time = datetime.now(pytz.UTC) + timedelta(hours=eta_hours)
-                properties['⏱️ ETA'] = {"date": {"start": eta_time.isoformat()}}
+            # ETA из пакетного расчета по автопарку, иначе на основе расстояния и скорости
+            eta = data.get('taskEta') or converted['eta']
+            if eta:
+                properties['⏱️ ETA'] = {"date": {"start": eta}}
         
         # Последнее сообщение
         if data.get('lastMessage'):
@@ -408,41 +961,28 @@ class DispatcherNotionSync:
         # === ТАХОГРАФ ===
         
         # Время вождения
-        if data.get('dailyDrivingTimeLeft') is not None:
-            time_str = self._format_driving_time(data['dailyDrivingTimeLeft'])
-            properties['⏱️ Fahrzeit'] = {"rich_text": [{"text": {"content": time_str}}]}
+        if converted['dailyDrivingTimeLeft'] is not None:
+            properties['⏱️ Fahrzeit'] = {"rich_text": [{"text": {"content": converted['dailyDrivingTimeLeft']}}]}
         
         # Время до паузы
-        if data.get('continuousDrivingTimeLeft') is not None:
-            time_str = self._format_driving_time(data['continuousDrivingTimeLeft'])
-            properties['⏸️ Pause in'] = {"rich_text": [{"text": {"content": time_str}}]}
+        if converted['continuousDrivingTimeLeft'] is not None:
+            properties['⏸️ Pause in'] = {"rich_text": [{"text": {"content": converted['continuousDrivingTimeLeft']}}]}
         
         # Недельное время
-        if data.get('weeklyDrivingTimeLeft') is not None:
-            time_str = self._format_driving_time(data['weeklyDrivingTimeLeft'])
-            properties['📅 Woche'] = {"rich_text": [{"text": {"content": time_str}}]}
+        if converted['weeklyDrivingTimeLeft'] is not None:
+            properties['📅 Woche'] = {"rich_text": [{"text": {"content": converted['weeklyDrivingTimeLeft']}}]}
         
         # Текущая активность
         if data.get('currentActivity'):
             properties['🎯 Aktivität'] = {"select": {"name": data['currentActivity']}}
         
         # Начало работы
-        if data.get('workDayStarted'):
-            try:
-                timestamp_ms = int(data['workDayStarted'])
-                dt = datetime.fromtimestamp(timestamp_ms / 1000, tz=pytz.UTC)
-                properties['🕐 Start'] = {"date": {"start": dt.isoformat()}}
-            except:
-                pass
+        if converted['workDayStarted']:
+            properties['🕐 Start'] = {"date": {"start": converted['workDayStarted']}}
         
         # Следующий отдых
-        if data.get('nextDayRest'):
-            try:
-                timestamp_ms = int(data['nextDayRest'])
-                dt = datetime.fromtimestamp(timestamp_ms / 1000, tz=pytz.UTC)
-                properties['😴 Ruhezeit'] = {"date": {"start": dt.isoformat()}}
-            except:
-                pass
+        if converted['nextDayRest']:
+            properties['😴 Ruhezeit'] = {"date": {"start": converted['nextDayRest']}}
         
         # Нарушения
         violations = data.get('longerDrivingCount', 0) + data.get('shorterRestCount', 0)
@@ -453,17 +993,14 @@ class DispatcherNotionSync:
         properties['⚠️ Warnung'] = {"select": {"name": status}}
         
         # === ВРЕМЯ ОБНОВЛЕНИЯ ===
-        current_time = datetime.now(pytz.UTC).isoformat()
-        properties['🔄 Update'] = {"date": {"start": current_time}}
+        properties['🔄 Update'] = {"date": {"start": now_iso}}
         
         # === ДОПОЛНИТЕЛЬНЫЕ ПОЛЯ ===
         
         # Топливо в литрах (не в процентах!)
-        if data.get('fuelLevel') is not None:
-            # Предполагаем стандартный бак 400 литров для грузовика
-            tank_capacity = data.get('fuelTankCapacity', 400)
-            fuel_liters = (float(data['fuelLevel']) / 100) * tank_capacity
-            properties['⛽ Fuel'] = {"number": fuel_liters}
+        if converted['fuelLiters'] is not None:
+            # Бак по умолчанию 400 литров (см. notion_payloads.DEFAULT_TANK_CAPACITY)
+            properties['⛽ Fuel'] = {"number": converted['fuelLiters']}
         
         # Дневной пробег
         if data.get('dailyDistance') is not None:
@@ -479,16 +1016,9 @@ class DispatcherNotionSync:
         # Загрузка (процент использования транспорта)
         if data.get('utilization') is not None:
             properties['📊 Auslastung'] = {"number": float(data['utilization']) / 100}
-        else:
-            # Рассчитываем на основе времени работы
-            if data.get('workDayStarted'):
-                work_start = int(data['workDayStarted']) / 1000
-                now = time.time()
-                work_hours = (now - work_start) / 3600
-                if work_hours > 0:
-                    # Предполагаем 8-часовой рабочий день
-                    utilization = min(work_hours / 8, 1.0)
-                    properties['📊 Auslastung'] = {"number": utilization}
+        elif converted['utilization'] is not None:
+            # Рассчитываем на основе времени работы (8-часовой рабочий день)
+            properties['📊 Auslastung'] = {"number": converted['utilization']}
         
         # Группа
         if data.get('groupName'):
@@ -503,34 +1033,19 @@ class DispatcherNotionSync:
         # === ЗАДАЧИ ===
         
         # Плановое прибытие
-        if data.get('plannedArrival'):
-            try:
-                timestamp_ms = int(data['plannedArrival'])
-                dt = datetime.fromtimestamp(timestamp_ms / 1000, tz=pytz.UTC)
-                properties['📅 Plan'] = {"date": {"start": dt.isoformat()}}
-            except:
-                pass
+        if converted['plannedArrival']:
+            properties['📅 Plan'] = {"date": {"start": converted['plannedArrival']}}
         
         # Фактическое прибытие
-        if data.get('actualArrival'):
-            try:
-                timestamp_ms = int(data['actualArrival'])
-                dt = datetime.fromtimestamp(timestamp_ms / 1000, tz=pytz.UTC)
-                properties['✅ Ist'] = {"date": {"start": dt.isoformat()}}
-            except:
-                pass
+        if converted['actualArrival']:
+            properties['✅ Ist'] = {"date": {"start": converted['actualArrival']}}
         
         # Опоздание (рассчитываем на основе планового и фактического времени)
         if data.get('delayMinutes') is not None:
             properties['⏰ Delay'] = {"number": int(data['delayMinutes'])}
-        elif data.get('plannedArrival') and data.get('actualArrival'):
-            # Рассчитываем опоздание в минутах
-            planned = int(data['plannedArrival']) / 1000
-            actual = int(data['actualArrival']) / 1000
-            delay_seconds = actual - planned
-            delay_minutes = int(delay_seconds / 60)
-            if delay_minutes > 0:
-                properties['⏰ Delay'] = {"number": delay_minutes}
+        elif converted['delayMinutes'] is not None:
+            # Опоздание в минутах по плановому и фактическому времени
+            properties['⏰ Delay'] = {"number": converted['delayMinutes']}
         
         # Клиент
         if data.get('customerName'):
@@ -574,31 +1089,8 @@ class DispatcherNotionSync:
         
         return properties
 
-def sync_dispatcher_data():
-    """Главная функция синхронизации"""
-    logger.info("="*50)
-    logger.info("🚀 Начало синхронизации данных диспетчера")
-    
-    # Инициализация API
-    loctracker = LocTrackerAPI()
-    notion = DispatcherNotionSync()
-    
-    # Получаем данные
-    devices = loctracker.get_devices()
-    if not devices:
-        logger.error("Не удалось получить список устройств")
-        return
-    
-    positions = loctracker.get_positions()
-    if not positions:
-        logger.error("Не удалось получить позиции")
-        return
-    
-    # Получаем дополнительные данные
-    tachographs = loctracker.get_tachograph_state()
-    fleet_state = loctracker.get_fleet_state()
-    
-    # Создаем словарь задач из fleet state
+def _build_fleet_tasks_dict(fleet_state: Optional[Dict]) -> Dict[str, List[Dict]]:
+    """Создать словарь задач из fleet state"""
     fleet_tasks_dict = {}
     if fleet_state and 'devices' in fleet_state:
         for fleet_device in fleet_state['devices']:
@@ -606,165 +1098,520 @@ def sync_dispatcher_data():
                 device_num = fleet_device['device'].get('number')
                 if device_num:
                     fleet_tasks_dict[str(device_num)] = fleet_device['tasks']
+    return fleet_tasks_dict
+
+def _fetch_device_extras(loctracker: LocTrackerAPI, device_number: str, registration: str,
+                         fleet_tasks: Optional[List[Dict]]) -> Dict[str, Any]:
+    """Получить задачи, отчет и топливо для одного устройства"""
+    extras = {'tasks': None, 'report': None, 'fuel': None}
     
-    # Создаем словари для быстрого доступа
-    positions_dict = {p['deviceNumber']: p for p in positions}
-    tacho_dict = {}
-    if tachographs:
-        for tacho in tachographs:
-            if 'deviceNumber' in tacho:
-                tacho_dict[tacho['deviceNumber']] = tacho
+    # Сначала ищем задачи в fleet state
+    tasks = fleet_tasks
+    if tasks:
+        logger.debug(f"Найдено {len(tasks)} задач в fleet state для {registration}")
     
-    processed_count = 0
-    error_count = 0
+    # Если нет в fleet state, пробуем API
+    if not tasks:
+        try:
+            tasks = loctracker.get_device_tasks(device_number)
+        except Exception as e:
+            logger.debug(f"Не удалось получить задачи из API для {registration}: {e}")
+    extras['tasks'] = tasks
     
-    # Обрабатываем каждое устройство
-    for device in devices:
-        device_number = device.get('number')
-        registration = device.get('registrationNumber', '').strip()
+    # Получаем отчет по устройству для дневного пробега
+    try:
+        extras['report'] = loctracker.get_device_report(device_number)
+    except Exception as e:
+        logger.debug(f"Не удалось получить отчет для {registration}: {e}")
+    
+    # Получаем данные по топливу
+    try:
+        extras['fuel'] = loctracker.get_fuel_data(device_number)
+    except Exception as e:
+        logger.debug(f"Не удалось получить данные топлива для {registration}: {e}")
+    
+    return extras
+
+def _merge_device_data(device: Dict, position: Optional[Dict], tacho: Optional[Dict],
+                       extras: Dict[str, Any], activity: Optional[Dict] = None,
+                       arrivals: Optional[Dict[str, Dict]] = None,
+                       state: Optional[VehicleState] = None) -> VehicleState:
+    """Объединить данные устройства, позиции, тахографа, задач, отчета и топлива
+    
+    С state запись прошлого прохода заполняется заново на месте, иначе создается новая.
+    """
+    combined_data = state.reset(device) if state is not None else VehicleState(device)
+    combined_data.vehicleId = device.get('id')
+    
+    # Добавляем данные позиции
+    if position:
+        combined_data.update(position)
+    
+    # Добавляем данные тахографа (новая структура API)
+    if tacho:
+        # Время вождения из новой структуры
+        if 'driveTimeCurrentDay' in tacho:
+            combined_data.dailyDrivingTimeLeft = tacho['driveTimeCurrentDay'].get('durationRemaining', 0)
         
-        if not registration:
-            continue
+        if 'driveTimeSinceRest' in tacho:
+            combined_data.continuousDrivingTimeLeft = tacho['driveTimeSinceRest'].get('durationRemaining', 0)
         
-        logger.info(f"📦 Обработка {registration}...")
+        if 'driveTimeCurrentWeek' in tacho:
+            combined_data.weeklyDrivingTimeLeft = tacho['driveTimeCurrentWeek'].get('durationRemaining', 0)
         
-        # Объединяем все данные
-        combined_data = {**device}
-        combined_data['vehicleId'] = device.get('id')
+        # Статус активности (преобразуем числовой статус)
+        status = tacho.get('status', 0)
+        status_map = {0: 'REST', 1: 'AVAILABLE', 2: 'WORK', 3: 'DRIVING'}
+        combined_data.currentActivity = status_map.get(status, 'AVAILABLE')
         
-        # Добавляем данные позиции
-        if device_number in positions_dict:
-            position = positions_dict[device_number]
-            combined_data.update(position)
+        # Время начала работы
+        combined_data.workDayStarted = tacho.get('workPeriodStart')
+        combined_data.nextDayRest = tacho.get('workPeriodExpectedEnd')
         
-        # Добавляем данные тахографа (новая структура API)
-        if device_number in tacho_dict:
-            tacho = tacho_dict[device_number]
-            
-            # Время вождения из новой структуры
-            if 'driveTimeCurrentDay' in tacho:
-                combined_data['dailyDrivingTimeLeft'] = tacho['driveTimeCurrentDay'].get('durationRemaining', 0)
-            
-            if 'driveTimeSinceRest' in tacho:
-                combined_data['continuousDrivingTimeLeft'] = tacho['driveTimeSinceRest'].get('durationRemaining', 0)
-            
-            if 'driveTimeCurrentWeek' in tacho:
-                combined_data['weeklyDrivingTimeLeft'] = tacho['driveTimeCurrentWeek'].get('durationRemaining', 0)
-            
-            # Статус активности (преобразуем числовой статус)
-            status = tacho.get('status', 0)
-            status_map = {0: 'REST', 1: 'AVAILABLE', 2: 'WORK', 3: 'DRIVING'}
-            combined_data['currentActivity'] = status_map.get(status, 'AVAILABLE')
-            
-            # Время начала работы
-            combined_data['workDayStarted'] = tacho.get('workPeriodStart')
-            combined_data['nextDayRest'] = tacho.get('workPeriodExpectedEnd')
-            
-            # Нарушения
-            combined_data['longerDrivingCount'] = tacho.get('extendedDailyDrives', 0)
-            combined_data['shorterRestCount'] = tacho.get('shortenedDailyRest', 0)
+        # Нарушения
+        combined_data.longerDrivingCount = tacho.get('extendedDailyDrives', 0)
+        combined_data.shorterRestCount = tacho.get('shortenedDailyRest', 0)
+        
+        # Имя водителя
+        combined_data.driverName = tacho.get('driverNameFull', tacho.get('driverName', ''))
+    
+    tasks = extras.get('tasks')
+    if tasks and len(tasks) > 0:
+        # Текущая задача (ищем первую не завершенную или последнюю завершенную)
+        current_task = None
+        for task in tasks:
+            if task.get('status') != 'COMPLETED':
+                current_task = task
+                break
+        
+        # Если все завершены, берем последнюю
+        if not current_task and len(tasks) > 0:
+            current_task = tasks[0]
+        
+        if current_task:
+            combined_data.currentTaskAddress = current_task.get('locationAddress', '')
+            combined_data.taskStatus = current_task.get('status', '')
+            combined_data.plannedArrival = current_task.get('plannedArrival', current_task.get('date'))
+            combined_data.actualArrival = current_task.get('actualArrival', current_task.get('timeCompleted'))
+            # Нет факта от LocTracker - берем прибытие, определенное по геозоне задачи
+            arrival = (arrivals or {}).get(task_key(current_task))
+            if not combined_data.actualArrival and arrival:
+                combined_data.actualArrival = arrival['arrivedAt']
+            combined_data.customerName = current_task.get('customerName', current_task.get('locationName', ''))
+            combined_data.orderNumber = current_task.get('orderNumber', str(current_task.get('taskId', '')))
+            combined_data.cargoDescription = current_task.get('cargoDescription', current_task.get('logistComment', ''))
+            combined_data.palletCount = current_task.get('palletCount', current_task.get('parcelWeight'))
+            combined_data.cargoWeight = current_task.get('cargoWeight', current_task.get('totalParcelWeight'))
+            combined_data.priority = current_task.get('priority', 2)
+            combined_data.notes = current_task.get('notes', current_task.get('driverNotes', ''))
             
-            # Имя водителя
-            combined_data['driverName'] = tacho.get('driverNameFull', tacho.get('driverName', ''))
+            # Координаты текущей и остальных незавершенных задач; расстояния и ETA
+            # считаются для всего автопарка сразу (fleet_geo.apply_task_distances)
+            pending_tasks = [current_task] + [t for t in tasks if t is not current_task and t.get('status') != 'COMPLETED']
+            combined_data.taskCoords = [
+                (task.get('latitude', task.get('lat')), task.get('longitude', task.get('lng')))
+                for task in pending_tasks
+            ]
+            # Ключи тех же задач - для геозон ТС, задачи которых приходят не из fleet state
+            combined_data.taskKeys = [task_key(task) for task in pending_tasks]
+        
+        # Следующая задача
+        next_task = tasks[1] if len(tasks) > 1 else None
+        if next_task:
+            combined_data.nextTaskAddress = next_task.get('locationAddress', '')
         
-        # Получаем задачи (сначала пробуем из fleet state, потом из API)
-        tasks = None
+        # Считаем выполненные задачи
+        completed = [t for t in tasks if t.get('status') == 'COMPLETED']
+        combined_data.completedTasks = len(completed)
+    
+    # Дневной пробег из отчета
+    report = extras.get('report')
+    if report:
+        combined_data.dailyDistance = report.get('totalDistance', 0)
+        combined_data.fuelTankCapacity = report.get('fuelTankCapacity', 400)
+        
+        # Если есть данные о заправках
+        if 'fuelData' in report:
+            combined_data.fuelLevel = report['fuelData'].get('currentLevel')
+    
+    # Данные по топливу
+    fuel_data = extras.get('fuel')
+    if fuel_data:
+        combined_data.fuelLevel = fuel_data.get('currentLevel')
+        combined_data.fuelTankCapacity = fuel_data.get('tankCapacity', 400)
+    
+    # Последняя новая активность из ленты (только записи новее курсора)
+    if activity:
+        combined_data.lastActivityType = activity.get('type')
+        combined_data.lastActivityTime = activity.get('time', activity.get('date'))
+        message = activity.get('message', activity.get('text'))
+        if message:
+            combined_data.lastMessage = message
+    
+    return combined_data
+
+def _enrich_device(device: Dict, loctracker: LocTrackerAPI, positions_dict: Dict, tacho_dict: Dict,
+                   fleet_tasks_dict: Dict, activities_dict: Dict, arrivals_dict: Optional[Dict] = None,
+                   states: Optional[VehicleStates] = None) -> VehicleState:
+    """Получить дополнительные данные одного устройства и объединить их (в запись из states, если задан)"""
+    device_number = device.get('number')
+    registration = device.get('registrationNumber', '').strip()
+    
+    logger.info(f"📦 Обработка {registration}...")
+    
+    with METRICS.stage('fetch_device'):
+        extras = _fetch_device_extras(loctracker, device_number, registration,
+                                      fleet_tasks_dict.get(device_number))
+    with METRICS.stage('merge'):
+        return _merge_device_data(device, positions_dict.get(device_number),
+                                  tacho_dict.get(device_number), extras,
+                                  activities_dict.get(str(device_number)),
+                                  (arrivals_dict or {}).get(str(device_number)),
+                                  states.acquire(device_number) if states is not None else None)
+
+def _prepare_payloads(notion: 'DispatcherNotionSync', records: List[Optional[Dict]],
+                      valid_records: List[Dict]) -> List[Optional[Dict]]:
+    """Свойства Notion по порядку records (None для необработанных ТС)"""
+    try:
+        prepared = iter(notion.prepare_properties_batch(valid_records))
+    except Exception as e:
+        # Запасной путь: свойства подготовит каждая запись отдельно
+        logger.error(f"Ошибка пакетной подготовки свойств: {e}")
+        return [None] * len(records)
+    return [next(prepared) if record is not None else None for record in records]
+
+def _plan_priority(notion: 'DispatcherNotionSync', vehicles: List[Dict], positions_dict: Dict,
+                   tacho_dict: Dict, fleet_tasks_dict: Dict) -> PriorityPlan:
+    """Порядок по срочности из позиций, тахографов и задач fleet state (без запросов по ТС)"""
+    previews = []
+    for device in vehicles:
+        device_number = device.get('number')
+        previews.append(_merge_device_data(device, positions_dict.get(device_number), tacho_dict.get(device_number),
+                                           {'tasks': fleet_tasks_dict.get(device_number)}))
+    apply_task_distances(previews)
+    plan = PriorityPlan(vehicles, previews, notion._calculate_status)
+    plan.log_plan()
+    return plan
+
+def _gate_vehicles(gate: Optional[ChangeGate], vehicles: List[Dict], positions_dict: Dict, tacho_dict: Dict,
+                   fleet_tasks_dict: Dict, activities_dict: Dict, arrivals_dict: Optional[Dict] = None):
+    """Оставить ТС, чьи общие данные изменились или устарели; вернуть их и число пропущенных"""
+    if gate is None:
+        return vehicles, 0
+    changed, unchanged = gate.select(vehicles, positions_dict, tacho_dict, fleet_tasks_dict, activities_dict,
+                                     arrivals_dict)
+    logger.info(f"💤 Без изменений в общих данных: {len(unchanged)} ТС, к обработке: {len(changed)}")
+    return changed, len(unchanged)
+
+def _detect_arrivals(geofence: Optional[GeofenceTracker], positions: List[Dict],
+                     fleet_tasks_dict: Dict) -> Dict[str, Dict]:
+    """Прибытия к задачам по геозонам (ошибка геозон не прерывает синхронизацию)"""
+    if geofence is None:
+        return {}
+    try:
+        with METRICS.stage('geofence'):
+            return geofence.update(positions, fleet_tasks_dict)
+    except Exception as e:
+        logger.error(f"Ошибка при определении прибытий по геозонам: {e}")
+        return {}
+
+def _roster(devices: Optional[List[Dict]]) -> List[str]:
+    """Номера устройств, которые пишутся в Notion (с регистрационным номером)"""
+    return [str(d.get('number')) for d in devices or [] if d.get('registrationNumber', '').strip()]
+
+def _flush_outbox(outbox: Optional[NotionOutbox]) -> int:
+    """Выгрузить очередь, если ее не выгружает фоновый поток; вернуть число ожидающих записей"""
+    if outbox is None:
+        return 0
+    if not outbox.draining:
+        try:
+            outbox.drain()
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки очереди Notion: {e}")
+    return outbox.pending()
+
+def _report_writes(outbox: Optional[NotionOutbox], plan: Optional[PriorityPlan], gate: Optional[ChangeGate]):
+    """Итог SLO критичных ТС; при фоновой выгрузке очереди - после записи ее ТС
+    
+    Пока фоновый поток выгружает записи прохода, цифры покрывают только подтвержденные
+    записи; окончательный итог и сохранение отпечатков - когда поток запишет записи прохода.
+    """
+    if outbox is None or not outbox.draining:
+        if plan:
+            plan.report()
+        return
+    if plan:
+        plan.report(confirmed_only=True)
+    
+    def settle():
+        if plan:
+            plan.report()
+        if gate:
+            gate.save()
+    
+    outbox.on_settled(settle)
+
+def _record_positions(history: Optional[PositionHistory], positions: List[Dict], pass_started_at: float):
+    """Дописать позиции прохода в историю (ошибка истории не прерывает синхронизацию)"""
+    if history is None:
+        return
+    try:
+        written = history.append(positions, fallback_time=pass_started_at)
+        logger.info(f"📈 История позиций: +{written} точек")
+    except Exception as e:
+        logger.error(f"Ошибка при записи истории позиций: {e}")
+
+def sync_dispatcher_data(workers: Optional[int] = None, loctracker: Optional[LocTrackerAPI] = None,
+                         notion: Optional['DispatcherNotionSync'] = None,
+                         store: Optional[SnapshotStore] = None,
+                         history: Optional[PositionHistory] = None,
+                         gate: Optional[ChangeGate] = None,
+                         activity_stream: Optional[ActivityStream] = None,
+                         geofence: Optional[GeofenceTracker] = None,
+                         outbox: Optional[NotionOutbox] = None,
+                         states: Optional[VehicleStates] = None) -> Optional[Dict[str, Any]]:
+    """Главная функция синхронизации
+    
+    Резидентный процесс (sync_daemon.py) передает свои клиенты loctracker/notion,
+    хранилище снимков, историю позиций, фильтр изменений, ленту активностей и геозоны, чтобы
+    соединения, индекс страниц и кэши переживали отдельные проходы, а с states - и записи ТС,
+    которые объединение заполняет на месте вместо новых в каждом проходе. С очередью записей
+    (outbox) проход только ставит записи в очередь; если ее не выгружает фоновый поток,
+    очередь выгружается в конце прохода.
+    """
+    logger.info("="*50)
+    logger.info("🚀 Начало синхронизации данных диспетчера")
+    started_at = time.monotonic()
+    
+    if workers is None:
+        workers = SYNC_WORKERS
+    workers = max(1, workers)
+    
+    # Инициализация API (если клиенты не переданы снаружи)
+    owns_loctracker = loctracker is None
+    if loctracker is None:
+        loctracker = LocTrackerAPI()
+    if notion is None:
+        notion = DispatcherNotionSync()
+    owns_outbox = outbox is None and bool(NOTION_OUTBOX_FILE)
+    if owns_outbox:
+        outbox = NotionOutbox(notion)
+    owns_store = store is None and bool(SNAPSHOT_DB_FILE)
+    if owns_store:
+        store = SnapshotStore(SNAPSHOT_DB_FILE)
+    skipped_before = notion.skipped_writes
+    pass_started_at = time.time()
+    
+    # Все, что проход создал сам, закрывается и при раннем выходе
+    try:
+        # Получаем данные
+        fetch_started = time.perf_counter()
+        devices = loctracker.get_devices()
+        if not devices:
+            logger.error("Не удалось получить список устройств")
+            return None
         
-        # Сначала ищем в fleet state
-        if device_number in fleet_tasks_dict:
-            tasks = fleet_tasks_dict[device_number]
-            logger.debug(f"Найдено {len(tasks)} задач в fleet state для {registration}")
+        positions = loctracker.get_positions()
+        if not positions:
+            logger.error("Не удалось получить позиции")
+            return None
         
-        # Если нет в fleet state, пробуем API
-        if not tasks:
+        if history is None and POSITION_HISTORY_DIR:
+            history = PositionHistory(POSITION_HISTORY_DIR)
+        _record_positions(history, positions, pass_started_at)
+        
+        # Получаем дополнительные данные
+        tachographs = loctracker.get_tachograph_state()
+        fleet_state = loctracker.get_fleet_state()
+        
+        # Создаем словарь задач из fleet state
+        fleet_tasks_dict = _build_fleet_tasks_dict(fleet_state)
+        
+        # Создаем словари для быстрого доступа
+        positions_dict = {p['deviceNumber']: p for p in positions}
+        tacho_dict = {}
+        if tachographs:
+            for tacho in tachographs:
+                if 'deviceNumber' in tacho:
+                    tacho_dict[tacho['deviceNumber']] = tacho
+        
+        # Новые активности всего автопарка одним запросом
+        if activity_stream is None and ACTIVITY_STREAM_ENABLED:
+            activity_stream = ActivityStream(loctracker)
+        activities_dict = latest_by_device(activity_stream.poll()) if activity_stream else {}
+        METRICS.observe_stage('fetch_fleet', time.perf_counter() - fetch_started)
+        
+        # Прибытия к задачам - по геозонам для всего автопарка, без запросов по ТС
+        if geofence is None and GEOFENCE_ENABLED:
+            geofence = GeofenceTracker()
+        arrivals_dict = _detect_arrivals(geofence, positions, fleet_tasks_dict)
+        
+        # Один запрос к Notion на проход вместо поиска страницы для каждого ТС;
+        # после перезапуска индекс прогревается из снимка и догружается инкрементально
+        try:
+            if store:
+                notion.seed_page_index(*store.load_page_index(notion.database_id), _roster(devices))
+            notion.refresh_page_index()
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке индекса страниц: {e}")
+        
+        # Только устройства с регистрационным номером
+        vehicles = [d for d in devices if d.get('registrationNumber', '').strip()]
+        if states is not None:
+            states.prune(vehicles)
+        
+        # Запросы по ТС и запись - только для изменившихся (или давно не обновлявшихся) ТС
+        if gate is None and CHANGE_GATE_ENABLED:
+            gate = ChangeGate()
+        vehicles, gated_count = _gate_vehicles(gate, vehicles, positions_dict, tacho_dict,
+                                               fleet_tasks_dict, activities_dict, arrivals_dict)
+        if activity_stream:
+            # Активности устройств без записи в этом проходе не держат курсор
+            activity_stream.ack_others(device.get('number') for device in vehicles)
+        
+        # Срочные ТС (скоро пауза по тахографу) - отдельным первым ярусом
+        plan = None
+        if SYNC_ORDER == 'priority':
+            plan = _plan_priority(notion, vehicles, positions_dict, tacho_dict, fleet_tasks_dict)
+        tiers = plan.tiers if plan else [vehicles]
+        
+        def enrich(device: Dict) -> Optional[Dict]:
             try:
-                tasks = loctracker.get_device_tasks(device_number)
+                return _enrich_device(device, loctracker, positions_dict, tacho_dict,
+                                      fleet_tasks_dict, activities_dict, arrivals_dict, states)
             except Exception as e:
-                logger.debug(f"Не удалось получить задачи из API для {registration}: {e}")
-        
-        if tasks and len(tasks) > 0:
-                # Текущая задача (ищем первую не завершенную или последнюю завершенную)
-                current_task = None
-                for task in tasks:
-                    if task.get('status') != 'COMPLETED':
-                        current_task = task
-                        break
+                logger.error(f"Ошибка обработки устройства {device.get('number')}: {e}")
+                return None
+        
+        written: List[str] = []
+        
+        def synced(record: Dict, fingerprint: Optional[str], activity_id: Optional[int]):
+            """Учесть подтвержденную запись ТС в Notion - из прохода или из потока выгрузки очереди"""
+            written.append(str(record.get('number')))
+            if gate:
+                gate.mark_synced(record, fingerprint=fingerprint)
+            if plan:
+                plan.observe_write(record, time.monotonic() - started_at)
+            if activity_stream:
+                activity_stream.ack(record.get('number'), activity_id)
+        
+        def write(combined_data: Optional[Dict], properties: Optional[Dict]) -> bool:
+            if combined_data is None:
+                return False
+            fingerprint = gate.pending_fingerprint(combined_data) if gate else None
+            activity_id = (activities_dict.get(str(combined_data.get('number'))) or {}).get('id')
+            if outbox:
+                # Запись в Notion - из очереди, срочные ТС выгружаются первыми; отпечаток,
+                # SLO и подтверждение активностей учитываются только после настоящей записи
+                return outbox.enqueue(combined_data, properties, plan.rank(combined_data) if plan else 0,
+                                      on_written=lambda record: synced(record, fingerprint, activity_id))
+            # Темп запросов к Notion задает общий RateLimiter
+            with METRICS.stage('notion_write'):
+                success = notion.update_or_create_entry(combined_data, properties)
+            if success:
+                synced(combined_data, fingerprint, activity_id)
+            return success
+        
+        # Обрабатываем устройства параллельно; map сохраняет порядок яруса
+        logger.info(f"⚙️ Воркеров: {workers}, устройств: {len(vehicles)}")
+        records, results = [], []
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sync') as executor:
+            for tier in tiers:
+                tier_records = list(executor.map(with_pass_labels(enrich), tier))
                 
-                # Если все завершены, берем последнюю
-                if not current_task and len(tasks) > 0:
-                    current_task = tasks[0]
+                # Расстояния и ETA до всех задач - одним векторным расчетом по ярусу
+                valid_records = [r for r in tier_records if r is not None]
+                with METRICS.stage('distances'):
+                    apply_task_distances(valid_records)
                 
-                if current_task:
-                    combined_data['currentTaskAddress'] = current_task.get('locationAddress', '')
-                    combined_data['taskStatus'] = current_task.get('status', '')
-                    combined_data['plannedArrival'] = current_task.get('plannedArrival', current_task.get('date'))
-                    combined_data['actualArrival'] = current_task.get('actualArrival', current_task.get('timeCompleted'))
-                    combined_data['customerName'] = current_task.get('customerName', current_task.get('locationName', ''))
-                    combined_data['orderNumber'] = current_task.get('orderNumber', str(current_task.get('taskId', '')))
-                    combined_data['cargoDescription'] = current_task.get('cargoDescription', current_task.get('logistComment', ''))
-                    combined_data['palletCount'] = current_task.get('palletCount', current_task.get('parcelWeight'))
-                    combined_data['cargoWeight'] = current_task.get('cargoWeight', current_task.get('totalParcelWeight'))
-                    combined_data['priority'] = current_task.get('priority', 2)
-                    combined_data['notes'] = current_task.get('notes', current_task.get('driverNotes', ''))
-                    
-                    # Вычисляем расстояние до текущей задачи
-                    task_lat = current_task.get('latitude', current_task.get('lat'))
-                    task_lng = current_task.get('longitude', current_task.get('lng'))
-                    if combined_data.get('lat') and combined_data.get('lng') and task_lat and task_lng:
-                        distance = notion._calculate_distance(
-                            combined_data['lat'], combined_data['lng'],
-                            task_lat, task_lng
-                        )
-                        combined_data['distanceToTask'] = distance
+                # Свойства Notion для всех ТС яруса - одним поколоночным преобразованием
+                payloads = _prepare_payloads(notion, tier_records, valid_records)
                 
-                # Следующая задача
-                next_task = tasks[1] if len(tasks) > 1 else None
-                if next_task:
-                    combined_data['nextTaskAddress'] = next_task.get('locationAddress', '')
-                
-                # Считаем выполненные задачи
-                completed = [t for t in tasks if t.get('status') == 'COMPLETED']
-                combined_data['completedTasks'] = len(completed)
-        
-        # Получаем отчет по устройству для дневного пробега
-        try:
-            report = loctracker.get_device_report(device_number)
-            if report:
-                combined_data['dailyDistance'] = report.get('totalDistance', 0)
-                combined_data['fuelTankCapacity'] = report.get('fuelTankCapacity', 400)
-                
-                # Если есть данные о заправках
-                if 'fuelData' in report:
-                    combined_data['fuelLevel'] = report['fuelData'].get('currentLevel')
-        except Exception as e:
-            logger.debug(f"Не удалось получить отчет для {registration}: {e}")
-        
-        # Получаем данные по топливу
-        try:
-            fuel_data = loctracker.get_fuel_data(device_number)
-            if fuel_data:
-                combined_data['fuelLevel'] = fuel_data.get('currentLevel')
-                combined_data['fuelTankCapacity'] = fuel_data.get('tankCapacity', 400)
-        except Exception as e:
-            logger.debug(f"Не удалось получить данные топлива для {registration}: {e}")
-        
-        # Обновляем или создаем запись в Notion
-        if notion.update_or_create_entry(combined_data):
-            processed_count += 1
-            logger.info(f"✅ Обработано: {registration}")
-        else:
-            error_count += 1
-            logger.error(f"❌ Ошибка обработки: {registration}")
+                results.extend(executor.map(with_pass_labels(write), tier_records, payloads))
+                records.extend(tier_records)
+        vehicles = [device for tier in tiers for device in tier]
+        
+        queued_count = _flush_outbox(outbox)
+        notion.save_state()
+        if activity_stream:
+            # Курсор сдвигаем только до активностей, уже записанных в Notion
+            activity_stream.commit()
+        if gate:
+            gate.save()
+        if geofence:
+            geofence.learn_tasks(records)
+            geofence.save()
+        
+        written_count = len(written)
+        enqueued_count = sum(1 for success in results if success) if outbox else 0
+        processed_count = 0
+        error_count = 0
+        for device, success in zip(vehicles, results):
+            registration = device.get('registrationNumber', '').strip()
+            if success:
+                processed_count += 1
+                logger.info(f"✅ Обработано: {registration}")
+            else:
+                error_count += 1
+                logger.error(f"❌ Ошибка обработки: {registration}")
         
-        # Небольшая задержка для API
-        time.sleep(0.5)
+        # Снимок состояния автопарка и ID страниц для перезапуска и других потребителей
+        if store:
+            try:
+                saved = [r for r in records if r is not None]
+                page_ids = {str(r.get('number')): notion.page_id_for(r) for r in saved}
+                with METRICS.stage('snapshot'):
+                    store.save_pass(saved, {k: v for k, v in page_ids.items() if v}, pass_started_at,
+                                    processed_count, error_count, notion.database_id)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения снимка: {e}")
+    finally:
+        loctracker.cache.purge()
+        if owns_loctracker:
+            loctracker.close()
+        if owns_outbox:
+            outbox.close()
+        if owns_store:
+            store.close()
     
     logger.info("="*50)
     logger.info(f"✅ Синхронизация завершена!")
     logger.info(f"📊 Обработано: {processed_count}")
     logger.info(f"❌ Ошибок: {error_count}")
-    logger.info(f"🔗 База данных: https://www.notion.so/{DISPATCHER_DATABASE_ID.replace('-', '')}")
+    skipped_count = notion.skipped_writes - skipped_before
+    duration = time.monotonic() - started_at
+    logger.info(f"⏭️ Без изменений (запись пропущена): {skipped_count}")
+    logger.info(f"💤 Без изменений (не запрашивались): {gated_count}")
+    if outbox:
+        logger.info(f"📮 Поставлено в очередь: {enqueued_count}, записано в Notion: {written_count}, "
+                    f"ожидают записи: {queued_count}"
+                    + (" (очередь выгружает фоновый поток - учтены записи, подтвержденные к концу прохода)"
+                       if outbox.draining else ""))
+    logger.info(f"⏱️ Длительность прохода: {duration:.1f} с")
+    record_pass(duration, written_count, error_count, skipped_count, gated_count, enqueued_count)
+    _report_writes(outbox, plan, gate)
+    cache_stats = ', '.join(f"{source} {s['hits']}/{s['hits'] + s['misses']}"
+                            for source, s in loctracker.cache.stats().items())
+    if cache_stats:
+        logger.info(f"💾 Кэш LocTracker (попадания/запросы): {cache_stats}")
+    negative_stats = loctracker.negative_cache.stats()
+    if negative_stats['avoided']:
+        avoided = ', '.join(f"{endpoint} {count}" for endpoint, count in sorted(negative_stats['avoided'].items()))
+        active = ', '.join(f"{failure} {count}" for failure, count in sorted(negative_stats['active'].items()))
+        logger.info(f"🚫 Пропущено запросов к падающим эндпоинтам: {avoided} (в паузе: {active or '-'})")
+    logger.info(f"🔗 База данных: https://www.notion.so/{notion.database_id.replace('-', '')}")
     logger.info("="*50)
+    
+    return {
+        'processed': processed_count,
+        'errors': error_count,
+        'skipped': skipped_count,
+        'gated': gated_count,
+        'enqueued': enqueued_count,
+        'written': written_count,
+        'queued': queued_count,
+        'duration': duration,
+    }
 
 def main():
     """Главная функция"""
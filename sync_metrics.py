@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Метрики проходов синхронизации в формате Prometheus
+Гистограммы по этапам (загрузка, объединение, преобразование, поиск и запись в Notion),
+вызовы LocTracker и Notion по эндпоинтам с классами ошибок, длительность прохода
+относительно интервала. Экспорт - HTTP-эндпоинт /metrics или текстовый файл
+"""
+
+import os
+import time
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Порт HTTP-эндпоинта /metrics для демона (0 - не запускать)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Файл метрик, перезаписывается после каждого прохода ('' - не писать)
+METRICS_FILE = os.getenv('METRICS_FILE', '')
+
+# Границы корзин гистограмм (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+HELP = {
+    'sync_stage_duration_seconds': 'Длительность этапов прохода синхронизации',
+    'sync_pass_duration_seconds': 'Длительность прохода синхронизации',
+    'sync_pass_last_duration_seconds': 'Длительность последнего прохода',
+    'sync_critical_write_seconds': 'Задержка записи критичных ТС от начала прохода',
+    'sync_critical_slo_breaches_total': 'Записи критичных ТС позже CRITICAL_SLO_SECONDS',
+    'sync_tenant_pass_duration_seconds': 'Длительность последнего прохода арендатора',
+    'sync_tenant_last_success_timestamp': 'Время последнего успешного прохода арендатора (unix)',
+    'sync_first_write_seconds': 'Время от начала потокового прохода до первой записи в Notion',
+    'geofence_events_total': 'Входы и выходы ТС из геозон своих задач',
+    'geofence_tasks': 'Задач в индексе геозон',
+    'notion_outbox_pending': 'Записей в очереди Notion',
+    'notion_outbox_writes_total': 'Выгрузки из очереди Notion по результату',
+    'notion_outbox_coalesced_total': 'Записи, заменившие ожидающую запись того же ТС',
+    'loctracker_proxy_requests_total': 'Запросы к прокси LocTracker по источникам и результату (hit/miss/coalesced/stale)',
+    'loctracker_response_bytes_total': 'Объем тел ответов LocTracker по эндпоинтам (байты)',
+    'loctracker_last_response_bytes': 'Размер последнего ответа LocTracker по эндпоинтам (байты)',
+    'loctracker_decode_seconds': 'Время разбора JSON ответов LocTracker по эндпоинтам',
+    'loctracker_unchanged_bodies_total': 'Ответы LocTracker, побайтно совпавшие с предыдущими (без разбора)',
+    'sync_interval_seconds': 'Интервал между проходами демона',
+    'sync_pass_interval_ratio': 'Доля интервала, занятая последним проходом',
+    'sync_passes_total': 'Выполненные проходы',
+    'sync_skipped_ticks_total': 'Пропущенные запуски из-за длинных проходов',
+    'sync_vehicles_total': 'Результаты обработки ТС по проходам',
+    'loctracker_request_duration_seconds': 'Длительность запросов к LocTracker по эндпоинтам',
+    'loctracker_requests_total': 'Запросы к LocTracker по эндпоинтам и результату',
+    'notion_request_duration_seconds': 'Длительность запросов к Notion по методам',
+    'notion_requests_total': 'Запросы к Notion по методам и результату',
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Метки проходов в текущем контексте (tenant=... в tenant_sync): арендаторы одного процесса
+# пишут этапы и итоги проходов в общий реестр, и без метки их ряды смешались бы
+_pass_labels: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar('pass_labels', default={})
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in items) + '}'
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class MetricsRegistry:
+    """Потокобезопасные счетчики, значения и гистограммы с метками"""
+    
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._gauges: Dict[str, Dict[Labels, float]] = {}
+        # имя -> метки -> [счетчики корзин..., сумма, количество]
+        self._histograms: Dict[str, Dict[Labels, list]] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+    
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels(labels)] = value
+    
+    def observe(self, name: str, value: float, **labels):
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+    
+    @contextmanager
+    def time(self, name: str, **labels) -> Iterator[None]:
+        """Засечь длительность блока в гистограмму"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    def stage(self, stage: str):
+        """Засечь этап прохода (sync_stage_duration_seconds{stage=...})"""
+        return self.time('sync_stage_duration_seconds', stage=stage, **_pass_labels.get())
+    
+    def observe_stage(self, stage: str, seconds: float):
+        """Учесть длительность этапа, засеченную вручную (этап из одновременных запросов)"""
+        self.observe('sync_stage_duration_seconds', seconds, stage=stage, **_pass_labels.get())
+    
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted(metrics):
+                    lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for labels, value in sorted(metrics[name].items()):
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+            for name in sorted(self._histograms):
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, state in sorted(self._histograms[name].items()):
+                    for bound, count in zip(self.buckets, state):
+                        lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_value(bound)))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {state[-1]}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(state[-2])}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {state[-1]}")
+        return '\n'.join(lines) + '\n'
+    
+    def write_file(self, path: str):
+        """Записать метрики в файл атомарно (для textfile collector node_exporter)"""
+        tmp_file = f"{path}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(self.render())
+            os.replace(tmp_file, path)
+        except Exception as e:
+            logger.warning(f"Не удалось записать метрики в {path}: {e}")
+    
+    def start_http_server(self, port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+        """Отдавать /metrics из фонового потока"""
+        registry = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logger.info(f"📊 Метрики доступны на http://{host}:{port}/metrics")
+        return server
+
+# Общий реестр процесса
+METRICS = MetricsRegistry()
+
+@contextmanager
+def pass_labels(**labels) -> Iterator[None]:
+    """Добавлять метки к этапам и итогам проходов внутри блока"""
+    token = _pass_labels.set({**_pass_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _pass_labels.reset(token)
+
+def with_pass_labels(func: Callable) -> Callable:
+    """func с метками проходов текущего контекста - для запуска в другом потоке
+    
+    Потоки (в отличие от задач asyncio) не наследуют контекст, поэтому функции,
+    которые передаются в пулы и потоки прохода, оборачиваются этой функцией.
+    """
+    labels = _pass_labels.get()
+    if not labels:
+        return func
+    
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        with pass_labels(**labels):
+            return func(*args, **kwargs)
+    
+    return run
+
+def record_pass(duration: float, written: int, errors: int, skipped: int, gated: int = 0, enqueued: int = 0):
+    """Итоги прохода: длительность и результаты по ТС; файл метрик, если задан
+    
+    written - подтвержденные записи в Notion за проход (включая пропущенные без изменений),
+    enqueued - поставленные в очередь записей (их выгрузку считает notion_outbox_writes_total).
+    Ряды получают метки pass_labels() (у арендаторов - tenant).
+    """
+    labels = _pass_labels.get()
+    METRICS.observe('sync_pass_duration_seconds', duration, **labels)
+    METRICS.set('sync_pass_last_duration_seconds', duration, **labels)
+    METRICS.inc('sync_passes_total', **labels)
+    METRICS.inc('sync_vehicles_total', max(0, written - skipped), result='written', **labels)
+    METRICS.inc('sync_vehicles_total', skipped, result='unchanged', **labels)
+    METRICS.inc('sync_vehicles_total', errors, result='error', **labels)
+    METRICS.inc('sync_vehicles_total', gated, result='gated', **labels)
+    METRICS.inc('sync_vehicles_total', enqueued, result='enqueued', **labels)
+    if METRICS_FILE:
+        METRICS.write_file(METRICS_FILE)
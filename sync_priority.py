@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Порядок обработки ТС по срочности
+Статус считается заранее по дешевым общим данным (позиции, тахографы, задачи из fleet state),
+и ТС, которым скоро нужна пауза, обогащаются и пишутся в Notion раньше стоящих
+"""
+
+import os
+import math
+import logging
+import threading
+from typing import Callable, Dict, List
+
+from sync_metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Порядок обработки ТС: devices - как в get_devices(), priority - сначала срочные
+SYNC_ORDER = os.getenv('SYNC_ORDER', 'devices')
+# Цель по задержке записи критичных ТС от начала прохода (секунды)
+CRITICAL_SLO_SECONDS = float(os.getenv('CRITICAL_SLO_SECONDS', '30'))
+# Движущееся ТС ближе этого расстояния до текущей задачи считается подъезжающим (км)
+NEAR_TASK_KM = float(os.getenv('NEAR_TASK_KM', '25'))
+
+# Ранги срочности (меньше - раньше)
+URGENT_STATUS_RANKS = {"🔴 KRITISCH": 0, "🟠 PAUSE BALD": 1, "🟡 WARNUNG": 2}
+RANK_NEAR_TASK = 3
+RANK_MOVING = 4
+RANK_OTHER = 5
+# ТС с рангом не больше этого - критичные: отдельный первый ярус и SLO
+CRITICAL_RANK = 1
+
+def urgency_rank(status: str, record: Dict) -> int:
+    """Ранг срочности: статус тахографа, затем движение к близкой задаче, затем движение"""
+    if status in URGENT_STATUS_RANKS:
+        return URGENT_STATUS_RANKS[status]
+    moving = (record.get('speed') or 0) > 5
+    distance = record.get('distanceToTask')
+    if moving and distance is not None and distance <= NEAR_TASK_KM:
+        return RANK_NEAR_TASK
+    if moving:
+        return RANK_MOVING
+    return RANK_OTHER
+
+class PriorityPlan:
+    """Порядок ТС на проход и учет задержки записи критичных ТС
+    
+    previews - предварительно объединенные записи (без запросов по отдельным ТС)
+    в порядке vehicles; status_func - DispatcherNotionSync._calculate_status.
+    """
+    
+    def __init__(self, vehicles: List[Dict], previews: List[Dict], status_func: Callable[[Dict], str]):
+        self.ranks: Dict[str, int] = {}
+        keyed = []
+        for position, (device, preview) in enumerate(zip(vehicles, previews)):
+            try:
+                rank = urgency_rank(status_func(preview), preview)
+            except Exception as e:
+                logger.debug(f"Не удалось оценить срочность {device.get('number')}: {e}")
+                rank = RANK_OTHER
+            distance = preview.get('distanceToTask')
+            self.ranks[str(device.get('number'))] = rank
+            keyed.append(((rank, math.inf if distance is None else distance, position), device))
+        keyed.sort(key=lambda item: item[0])
+        
+        ordered = [device for _, device in keyed]
+        self.critical_count = sum(1 for (rank, _, _), _ in keyed if rank <= CRITICAL_RANK)
+        # Критичные ТС проходят весь цикл до записи отдельно, не дожидаясь остального автопарка
+        self.tiers = [tier for tier in (ordered[:self.critical_count], ordered[self.critical_count:]) if tier]
+        self.latencies: List[float] = []
+        self.lock = threading.Lock()
+    
+    @property
+    def ordered(self) -> List[Dict]:
+        return [device for tier in self.tiers for device in tier]
+    
+    def rank(self, record: Dict) -> int:
+        return self.ranks.get(str(record.get('number')), RANK_OTHER)
+    
+    def is_critical(self, record: Dict) -> bool:
+        return self.rank(record) <= CRITICAL_RANK
+    
+    def observe_write(self, record: Dict, elapsed: float):
+        """Учесть запись ТС через elapsed секунд от начала прохода"""
+        if not self.is_critical(record):
+            return
+        METRICS.observe('sync_critical_write_seconds', elapsed)
+        if elapsed > CRITICAL_SLO_SECONDS:
+            METRICS.inc('sync_critical_slo_breaches_total')
+        with self.lock:
+            self.latencies.append(elapsed)
+    
+    def log_plan(self):
+        counts = {}
+        for rank in self.ranks.values():
+            counts[rank] = counts.get(rank, 0) + 1
+        summary = ', '.join(f"{rank}: {count}" for rank, count in sorted(counts.items()))
+        logger.info(f"🚨 Порядок по срочности, критичных ТС: {self.critical_count} (ранги {summary})")
+    
+    def report(self, confirmed_only: bool = False):
+        """Итог SLO по критичным ТС за проход
+        
+        confirmed_only - записи прохода еще в очереди Notion: промежуточный итог
+        только по уже подтвержденным записям, без предупреждения о недописанных.
+        """
+        if not self.critical_count:
+            return
+        with self.lock:
+            written = len(self.latencies)
+            worst = max(self.latencies, default=0.0)
+        if confirmed_only:
+            logger.info(f"🚨 Критичные ТС: подтверждено пока {written}/{self.critical_count}, "
+                        f"худшая задержка {worst:.1f} с (итог - после выгрузки очереди)")
+            return
+        if written < self.critical_count or worst > CRITICAL_SLO_SECONDS:
+            logger.warning(f"⚠️ Критичные ТС: записано {written}/{self.critical_count}, "
+                           f"худшая задержка {worst:.1f} с (SLO {CRITICAL_SLO_SECONDS:.0f} с)")
+        else:
+            logger.info(f"🚨 Критичные ТС записаны за {worst:.1f} с (SLO {CRITICAL_SLO_SECONDS:.0f} с)")
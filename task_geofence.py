@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Геозоны задач и локальное определение прибытия
+Незавершенные задачи автопарка (из fleet state и ранее полученных tasks/{device}/trip) раскладываются
+по сетке ячеек; позиции прохода ищутся только в соседних ячейках, а не перебором всех задач.
+Вход в геозону своей задачи, нахождение в ней не меньше GEOFENCE_MIN_DWELL_SECONDS и выход
+дают время прибытия и отъезда без запросов по отдельным ТС
+"""
+
+import os
+import json
+import math
+import time
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sync_metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Определять прибытие к задачам по геозонам
+GEOFENCE_ENABLED = os.getenv('GEOFENCE_ENABLED', '1') == '1'
+# Файл с визитами в геозоны и задачами, известными из tasks/{device}/trip
+GEOFENCE_FILE = os.getenv('GEOFENCE_FILE', '.geofence_state.json')
+# Радиус геозоны вокруг точки задачи (метры)
+GEOFENCE_RADIUS_M = float(os.getenv('GEOFENCE_RADIUS_M', '300'))
+# Минимальное время в геозоне, чтобы считать ТС прибывшим, а не проехавшим мимо (секунды)
+GEOFENCE_MIN_DWELL_SECONDS = float(os.getenv('GEOFENCE_MIN_DWELL_SECONDS', '120'))
+
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEGREE = 111320
+
+def _coordinate(value) -> Optional[float]:
+    try:
+        return None if value is None or value == '' else float(value)
+    except (TypeError, ValueError):
+        return None
+
+def task_key(task: Dict) -> Optional[str]:
+    """Ключ задачи: ID из LocTracker, иначе координаты"""
+    task_id = task.get('taskId', task.get('id'))
+    if task_id is not None:
+        return str(task_id)
+    lat = _coordinate(task.get('latitude', task.get('lat')))
+    lng = _coordinate(task.get('longitude', task.get('lng')))
+    if lat is None or lng is None:
+        return None
+    return f"{lat:.5f},{lng:.5f}"
+
+def distance_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Расстояние по прямой в метрах (haversine, без коэффициента дорог)"""
+    lat1_rad, lat2_rad = math.radians(lat1), math.radians(lat2)
+    a = (math.sin(math.radians(lat2 - lat1) / 2) ** 2
+         + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+class TaskGeofenceIndex:
+    """Сетка ячеек над точками задач
+    
+    Сторона ячейки не меньше радиуса геозоны, поэтому все задачи в радиусе от точки
+    лежат в ее ячейке и соседних (по долготе соседей больше - градус долготы короче у полюсов).
+    """
+    
+    def __init__(self, radius_m: float = GEOFENCE_RADIUS_M):
+        self.radius_m = radius_m
+        self.cell_deg = radius_m / METERS_PER_DEGREE
+        # (ячейка широты, ячейка долготы) -> [(устройство, ключ задачи, lat, lng)]
+        self.cells: Dict[Tuple[int, int], List[Tuple[str, str, float, float]]] = {}
+        self.size = 0
+    
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg)
+    
+    def add(self, device_number: str, key: str, lat: float, lng: float):
+        self.cells.setdefault(self._cell(lat, lng), []).append((device_number, key, lat, lng))
+        self.size += 1
+    
+    def nearby(self, lat: float, lng: float) -> List[Tuple[str, str, float]]:
+        """Задачи в радиусе от точки: (устройство, ключ задачи, расстояние в метрах)"""
+        row, col = self._cell(lat, lng)
+        # Сколько ячеек долготы покрывают радиус на этой широте
+        span = math.ceil(1 / max(math.cos(math.radians(lat)), 0.01))
+        found = []
+        for cell_row in (row - 1, row, row + 1):
+            for cell_col in range(col - span, col + span + 1):
+                for device_number, key, task_lat, task_lng in self.cells.get((cell_row, cell_col), ()):
+                    distance = distance_m(lat, lng, task_lat, task_lng)
+                    if distance <= self.radius_m:
+                        found.append((device_number, key, distance))
+        return found
+    
+    def __len__(self) -> int:
+        return self.size
+
+class GeofenceTracker:
+    """Визиты ТС в геозоны своих задач между проходами
+    
+    update() строит индекс по незавершенным задачам, сопоставляет позиции прохода
+    и возвращает подтвержденные прибытия; learn_tasks() запоминает задачи ТС,
+    которых нет в fleet state (пришли из tasks/{device}/trip), для следующих проходов;
+    save() сохраняет состояние на диск.
+    """
+    
+    def __init__(self, state_file: Optional[str] = GEOFENCE_FILE, radius_m: float = GEOFENCE_RADIUS_M,
+                 min_dwell: float = GEOFENCE_MIN_DWELL_SECONDS):
+        self.state_file = state_file
+        self.radius_m = radius_m
+        self.min_dwell = min_dwell
+        state = self._load()
+        # устройство -> ключ задачи -> {'entered', 'seen', 'exited'} (мс)
+        self.visits: Dict[str, Dict[str, Dict]] = state.get('visits', {})
+        # устройство -> [[ключ задачи, lat, lng]] для ТС без задач в fleet state
+        self.trip_tasks: Dict[str, List[list]] = state.get('trip_tasks', {})
+        self.fleet_devices = set()
+        self.lock = threading.Lock()
+    
+    def _load(self) -> Dict:
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать состояние геозон: {e}")
+            return {}
+    
+    def save(self):
+        """Атомарно сохранить визиты и задачи"""
+        if not self.state_file:
+            return
+        tmp_file = f"{self.state_file}.tmp"
+        try:
+            with self.lock:
+                data = json.dumps({'visits': self.visits, 'trip_tasks': self.trip_tasks})
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_file, self.state_file)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить состояние геозон: {e}")
+    
+    def _build_index(self, fleet_tasks_dict: Dict[str, List[Dict]]) -> TaskGeofenceIndex:
+        index = TaskGeofenceIndex(self.radius_m)
+        for device_number, tasks in fleet_tasks_dict.items():
+            for task in tasks or []:
+                if task.get('status') == 'COMPLETED':
+                    continue
+                key = task_key(task)
+                lat = _coordinate(task.get('latitude', task.get('lat')))
+                lng = _coordinate(task.get('longitude', task.get('lng')))
+                if key is not None and lat is not None and lng is not None:
+                    index.add(str(device_number), key, lat, lng)
+        # Задачи из tasks/{device}/trip известны с прошлых проходов
+        for device_number, tasks in self.trip_tasks.items():
+            if device_number not in self.fleet_devices:
+                for key, lat, lng in tasks:
+                    index.add(device_number, key, lat, lng)
+        return index
+    
+    def update(self, positions: Iterable[Dict], fleet_tasks_dict: Dict[str, List[Dict]],
+               now: Optional[float] = None) -> Dict[str, Dict[str, Dict]]:
+        """Сопоставить позиции прохода с геозонами
+        
+        Возвращает устройство -> ключ задачи -> {'arrivedAt', 'departedAt'} (мс) для визитов
+        не короче min_dwell; departedAt - None, пока ТС в геозоне.
+        """
+        now_ms = int((time.time() if now is None else now) * 1000)
+        entered = exited = 0
+        with self.lock:
+            self.fleet_devices = {str(device_number) for device_number in fleet_tasks_dict}
+            index = self._build_index(fleet_tasks_dict)
+            pending: Dict[str, set] = {}
+            for cell in index.cells.values():
+                for device_number, key, _, _ in cell:
+                    pending.setdefault(device_number, set()).add(key)
+            
+            # Позиции - по времени: более поздняя точка не должна закрыть визит раньше более ранней
+            timed = sorted(((int(position.get('time') or now_ms), position) for position in positions),
+                           key=lambda item: item[0])
+            for seen_at, position in timed:
+                lat, lng = _coordinate(position.get('lat')), _coordinate(position.get('lng'))
+                device_number = str(position.get('deviceNumber'))
+                if lat is None or lng is None or device_number not in pending:
+                    continue
+                # Прибытием считается только геозона своей задачи
+                inside = {key for owner, key, _ in index.nearby(lat, lng) if owner == device_number}
+                visits = self.visits.setdefault(device_number, {})
+                for key in inside:
+                    visit = visits.get(key)
+                    if visit is None or (visit['exited'] is not None and not self._confirmed(visit)):
+                        # Первый вход или повторный после проезда мимо
+                        visits[key] = {'entered': seen_at, 'seen': seen_at, 'exited': None}
+                        entered += 1
+                    elif visit['exited'] is None:
+                        visit['seen'] = max(visit['seen'], seen_at)
+                for key, visit in visits.items():
+                    if key not in inside and visit['exited'] is None:
+                        visit['exited'] = seen_at
+                        exited += 1
+            
+            # Визиты к завершенным (или снятым) задачам больше не нужны
+            for device_number in list(self.visits):
+                keys = pending.get(device_number, set())
+                visits = {key: visit for key, visit in self.visits[device_number].items() if key in keys}
+                if visits:
+                    self.visits[device_number] = visits
+                else:
+                    del self.visits[device_number]
+            
+            arrivals = {}
+            for device_number, visits in self.visits.items():
+                confirmed = {
+                    key: {'arrivedAt': visit['entered'], 'departedAt': visit['exited']}
+                    for key, visit in visits.items() if self._confirmed(visit)
+                }
+                if confirmed:
+                    arrivals[device_number] = confirmed
+        
+        METRICS.inc('geofence_events_total', entered, event='enter')
+        METRICS.inc('geofence_events_total', exited, event='exit')
+        METRICS.set('geofence_tasks', len(index))
+        logger.info(f"📍 Геозоны задач: {len(index)}, входов: {entered}, выходов: {exited}, "
+                    f"ТС с прибытием: {len(arrivals)}")
+        return arrivals
+    
+    def _confirmed(self, visit: Dict) -> bool:
+        """ТС пробыло в геозоне не меньше min_dwell"""
+        end = visit['exited'] if visit['exited'] is not None else visit['seen']
+        return (end - visit['entered']) / 1000 >= self.min_dwell
+    
+    def learn_tasks(self, records: Iterable[Optional[Dict]]):
+        """Запомнить незавершенные задачи ТС, которых нет в fleet state (ключи и координаты из записей)"""
+        with self.lock:
+            for record in records:
+                if record is None:
+                    continue
+                device_number = str(record.get('number'))
+                if device_number in self.fleet_devices:
+                    continue
+                tasks = []
+                for key, (lat, lng) in zip(record.get('taskKeys') or [], record.get('taskCoords') or []):
+                    lat, lng = _coordinate(lat), _coordinate(lng)
+                    if key is not None and lat is not None and lng is not None:
+                        tasks.append([key, lat, lng])
+                if tasks:
+                    self.trip_tasks[device_number] = tasks
+                else:
+                    self.trip_tasks.pop(device_number, None)
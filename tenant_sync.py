@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Синхронизация нескольких дочерних компаний в одном процессе
+Каждый арендатор - своя учетная запись LocTracker и своя база диспетчера в Notion
+(конфигурация в TENANTS_FILE). Клиенты, кэши и локальное состояние у арендаторов раздельные,
+проходы идут по очереди от давно не обновлявшихся; при TENANT_PROCESSES > 1 арендаторы
+делятся между несколькими процессами
+"""
+
+import os
+import json
+import time
+import signal
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from activity_stream import ActivityStream
+from change_gate import CHANGE_GATE_ENABLED, ChangeGate
+from position_history import POSITION_HISTORY_DIR, PositionHistory
+from snapshot_store import SNAPSHOT_DB_FILE, SnapshotStore
+from stream_sync import stream_sync_dispatcher_data
+from sync_daemon import SYNC_INTERVAL_SECONDS, SYNC_PIPELINE, SyncDaemon
+from sync_dispatcher_data import (
+    ACTIVITY_STREAM_ENABLED,
+    NOTION_RATE_LIMIT,
+    DispatcherNotionSync,
+    LocTrackerAPI,
+    RateLimiter,
+    sync_dispatcher_data,
+)
+from sync_metrics import METRICS, METRICS_PORT, pass_labels
+from task_geofence import GEOFENCE_ENABLED, GeofenceTracker
+from notion_outbox import NOTION_OUTBOX_FILE, NotionOutbox
+from vehicle_state import VehicleStates
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация арендаторов (JSON-список; строки ${VAR} берутся из окружения)
+TENANTS_FILE = os.getenv('TENANTS_FILE', 'tenants.json')
+# Каталог локального состояния арендаторов (по подкаталогу на арендатора)
+TENANTS_STATE_DIR = os.getenv('TENANTS_STATE_DIR', 'tenants')
+# Сколько арендаторов синхронизируется одновременно в одном процессе
+TENANT_CONCURRENCY = int(os.getenv('TENANT_CONCURRENCY', '2'))
+# Воркеров обогащения на проход одного арендатора
+TENANT_WORKERS = int(os.getenv('TENANT_WORKERS', '4'))
+# Число процессов (0/1 - все арендаторы в текущем процессе)
+TENANT_PROCESSES = int(os.getenv('TENANT_PROCESSES', '0'))
+
+REQUIRED_FIELDS = ('name', 'loctracker_username', 'loctracker_password', 'database_id')
+
+def load_tenants(path: str = TENANTS_FILE) -> List[Dict]:
+    """Прочитать и проверить конфигурацию арендаторов"""
+    with open(path, 'r', encoding='utf-8') as f:
+        configs = json.load(f)
+    if not isinstance(configs, list) or not configs:
+        raise ValueError(f"{path}: ожидается непустой список арендаторов")
+    
+    names = set()
+    for config in configs:
+        for key, value in config.items():
+            if isinstance(value, str):
+                config[key] = os.path.expandvars(value)
+                # expandvars оставляет незаданные переменные как есть - такой пароль или токен не годится
+                if '${' in config[key]:
+                    raise ValueError(f"{path}: у арендатора {config.get('name', '?')} в {key} "
+                                     f"не задана переменная окружения {value}")
+        missing = [field for field in REQUIRED_FIELDS if not config.get(field)]
+        if missing:
+            raise ValueError(f"{path}: у арендатора {config.get('name', '?')} не заданы {', '.join(missing)}")
+        if config['name'] in names:
+            raise ValueError(f"{path}: арендатор {config['name']} указан дважды")
+        names.add(config['name'])
+    return configs
+
+def notion_token(config: Dict) -> Optional[str]:
+    """Токен интеграции Notion арендатора (по умолчанию общий из окружения)"""
+    return config.get('notion_api_key') or os.getenv('NOTION_API_KEY')
+
+class Tenant:
+    """Клиенты и локальное состояние одного арендатора (учетная запись LocTracker -> база Notion)"""
+    
+    def __init__(self, config: Dict, notion_limiters: Dict[str, RateLimiter]):
+        self.name = config['name']
+        self.workers = int(config.get('workers', TENANT_WORKERS))
+        state_dir = config.get('state_dir') or os.path.join(TENANTS_STATE_DIR, self.name)
+        os.makedirs(state_dir, exist_ok=True)
+        
+        self.loctracker = LocTrackerAPI(config['loctracker_username'], config['loctracker_password'],
+                                        config.get('loctracker_url'))
+        # Лимит Notion считается на токен интеграции: базы с общим токеном делят лимитер
+        api_key = notion_token(config)
+        limiter = notion_limiters.get(api_key) or RateLimiter(float(config.get('notion_rate_limit', NOTION_RATE_LIMIT)))
+        self.notion = DispatcherNotionSync(config['database_id'], api_key,
+                                           os.path.join(state_dir, 'notion_state.json'), limiter)
+        notion_limiters[api_key] = limiter
+        
+        self.store = SnapshotStore(os.path.join(state_dir, 'fleet_snapshot.db')) if SNAPSHOT_DB_FILE else None
+        self.history = PositionHistory(os.path.join(state_dir, 'position_history')) if POSITION_HISTORY_DIR else None
+        self.gate = ChangeGate(os.path.join(state_dir, 'change_gate.json')) if CHANGE_GATE_ENABLED else None
+        self.geofence = GeofenceTracker(os.path.join(state_dir, 'geofence_state.json')) if GEOFENCE_ENABLED else None
+        self.outbox = None
+        if NOTION_OUTBOX_FILE:
+            self.outbox = NotionOutbox(self.notion, os.path.join(state_dir, 'notion_outbox.db'))
+            # Поток выгрузки пишет этапы с меткой арендатора
+            with pass_labels(tenant=self.name):
+                self.outbox.start_drainer()
+        # Номера устройств разных аккаунтов могут совпадать - записи ТС у каждого свои
+        self.states = VehicleStates()
+        self.activity_stream = None
+        if ACTIVITY_STREAM_ENABLED:
+            self.activity_stream = ActivityStream(self.loctracker, os.path.join(state_dir, 'activity_cursor.json'))
+        
+        # Время окончания последнего прохода (0 - еще не синхронизировался)
+        self.last_synced_at = 0.0
+    
+    def run_pass(self):
+        """Один проход арендатора; ошибка не затрагивает остальных"""
+        logger.info(f"🏢 {self.name}: начало прохода")
+        started = time.monotonic()
+        run_pass = stream_sync_dispatcher_data if SYNC_PIPELINE == 'stream' else sync_dispatcher_data
+        try:
+            # Этапы и итоги прохода - с меткой арендатора: шард пишет в один реестр за всех своих
+            with pass_labels(tenant=self.name):
+                summary = run_pass(workers=self.workers, loctracker=self.loctracker, notion=self.notion,
+                                   store=self.store, history=self.history, gate=self.gate,
+                                   activity_stream=self.activity_stream, geofence=self.geofence,
+                                   outbox=self.outbox, states=self.states)
+            if summary:
+                METRICS.set('sync_tenant_last_success_timestamp', time.time(), tenant=self.name)
+        except Exception as e:
+            logger.error(f"❌ {self.name}: ошибка прохода синхронизации: {e}")
+        finally:
+            duration = time.monotonic() - started
+            METRICS.set('sync_tenant_pass_duration_seconds', duration, tenant=self.name)
+            self.last_synced_at = time.monotonic()
+            logger.info(f"🏢 {self.name}: проход за {duration:.1f} с")
+    
+    def close(self):
+        if self.outbox:
+            self.outbox.stop_drainer()
+            self.outbox.close()
+        self.notion.save_state()
+        self.loctracker.close()
+        if self.store:
+            self.store.close()
+
+class TenantSyncDaemon(SyncDaemon):
+    """Демон с проходами по всем арендаторам на общей сетке интервалов"""
+    
+    def __init__(self, configs: List[Dict], interval: float = SYNC_INTERVAL_SECONDS,
+                 concurrency: int = TENANT_CONCURRENCY):
+        self.configs = configs
+        self.concurrency = max(1, concurrency)
+        super().__init__(interval)
+    
+    def _create_clients(self):
+        notion_limiters: Dict[str, RateLimiter] = {}
+        self.tenants = [Tenant(config, notion_limiters) for config in self.configs]
+        logger.info(f"🏢 Арендаторов: {len(self.tenants)}, одновременно: {self.concurrency}")
+    
+    def _run_pass(self):
+        # Первыми идут давно не обновлявшиеся: при нехватке слотов никто не остается всегда последним
+        queue = sorted(self.tenants, key=lambda tenant: tenant.last_synced_at)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='tenant') as executor:
+            list(executor.map(Tenant.run_pass, queue))
+    
+    def shutdown(self):
+        for tenant in self.tenants:
+            tenant.close()
+        logger.info(f"👋 Демон остановлен. Проходов: {self.passes}, пропущено запусков: {self.skipped_ticks}")
+
+def _run_shard(configs: List[Dict], metrics_port: int):
+    """Процесс-шард: свой демон для части арендаторов"""
+    daemon = TenantSyncDaemon(configs)
+    daemon.metrics_port = metrics_port
+    daemon.install_signal_handlers()
+    daemon.run()
+
+def plan_shards(configs: List[Dict], processes: int) -> List[List[Dict]]:
+    """Разделить арендаторов между процессами; арендаторы с общим токеном Notion - в одном
+    
+    Лимит Notion считается на токен, а общий RateLimiter есть только внутри процесса:
+    токен в двух процессах получил бы удвоенный темп запросов.
+    """
+    groups: Dict[Optional[str], List[Dict]] = {}
+    for config in configs:
+        groups.setdefault(notion_token(config), []).append(config)
+    shards: List[List[Dict]] = [[] for _ in range(min(processes, len(groups)))]
+    # Крупные группы первыми - в наименее загруженный шард
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(shards, key=len).extend(group)
+    if len(shards) < processes:
+        logger.warning(f"⚠️ Токенов Notion: {len(groups)} - процессов меньше, чем TENANT_PROCESSES={processes}")
+    return shards
+
+def run_sharded(configs: List[Dict], processes: int):
+    """Разделить арендаторов между процессами и дождаться их завершения"""
+    shards = plan_shards(configs, processes)
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        # Каждому шарду - свой порт метрик
+        context.Process(target=_run_shard, args=(shard, METRICS_PORT + index if METRICS_PORT else 0),
+                        name=f"tenant-shard-{index}")
+        for index, shard in enumerate(shards)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f"🏢 Арендаторы разделены между {len(workers)} процессами")
+    
+    def forward(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    
+    for worker in workers:
+        worker.join()
+
+def main(path: Optional[str] = None):
+    """Главная функция"""
+    configs = load_tenants(path or TENANTS_FILE)
+    if TENANT_PROCESSES > 1 and len(configs) > 1:
+        run_sharded(configs, TENANT_PROCESSES)
+        return
+    daemon = TenantSyncDaemon(configs)
+    daemon.install_signal_handlers()
+    daemon.run()
+
+if __name__ == "__main__":
+    main()
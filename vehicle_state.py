@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Объединенная запись ТС с фиксированным набором полей (__slots__)
+Вместо нового словаря на каждое ТС в каждом проходе объединение заполняет VehicleState
+на месте: резидентный процесс держит по одной записи на устройство (VehicleStates)
+и переиспользует ее между проходами, поэтому память не растет от прохода к проходу.
+Запись читается как словарь (get, [], in, items) - потребители объединенных данных не меняются
+"""
+
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+class _Unset:
+    """Поле не заполнено в этом проходе (в словаре ключа бы не было)"""
+    
+    __slots__ = ()
+    
+    def __repr__(self) -> str:
+        return 'UNSET'
+    
+    def __bool__(self) -> bool:
+        return False
+
+UNSET = _Unset()
+
+# Поля объединенной записи и их типы; остальные ключи устройства и позиции попадают в extra
+FIELD_TYPES: Dict[str, Any] = {
+    # Устройство (/devices)
+    'id': Optional[int],
+    'vehicleId': Optional[int],
+    'number': Optional[str],
+    'registrationNumber': Optional[str],
+    'name': Optional[str],
+    'driver': Optional[str],
+    'driverPhone': Optional[str],
+    'groupName': Optional[str],
+    # Позиция (/positions)
+    'deviceNumber': Optional[str],
+    'lat': Optional[float],
+    'lng': Optional[float],
+    'speed': Optional[float],
+    'ignitionState': Optional[str],
+    'address': Optional[str],
+    'time': Optional[int],
+    # Тахограф (/tachographs/state)
+    'dailyDrivingTimeLeft': Optional[int],
+    'continuousDrivingTimeLeft': Optional[int],
+    'weeklyDrivingTimeLeft': Optional[int],
+    'currentActivity': Optional[str],
+    'workDayStarted': Optional[int],
+    'nextDayRest': Optional[int],
+    'longerDrivingCount': Optional[int],
+    'shorterRestCount': Optional[int],
+    'driverName': Optional[str],
+    # Задачи
+    'currentTaskAddress': Optional[str],
+    'taskStatus': Optional[str],
+    'plannedArrival': Optional[int],
+    'actualArrival': Optional[int],
+    'customerName': Optional[str],
+    'orderNumber': Optional[str],
+    'cargoDescription': Optional[str],
+    'palletCount': Optional[float],
+    'cargoWeight': Optional[float],
+    'priority': Optional[int],
+    'notes': Optional[str],
+    'taskCoords': Optional[List[Tuple[Any, Any]]],
+    'taskKeys': Optional[List[Optional[str]]],
+    'nextTaskAddress': Optional[str],
+    'completedTasks': Optional[int],
+    # Расстояния и ETA (fleet_geo.apply_task_distances)
+    'distanceToTask': Optional[float],
+    'taskDistances': Optional[List[Optional[float]]],
+    'taskEta': Optional[str],
+    'taskEtas': Optional[List[Optional[str]]],
+    # Отчет и топливо
+    'dailyDistance': Optional[float],
+    'fuelTankCapacity': Optional[float],
+    'fuelLevel': Optional[float],
+    # Лента активностей
+    'lastActivityType': Optional[str],
+    'lastActivityTime': Optional[int],
+    'lastMessage': Optional[str],
+    # Вычисляемые поля Notion
+    'utilization': Optional[float],
+    'delayMinutes': Optional[float],
+}
+
+FIELDS = tuple(FIELD_TYPES)
+_FIELD_SET = frozenset(FIELDS)
+
+class VehicleState:
+    """Объединенные данные одного ТС
+    
+    Известные поля хранятся в слотах (незаполненные - UNSET), прочие ключи - в extra.
+    reset() очищает запись перед новым объединением, поэтому данные прошлого прохода
+    не просачиваются в следующий. to_dict() дает обычный словарь для JSON.
+    """
+    
+    __slots__ = FIELDS + ('extra',)
+    
+    def __init__(self, data: Optional[Dict] = None):
+        self.extra: Dict[str, Any] = {}
+        self.reset(data)
+    
+    def reset(self, data: Optional[Dict] = None) -> 'VehicleState':
+        """Очистить все поля и заполнить из data (устройство)"""
+        for name in FIELDS:
+            setattr(self, name, UNSET)
+        self.extra.clear()
+        if data:
+            self.update(data)
+        return self
+    
+    def update(self, data: Dict):
+        """Как dict.update: известные ключи - в слоты, остальные - в extra"""
+        extra = self.extra
+        for key, value in data.items():
+            if key in _FIELD_SET:
+                setattr(self, key, value)
+            else:
+                extra[key] = value
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            return default if value is UNSET else value
+        return self.extra.get(key, default)
+    
+    def __getitem__(self, key: str) -> Any:
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            if value is UNSET:
+                raise KeyError(key)
+            return value
+        return self.extra[key]
+    
+    def __setitem__(self, key: str, value: Any):
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            self.extra[key] = value
+    
+    def __contains__(self, key: str) -> bool:
+        if key in _FIELD_SET:
+            return getattr(self, key) is not UNSET
+        return key in self.extra
+    
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        for name in FIELDS:
+            value = getattr(self, name)
+            if value is not UNSET:
+                yield name, value
+        yield from self.extra.items()
+    
+    def keys(self) -> Iterator[str]:
+        return (key for key, _ in self.items())
+    
+    def __iter__(self) -> Iterator[str]:
+        return self.keys()
+    
+    def __len__(self) -> int:
+        return sum(1 for _ in self.items())
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Обычный словарь заполненных полей (для JSON и снимков)"""
+        return dict(self.items())
+    
+    def __repr__(self) -> str:
+        return f"VehicleState({self.to_dict()!r})"
+
+class VehicleStates:
+    """Записи ТС резидентного процесса, по одной на устройство
+    
+    acquire() отдает запись устройства для объединения на месте; prune() удаляет
+    записи устройств, которых больше нет в автопарке. Между аккаунтами номера
+    устройств могут совпадать, поэтому у каждого арендатора свой набор.
+    """
+    
+    def __init__(self):
+        self.states: Dict[str, VehicleState] = {}
+        self.lock = threading.Lock()
+    
+    def acquire(self, device_number) -> VehicleState:
+        key = str(device_number)
+        state = self.states.get(key)
+        if state is None:
+            with self.lock:
+                state = self.states.setdefault(key, VehicleState())
+        return state
+    
+    def prune(self, devices: Iterable[Dict]) -> int:
+        """Оставить записи только текущих устройств; вернуть число удаленных"""
+        current = {str(device.get('number')) for device in devices}
+        with self.lock:
+            removed = [key for key in self.states if key not in current]
+            for key in removed:
+                del self.states[key]
+        return len(removed)
+    
+    def __len__(self) -> int:
+        return len(self.states)